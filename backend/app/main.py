@@ -13,21 +13,36 @@
 - POST /api/register            註冊
 - POST /api/login               登入
 - GET  /api/pet/status          查寵物狀態
+- POST /api/pet/states          一次查多位玩家的寵物狀態（給 WebSocket 組的體力快取）
+- GET  /api/pet/stream          自己寵物狀態的 SSE 推播（取代輪詢 /api/pet/status）
 - POST /api/pet/update          Pi 回報運動量，更新體力 + 紀錄 exercise_logs
 - GET  /api/leaderboard         排行榜
 - POST /api/battle/result       寫入對戰結果（給 WebSocket 組呼叫）
+- POST /api/battle/results      一次寫入多筆對戰結果（WebSocket 積壓補送時用）
 - GET  /api/battle/history      查某玩家的對戰紀錄
 - GET  /api/chat/history        查聊天歷史（未來 WebSocket 可用）
+- POST /api/chat/messages       WebSocket 批次寫入聊天訊息
 
 注意：
 - 多伺服器概念用欄位 server_id 表示： "A" / "B" / "C"
+- 寵物體力 / 積分改變時會推給 ws server（設定 PET_EVENTS_SOCKET，見下方「寵物狀態變動推播」）
 - 外部 nginx 會加 /serverA /serverB /serverC 前綴，這裡不需要處理
 """
 
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any, List, Optional
-
-from fastapi import Depends, FastAPI
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+
+from fastapi import Depends, FastAPI, Header
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy import (
     CheckConstraint,
@@ -39,6 +54,7 @@ from sqlalchemy import (
     Text,
     create_engine,
     func,
+    insert,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, relationship, sessionmaker
@@ -149,6 +165,8 @@ class Battle(Base):
     winner_user_id = Column(Integer, ForeignKey("users.user_id"), nullable=True)
     server_id = Column(String(1), nullable=False)
     battle_status = Column(String(16), nullable=False, default="FINISHED")
+    # WebSocket 端的對戰代號（"A:1_2_1700000000000"），重送時用來去重
+    battle_key = Column(String(64), unique=True, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
@@ -180,6 +198,10 @@ def verify_password(plain_password: str, password_hash: str) -> bool:
     return hash_password(plain_password) == password_hash
 
 
+# 對戰勝者加幾分；ws server 的 WS_BATTLE_WIN_SCORE 要一樣，大廳先加的分數才會和這裡寫進 DB 的對得上
+BATTLE_WIN_SCORE = 5
+
+
 def energy_to_status(energy: int) -> str:
     """
     體力對應狀態：
@@ -195,6 +217,283 @@ def energy_to_status(energy: int) -> str:
         return "ACTIVE"
 
 
+# ============================================================
+# 寵物狀態變動推播（給 ws server 的體力快取）
+# ============================================================
+
+# ws-server/backplane_broker.py 的 unix socket，要和 ws server 的 WS_GLOBAL_BACKPLANE 是同一個
+# 例：PET_EVENTS_SOCKET=/tmp/ws-global.sock；沒設定就不推（ws server 會定期整批重抓）
+PET_EVENTS_SOCKET = os.getenv("PET_EVENTS_SOCKET", "")
+# 這個行程發出去的事件會帶 origin，從 broker 收回來時認得出是自己的（見下方 SSE 串流）
+PET_EVENT_ORIGIN = f"backend-{os.getpid()}-{int(time.time() * 1000)}"
+
+
+def pet_event(pet: Pet, server_id: str) -> dict:
+    """要在 commit 之前呼叫（commit 後屬性會 expire，再讀會多打一次 DB）。"""
+    return {
+        "pet_id": pet.pet_id,
+        "user_id": pet.user_id,
+        "server_id": server_id,
+        "energy": pet.energy,
+        "status": pet.status,
+        "score": pet.score,
+    }
+
+
+class PetEventPublisher:
+    """
+    把寵物變動 PUB 到 broker 的 "pet:<server_id>" channel（broker 的一行協定：PUB <channel> <json>），
+    ws server 收到後更新體力快取，直接發 pet_state_update 給大廳裡看得到這隻寵物的人（不用前端輪詢）。
+    - best effort：broker 連不上就丟掉，幾秒後再試著重連，API 不會因此失敗
+    - API 是 sync def（跑在 threadpool），所以用一般 socket + lock
+    """
+
+    RETRY_SECONDS = 5.0
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.sock: Optional[socket.socket] = None
+        self.lock = threading.Lock()
+        self.retry_at = 0.0
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, events: List[dict]) -> None:
+        if not self.path or not events:
+            return
+        # sent_at：ws server 拿來算推播延遲
+        sent_at = time.time()
+        data = b"".join(
+            f"PUB pet:{e['server_id']} "
+            f"{json.dumps({**e, 'sent_at': sent_at, 'origin': PET_EVENT_ORIGIN}, separators=(',', ':'))}\n".encode()
+            for e in events
+        )
+        with self.lock:
+            if self.sock is None and not self._connect():
+                self.dropped += len(events)
+                return
+            try:
+                self.sock.sendall(data)
+                self.published += len(events)
+            except OSError as exc:
+                print(f"[PET_EVENTS] 推送失敗：{exc!r}")
+                self.sock.close()
+                self.sock = None
+                self.retry_at = time.monotonic() + self.RETRY_SECONDS
+                self.dropped += len(events)
+
+    def _connect(self) -> bool:
+        if time.monotonic() < self.retry_at:
+            return False
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(1.0)
+            sock.connect(self.path)
+        except OSError as exc:
+            print(f"[PET_EVENTS] 連不上 {self.path}：{exc!r}")
+            self.retry_at = time.monotonic() + self.RETRY_SECONDS
+            return False
+        self.sock = sock
+        return True
+
+
+pet_event_publisher = PetEventPublisher(PET_EVENTS_SOCKET)
+
+
+# ============================================================
+# 寵物狀態 SSE 串流（GET /api/pet/stream）
+# ============================================================
+
+# 同一個玩家短時間內連續變動（例如 Pi 連續回報）只送最後一筆，兩次推送至少隔這麼久
+PET_STREAM_COALESCE = float(os.getenv("PET_STREAM_COALESCE_MS", "250")) / 1000
+# 閒置時多久送一次註解行，讓 nginx / 瀏覽器不會把連線當成斷掉
+PET_STREAM_HEARTBEAT = float(os.getenv("PET_STREAM_HEARTBEAT", "15"))
+# 瀏覽器斷線後隔多久重連（SSE 的 retry 欄位，毫秒）
+PET_STREAM_RETRY_MS = int(os.getenv("PET_STREAM_RETRY_MS", "3000"))
+# 記住最近狀態的玩家數上限（Last-Event-ID 續傳用），超過就丟最久沒變動的
+PET_STREAM_LATEST_MAX = int(os.getenv("PET_STREAM_LATEST_MAX", "10000"))
+# 從 broker 收其他行程（cron 體力衰減、其他 backend worker）的寵物變動
+PET_EVENT_SERVER_IDS = [s for s in os.getenv("PET_EVENT_SERVER_IDS", "A,B,C").split(",") if s]
+
+# 推給前端的欄位（broker 上的事件還有 sent_at / origin，不用給前端）
+PET_STREAM_FIELDS = ("pet_id", "user_id", "energy", "status", "score")
+
+
+class PetStreamSubscriber:
+    """一條 SSE 連線：只留最新一筆還沒送出的狀態，閒置時只是一個等待中的 asyncio.Event。"""
+
+    __slots__ = ("pending", "wakeup")
+
+    def __init__(self) -> None:
+        self.pending: Optional[dict] = None
+        self.wakeup = asyncio.Event()
+
+
+class PetStreamHub:
+    """
+    行程內的寵物狀態 pub/sub：
+    - API（sync def，跑在 threadpool）用 publish() 丟進來，透過 call_soon_threadsafe 交給 event loop
+    - cron 的體力衰減是另一個行程，經 broker 的 "pet:<server_id>" channel 收進來（deliver()）
+    - 每個玩家記住最新一筆狀態和它的 event id，Last-Event-ID 對得上就不重送
+    event id = "<開機時間>-<序號>"：backend 重開或換到別的 worker，id 對不上，就直接送目前狀態
+    """
+
+    def __init__(self) -> None:
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.epoch = str(int(time.time()))
+        self.seq = 0
+        self.latest: "OrderedDict[int, dict]" = OrderedDict()
+        self.subscribers: Dict[int, Set[PetStreamSubscriber]] = {}
+        # 有連著 broker 時 latest 才會收到 cron / 其他 worker 的變動，這時才能直接拿來當目前狀態
+        self.listening = False
+        self.delivered = 0
+        self.coalesced = 0
+
+    def publish(self, events: List[dict]) -> None:
+        """任何 thread 都可以呼叫；還沒啟動（例如 cron 行程）就什麼都不做。"""
+        if self.loop is None or not events:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.deliver, events)
+        except RuntimeError:
+            # event loop 已經關了（正在關機）
+            pass
+
+    def deliver(self, events: List[dict]) -> None:
+        """只能在 event loop 裡呼叫。"""
+        for event in events:
+            item = self.remember({k: event[k] for k in PET_STREAM_FIELDS})
+            for sub in self.subscribers.get(item["user_id"], ()):
+                if sub.pending is not None:
+                    self.coalesced += 1
+                sub.pending = item
+                sub.wakeup.set()
+            self.delivered += 1
+
+    def current(self, user_id: int) -> Optional[dict]:
+        """沒連著 broker 時 latest 可能已經過時（cron 體力衰減收不到），一律回 None 叫呼叫端讀 DB。"""
+        return self.latest.get(user_id) if self.listening else None
+
+    def reconcile(self, state: dict, before: Optional[dict]) -> dict:
+        """
+        從 DB 讀回來的狀態（before = 開始讀之前 latest 裡的那筆）：
+        - 讀的期間已經有新事件進來 → 用新的
+        - 和記住的一樣 → 沿用原本的 event id，Last-Event-ID 續傳就不會重送
+        - 不一樣 → 當成一筆新事件，順便推給這個玩家其他開著的串流
+        """
+        user_id = state["user_id"]
+        latest = self.latest.get(user_id)
+        if latest is not None and latest is not before:
+            return latest
+        if latest is not None and all(latest[k] == state[k] for k in PET_STREAM_FIELDS):
+            return latest
+        self.deliver([state])
+        return self.latest[user_id]
+
+    def remember(self, state: dict) -> dict:
+        """記下玩家的最新狀態並編新的 event id。"""
+        user_id = state["user_id"]
+        self.seq += 1
+        item = {**state, "id": f"{self.epoch}-{self.seq}"}
+        self.latest[user_id] = item
+        self.latest.move_to_end(user_id)
+        while len(self.latest) > PET_STREAM_LATEST_MAX:
+            self.latest.popitem(last=False)
+        return item
+
+    async def stream(self, user_id: int, initial: dict, last_event_id: Optional[str]) -> AsyncIterator[str]:
+        sub = PetStreamSubscriber()
+        self.subscribers.setdefault(user_id, set()).add(sub)
+        loop = asyncio.get_running_loop()
+        try:
+            yield f"retry: {PET_STREAM_RETRY_MS}\n\n"
+            # 訂閱和讀 latest 之間沒有 await，不會漏掉中間的變動
+            current = self.latest.get(user_id, initial)
+            if current["id"] != last_event_id:
+                yield format_pet_stream_event(current)
+            last_sent = loop.time()
+
+            while True:
+                try:
+                    await asyncio.wait_for(sub.wakeup.wait(), PET_STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                # 連續變動：等滿間隔再送，期間來的都會蓋掉 pending，只送最後一筆
+                delay = last_sent + PET_STREAM_COALESCE - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                sub.wakeup.clear()
+                item, sub.pending = sub.pending, None
+                if item is None:
+                    continue
+                last_sent = loop.time()
+                yield format_pet_stream_event(item)
+        finally:
+            # 客戶端斷線時 StreamingResponse 會取消這個 generator
+            subs = self.subscribers.get(user_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self.subscribers[user_id]
+
+
+def format_pet_stream_event(item: dict) -> str:
+    data = json.dumps({k: item[k] for k in PET_STREAM_FIELDS}, separators=(",", ":"))
+    return f"id: {item['id']}\nevent: pet\ndata: {data}\n\n"
+
+
+pet_stream_hub = PetStreamHub()
+
+
+def notify_pet_changes(events: List[dict]) -> None:
+    """commit 之後呼叫：推給 ws server（broker）+ 這個行程的 SSE 串流。"""
+    pet_event_publisher.publish(events)
+    pet_stream_hub.publish(events)
+
+
+async def pet_event_listener() -> None:
+    """
+    訂閱 broker 上的 "pet:<server_id>"，把別的行程（cron 體力衰減、其他 backend worker）的變動交給 hub。
+    自己發出去的（origin 相同）已經在 notify_pet_changes 送過，略過。
+    """
+    while True:
+        writer = None
+        try:
+            reader, writer = await asyncio.open_unix_connection(PET_EVENTS_SOCKET, limit=1024 * 1024)
+            writer.write("".join(f"SUB pet:{sid}\n" for sid in PET_EVENT_SERVER_IDS).encode())
+            await writer.drain()
+            pet_stream_hub.listening = True
+            print(f"[PET_STREAM] 已訂閱 {PET_EVENTS_SOCKET} 的寵物變動")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    event = json.loads(line.split(b" ", 2)[2])
+                    if event.get("origin") == PET_EVENT_ORIGIN:
+                        continue
+                    pet_stream_hub.deliver([event])
+                except (IndexError, KeyError, TypeError, ValueError) as exc:
+                    print(f"[PET_STREAM] 看不懂的事件：{exc!r}")
+        except OSError as exc:
+            print(f"[PET_STREAM] 連不上 {PET_EVENTS_SOCKET}：{exc!r}")
+        finally:
+            # 斷線期間漏掉的變動不會補，latest 先不能信，連上串流一律讀 DB
+            pet_stream_hub.listening = False
+            if writer is not None:
+                writer.close()
+        await asyncio.sleep(PetEventPublisher.RETRY_SECONDS)
+
+
+pet_event_listener_task: Optional[asyncio.Task] = None
+
+
+def log_listener_exit(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[PET_STREAM][ERROR] broker 訂閱意外結束：{task.exception()!r}")
+
+
 # ============================================================
 # Pydantic 模型：API request / response
 # ============================================================
@@ -238,6 +537,10 @@ class PetStatus(BaseModel):
     score: int
 
 
+class PetStatesRequest(BaseModel):
+    user_ids: List[int]
+
+
 class PetUpdateRequest(BaseModel):
     user_id: int
     pet_id: int
@@ -262,6 +565,14 @@ class BattleResultRequest(BaseModel):
     player1_score: int
     player2_score: int
     server_id: str  # "A" / "B" / "C"
+    # 有帶的話：同一個 battle_key 只會寫一次，重送直接回傳原本那筆
+    battle_key: Optional[str] = None
+    # 有帶的話以 WebSocket 判的為準（例如對手斷線判輸，勝方分數不一定比較高）
+    winner_user_id: Optional[int] = None
+
+
+class BattleResultBatchRequest(BaseModel):
+    results: List[BattleResultRequest]
 
 
 class BattleHistoryItem(BaseModel):
@@ -276,6 +587,18 @@ class BattleHistoryItem(BaseModel):
     created_at: datetime
 
 
+class ChatMessageIngestItem(BaseModel):
+    from_user_id: int
+    to_user_id: Optional[int] = None
+    server_id: str
+    content: str
+    created_at: datetime  # WebSocket 收到訊息的時間（unix 秒數或 ISO 字串都可以）
+
+
+class ChatMessageBatchRequest(BaseModel):
+    messages: List[ChatMessageIngestItem]
+
+
 class ChatMessageItem(BaseModel):
     message_id: int
     from_user_id: int
@@ -448,6 +771,107 @@ def get_pet_status(user_id: int, db: Session = Depends(get_db)):
     return APIResponse(success=True, data=pet_status, error=None)
 
 
+@app.post("/api/pet/states", response_model=APIResponse)
+def get_pet_states(request: PetStatesRequest, db: Session = Depends(get_db)):
+    """
+    給 ws server 的體力快取一次載入多位玩家（大廳裡的人），一次查詢。
+    - 回傳 [{pet_id, user_id, server_id, energy, status, score}, ...]，沒有寵物的玩家不會出現
+    - 一次最多 1000 人
+    """
+    if len(request.user_ids) > 1000:
+        return APIResponse(
+            success=False,
+            data=None,
+            error=ErrorInfo(code="TOO_MANY_USERS", message="At most 1000 user_ids per request."),
+        )
+
+    rows = (
+        db.query(Pet, User.server_id)
+        .join(User, Pet.user_id == User.user_id)
+        .filter(User.user_id.in_(request.user_ids))
+        .all()
+    ) if request.user_ids else []
+
+    data = [pet_event(pet, server_id) for pet, server_id in rows]
+    return APIResponse(success=True, data=data, error=None)
+
+
+# ============================================================
+# API: 寵物狀態 SSE 串流
+# ============================================================
+
+def load_pet_event(user_id: int) -> Optional[dict]:
+    db = SessionLocal()
+    try:
+        row = (
+            db.query(Pet, User.server_id)
+            .join(User, Pet.user_id == User.user_id)
+            .filter(User.user_id == user_id)
+            .first()
+        )
+        return pet_event(*row) if row else None
+    finally:
+        db.close()
+
+
+@app.on_event("startup")
+async def start_pet_stream() -> None:
+    global pet_event_listener_task
+    pet_stream_hub.loop = asyncio.get_running_loop()
+    if PET_EVENTS_SOCKET:
+        pet_event_listener_task = asyncio.create_task(pet_event_listener())
+        pet_event_listener_task.add_done_callback(log_listener_exit)
+
+
+@app.on_event("shutdown")
+async def stop_pet_stream() -> None:
+    global pet_event_listener_task
+    pet_stream_hub.loop = None
+    if pet_event_listener_task is not None:
+        pet_event_listener_task.cancel()
+        try:
+            await pet_event_listener_task
+        except asyncio.CancelledError:
+            pass
+        pet_event_listener_task = None
+
+
+@app.get("/api/pet/stream")
+async def pet_stream(user_id: int, last_event_id: Optional[str] = Header(None)):
+    """
+    自己寵物狀態的 Server-Sent Events（前端用 EventSource，不用再輪詢 /api/pet/status）：
+    - event: pet，data = {pet_id, user_id, energy, status, score}
+    - 連上時先送一次目前狀態；斷線重連帶 Last-Event-ID，狀態沒變就不重送
+    - Pi 回報、對戰結算、體力衰減（經 broker）都會推；短時間連續變動只送最後一筆
+    - 沒設定 PET_EVENTS_SOCKET（或 broker 斷線）時收不到體力衰減，連上時一律從 DB 讀目前狀態
+    - 沒有寵物回真的 404：EventSource 收到非 200 就不再重連（200 + JSON 會被當成斷線一直重連）
+    """
+    initial = pet_stream_hub.current(user_id)
+    if initial is None:
+        before = pet_stream_hub.latest.get(user_id)
+        state = await run_in_threadpool(load_pet_event, user_id)
+        if state is None:
+            return JSONResponse(
+                status_code=404,
+                content=jsonable_encoder(APIResponse(
+                    success=False,
+                    data=None,
+                    error=ErrorInfo(
+                        code="PET_NOT_FOUND",
+                        message="Pet not found for this user.",
+                    ),
+                )),
+            )
+        initial = pet_stream_hub.reconcile({k: state[k] for k in PET_STREAM_FIELDS}, before)
+
+    return StreamingResponse(
+        pet_stream_hub.stream(user_id, initial, last_event_id),
+        media_type="text/event-stream",
+        # X-Accel-Buffering：叫 nginx 不要把串流緩衝起來
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ============================================================
 # API: 更新寵物體力（Pi 回報）
 # ============================================================
@@ -508,8 +932,10 @@ def update_pet_energy(request: PetUpdateRequest, db: Session = Depends(get_db)):
     )
     db.add(log)
 
+    event = pet_event(pet, user.server_id)
     db.commit()
     db.refresh(pet)
+    notify_pet_changes([event])
 
     updated_data = {
         "pet_id": pet.pet_id,
@@ -562,14 +988,22 @@ def get_leaderboard(
 # API: 對戰結果上報
 # ============================================================
 
-@app.post("/api/battle/result", response_model=APIResponse)
-def report_battle_result(request: BattleResultRequest, db: Session = Depends(get_db)):
+def record_battle_result(db: Session, request: BattleResultRequest, events: List[dict]) -> APIResponse:
     """
-    一場對戰結束後，WebSocket 組可呼叫：
-    - 會寫一筆 battles 紀錄
-    - winner_user_id 自動判斷
-    - 也可以在這裡順便加成績邏輯（例如勝者加 score）
+    寫一筆 battles 紀錄 + 勝者加分，只 flush 不 commit（由呼叫的 API 決定什麼時候 commit）。
+    勝者寵物的變動放進 events，commit 之後再推播。
     """
+    if request.battle_key:
+        existing = db.query(Battle).filter(Battle.battle_key == request.battle_key).first()
+        if existing:
+            data = {
+                "battle_id": existing.battle_id,
+                "winner_user_id": existing.winner_user_id,
+                "battle_key": existing.battle_key,
+                "duplicate": True,
+            }
+            return APIResponse(success=True, data=data, error=None)
+
     # 找兩位玩家確認存在
     p1 = db.query(User).filter(
         User.user_id == request.player1_id,
@@ -592,7 +1026,9 @@ def report_battle_result(request: BattleResultRequest, db: Session = Depends(get
 
     # 判斷勝負
     winner_user_id: Optional[int] = None
-    if request.player1_score > request.player2_score:
+    if request.winner_user_id in (request.player1_id, request.player2_id):
+        winner_user_id = request.winner_user_id
+    elif request.player1_score > request.player2_score:
         winner_user_id = request.player1_id
     elif request.player2_score > request.player1_score:
         winner_user_id = request.player2_id
@@ -607,6 +1043,7 @@ def report_battle_result(request: BattleResultRequest, db: Session = Depends(get
         winner_user_id=winner_user_id,
         server_id=request.server_id,
         battle_status="FINISHED",
+        battle_key=request.battle_key,
     )
     db.add(battle)
 
@@ -619,18 +1056,50 @@ def report_battle_result(request: BattleResultRequest, db: Session = Depends(get
             .first()
         )
         if winner_pet:
-            winner_pet.score += 5
+            winner_pet.score += BATTLE_WIN_SCORE
+            events.append(pet_event(winner_pet, request.server_id))
 
-    db.commit()
-    db.refresh(battle)
+    db.flush()
 
     data = {
         "battle_id": battle.battle_id,
         "winner_user_id": winner_user_id,
+        "battle_key": battle.battle_key,
+        "duplicate": False,
     }
     return APIResponse(success=True, data=data, error=None)
 
 
+@app.post("/api/battle/result", response_model=APIResponse)
+def report_battle_result(request: BattleResultRequest, db: Session = Depends(get_db)):
+    """
+    一場對戰結束後，WebSocket 組可呼叫：
+    - 會寫一筆 battles 紀錄
+    - winner_user_id 沒帶就依分數自動判斷
+    - 勝者加 score
+    - 帶 battle_key 的話重送不會重複寫入
+    """
+    events: List[dict] = []
+    result = record_battle_result(db, request, events)
+    db.commit()
+    notify_pet_changes(events)
+    return result
+
+
+@app.post("/api/battle/results", response_model=APIResponse)
+def report_battle_results(request: BattleResultBatchRequest, db: Session = Depends(get_db)):
+    """
+    WebSocket 端積壓了多筆結果時一次送上來，整批一個 transaction。
+    每一筆的結果依序放在 data.results（格式和單筆 API 的回應一樣），
+    某一筆找不到玩家只會讓那一筆失敗，其他照寫。
+    """
+    events: List[dict] = []
+    results = [record_battle_result(db, item, events) for item in request.results]
+    db.commit()
+    notify_pet_changes(events)
+    return APIResponse(success=True, data={"results": results}, error=None)
+
+
 # ============================================================
 # API: 對戰歷史查詢
 # ============================================================
@@ -687,7 +1156,7 @@ def get_chat_history(
     """
     聊天歷史：
     - 目前只支援依 server_id 查最新的幾筆訊息
-    - 未實作寫入，預期由 WebSocket 邏輯在訊息送出時 insert messages
+    - 由 WebSocket 端批次呼叫 POST /api/chat/messages 寫入
     """
     msgs = (
         db.query(Message)
@@ -713,6 +1182,38 @@ def get_chat_history(
     return APIResponse(success=True, data=items, error=None)
 
 
+@app.post("/api/chat/messages", response_model=APIResponse)
+def ingest_chat_messages(request: ChatMessageBatchRequest, db: Session = Depends(get_db)):
+    """
+    WebSocket 端每湊一批（或每隔一小段時間）送上來，這裡一次 multi-row INSERT。
+    - 找不到的 user_id（帳號被刪）那幾筆略過，不讓整批失敗一直被重送
+    """
+    user_ids = {m.from_user_id for m in request.messages}
+    user_ids |= {m.to_user_id for m in request.messages if m.to_user_id is not None}
+    existing = {
+        row.user_id
+        for row in db.query(User.user_id).filter(User.user_id.in_(user_ids)).all()
+    } if user_ids else set()
+
+    rows = [
+        {
+            "from_user_id": m.from_user_id,
+            "to_user_id": m.to_user_id,
+            "server_id": m.server_id,
+            "content": m.content,
+            "created_at": m.created_at,
+        }
+        for m in request.messages
+        if m.from_user_id in existing and (m.to_user_id is None or m.to_user_id in existing)
+    ]
+    if rows:
+        db.execute(insert(Message), rows)
+        db.commit()
+
+    data = {"inserted": len(rows), "skipped": len(request.messages) - len(rows)}
+    return APIResponse(success=True, data=data, error=None)
+
+
 # ============================================================
 # （備註）啟動方式：
 # ------------------------------------------------------------
@@ -61,8 +61,11 @@ CREATE TABLE IF NOT EXISTS battles (
     winner_user_id INTEGER     REFERENCES users(user_id),
     server_id      CHAR(1) NOT NULL,
     battle_status  VARCHAR(16) NOT NULL DEFAULT 'FINISHED', -- PENDING / ONGOING / FINISHED
+    battle_key     VARCHAR(64) UNIQUE,                      -- WebSocket 端的對戰代號，重送時去重
     created_at     TIMESTAMPTZ DEFAULT NOW()
 );
+-- 舊資料庫補欄位
+ALTER TABLE battles ADD COLUMN IF NOT EXISTS battle_key VARCHAR(64) UNIQUE;
 
 CREATE INDEX IF NOT EXISTS idx_battles_server_id ON battles (server_id);
 CREATE INDEX IF NOT EXISTS idx_battles_players   ON battles (player1_id, player2_id);
@@ -21,7 +21,7 @@ if BASE_DIR not in sys.path:
 # ================================
 # 2. 從 app.main 匯入需要的東西
 # ================================
-from app.main import SessionLocal, Pet, energy_to_status
+from app.main import SessionLocal, Pet, User, energy_to_status, pet_event, pet_event_publisher
 
 
 """
@@ -29,16 +29,18 @@ from app.main import SessionLocal, Pet, energy_to_status
 - 所有寵物 energy -= 5（不能 < 0）
 - 若這次「剛好變成 0」（原本 > 0，現在 = 0）→ score -= 1
 - 更新 status = SLEEPING / TIRED / ACTIVE
+- 有變的寵物推給 ws server 的體力快取（要設定 PET_EVENTS_SOCKET）
 """
 
 
 def run_energy_decay():
     db = SessionLocal()
     try:
-        pets = db.query(Pet).all()
-        print(f"[CRON] 找到 {len(pets)} 隻寵物，開始更新體力 ...")
+        rows = db.query(Pet, User.server_id).join(User, Pet.user_id == User.user_id).all()
+        print(f"[CRON] 找到 {len(rows)} 隻寵物，開始更新體力 ...")
 
-        for pet in pets:
+        events = []
+        for pet, server_id in rows:
             old_energy = pet.energy
             new_energy = max(0, old_energy - 5)
 
@@ -56,8 +58,10 @@ def run_energy_decay():
                     print(
                         f"[CRON] pet_id={pet.pet_id} {old_energy}->{new_energy}, score={pet.score}"
                     )
+                events.append(pet_event(pet, server_id))
 
         db.commit()
+        pet_event_publisher.publish(events)
         print("[CRON] 體力更新完成，已寫入資料庫。")
 
     except Exception as exc:
@@ -6,6 +6,9 @@
 // 統一的基礎 URL，用於處理 Nginx 反向代理
 const BASE_URL = window.location.origin;
 
+// 寵物 SSE 連續這麼多次都沒連上（中間沒有成功 open 過）就不再重連
+const PET_STREAM_MAX_FAILED_OPENS = 5;
+
 /**
  * 統一處理所有 REST API 請求
  * @param {string} endpoint - 應用程式內部的 API 路徑 (例如: /api/login)
@@ -95,6 +98,33 @@ export async function getPetStatus(userId = null) {
     return callApi(endpoint, 'GET');
 }
 
+// 訂閱自己寵物狀態的變動（SSE：/api/pet/stream），不用輪詢 /api/pet/status
+// onUpdate 收到 {pet_id, user_id, energy, status, score}；斷線瀏覽器會自己帶 Last-Event-ID 重連
+// 回傳 EventSource（不用時 .close()），沒選伺服器 / 沒登入回傳 null
+export function openPetStream(onUpdate, userId = null) {
+    const server_id = localStorage.getItem('selected_server_id');
+    const uid = userId ?? localStorage.getItem('user_id');
+    if (!server_id || !uid) {
+        return null;
+    }
+
+    const url = `${BASE_URL}/server${server_id}/api/pet/stream?user_id=${encodeURIComponent(uid)}`;
+    const source = new EventSource(url);
+    source.addEventListener('pet', (event) => onUpdate(JSON.parse(event.data)));
+    // 一般斷線瀏覽器會自己重連（readyState 回到 CONNECTING）；
+    // 後端回 404（沒有寵物）這類錯誤時 readyState 是 CLOSED，不會再連，直接收掉；
+    // 連續好幾次都連不上（例如中間的 proxy 回了不是串流的東西）也當作放棄，不無限重連
+    let failedOpens = 0;
+    source.addEventListener('open', () => { failedOpens = 0; });
+    source.addEventListener('error', () => {
+        failedOpens += 1;
+        if (source.readyState === EventSource.CLOSED || failedOpens >= PET_STREAM_MAX_FAILED_OPENS) {
+            source.close();
+        }
+    });
+    return source;
+}
+
 // === SOLO 模式：將新的體力值寫回後端 ===
 export async function updatePetSpirit(newSpirit) {
     const userId = localStorage.getItem('user_id');
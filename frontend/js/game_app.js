@@ -1,6 +1,6 @@
 // frontend/js/game_app.js (PK 對戰 + Solo + 鏡頭/鍵盤模式 最終修正版)
 
-import { getPetStatus, updatePetSpirit } from './api_client.js';
+import { getPetStatus, updatePetSpirit, openPetStream } from './api_client.js';
 import { sendMessage, registerCallback, initWebSocket } from './websocket_client.js'; // ⭐ 多帶 initWebSocket
 //import { handleKeyboardInput, startDinoGame, stopDinoGame } from './dino_game.js';
 
@@ -727,6 +727,21 @@ function initGameSetup() {
         gamePetImgEl.src = statusImg;
     }
 
+    // ⭐ 還沒開始玩之前，自己寵物的體力由後端 SSE 推播更新（Pi 運動、體力衰減、對戰結算）
+    //    開始玩之後就以本地數值為準，結算時再寫回
+    openPetStream((pet) => {
+        if (gameRunning || elapsedTime > 0) return;
+        mySpirit = pet.energy;
+        initialSpirit = mySpirit;
+        localStorage.setItem('my_spirit_value', mySpirit);
+        if (playerStatusEl) {
+            playerStatusEl.textContent = `精神狀態: ${Math.floor(mySpirit)}/100`;
+        }
+        if (gamePetImgEl) {
+            gamePetImgEl.src = getSpiritInfo(mySpirit).statusImg;
+        }
+    });
+
     if (petStatusScreenEl) {
         petStatusScreenEl.classList.remove('pixel-border-box');
         petStatusScreenEl.style.backgroundColor = 'transparent';
@@ -799,6 +814,15 @@ function initGameSetup() {
         });
 
 
+        // ⭐ 房間逾時被伺服器回收 → 直接結束本地遊戲
+        registerCallback('battle_expired', (data) => {
+            const payload = data?.payload || {};
+            console.warn('[Game] 對戰房間已被伺服器回收:', payload.reason);
+            if (window.game_state && window.game_state.forceEnd) {
+                window.game_state.forceEnd();
+            }
+        });
+
         if (gamePetMessageEl) {
             gamePetMessageEl.textContent = '請在 5 秒內選擇遊玩模式，未選擇將預設為鍵盤模式。';
         }
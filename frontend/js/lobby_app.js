@@ -49,6 +49,7 @@ let currentMyUserId = null;
 
 // [修正] 儲存所有玩家資料以供排行榜使用
 let allPlayers = {}; 
+let pushedLeaderboard = null; // 全域頻道推來的排行榜（leaderboard_update）
 
 const PET_SPRITES = {
     idle: './assets/pet-lobby.png',
@@ -457,10 +458,12 @@ function updateLeaderboard() {
     if (!leaderboardListEl) return;
     leaderboardListEl.innerHTML = '';
     
-    // 轉成 Array 並排序，依據 score 降序
-    const sortedPlayers = Object.values(allPlayers)
-        .sort((a, b) => (b.score || 0) - (a.score || 0))
-        .slice(0, 5); // 取前5名
+    // 有伺服器推來的全域排行榜就用它（跨 A/B/C），不然用這個大廳的玩家自己排
+    const sortedPlayers = pushedLeaderboard
+        ? pushedLeaderboard.slice(0, 5)
+        : Object.values(allPlayers)
+            .sort((a, b) => (b.score || 0) - (a.score || 0))
+            .slice(0, 5); // 取前5名
 
     if (sortedPlayers.length === 0) {
         leaderboardListEl.innerHTML = '<li>尚無資料</li>';
@@ -608,6 +611,20 @@ function handlePlayerLeft(msg) {
     }
 }
 
+// 玩家離開視野（還在線上，只是走遠了）：只收掉畫面上的寵物，排行榜資料保留
+function handlePlayerLeftView(msg) {
+    const uid = Number(msg.user_id);
+    if (uid === currentMyUserId) return;
+
+    if (otherPets[uid]) {
+        otherPets[uid].el.remove();
+        delete otherPets[uid];
+    }
+    if (targetUserId === uid) {
+        petInfoCard.style.display = 'none';
+    }
+}
+
 function handlePetStateUpdate(msg) {
     const player = msg.payload.player;
     const uid = Number(player.user_id);
@@ -718,12 +735,31 @@ function handleBattleInvite(msg) {
 function handleBattleNotAllowed(msg) {
     clearInterval(window.currentBattleTimer);
     closeGlobalModal();
+    setBattleQueued(false);
     showCustomAlert('對戰失敗', msg.payload.message);
 }
 
+// ⭐ 隨機配對：伺服器依積分幫忙找對手，配到會直接收到 battle_start
+let battleQueued = false;
+
+function setBattleQueued(queued) {
+    battleQueued = queued;
+    const btn = document.getElementById('battle-queue-btn');
+    if (btn) btn.textContent = queued ? '配對中…（取消）' : '隨機配對';
+}
+
+function handleBattleQueueLeft(msg) {
+    setBattleQueued(false);
+    // 自己按取消就不用再跳提示
+    if (msg.payload.reason !== 'CANCELLED') {
+        showCustomAlert('配對取消', msg.payload.message);
+    }
+}
+
 function handleBattleStart(msg) {
     clearInterval(window.currentBattleTimer);
     closeGlobalModal();
+    setBattleQueued(false);
 
     const { battle_id, player1_id, player2_id } = msg.payload;
     const opponentId = player1_id === currentMyUserId ? player2_id : player1_id;
@@ -742,6 +778,13 @@ function handleBattleStart(msg) {
     );
 }
 
+function handleBattleExpired(msg) {
+    // 對戰房間卡太久被伺服器回收
+    clearInterval(window.currentBattleTimer);
+    closeGlobalModal();
+    showCustomAlert('對戰取消', msg.payload.message);
+}
+
 function handleBattleGo(msg) {
     const { battle_id, player1_id, player2_id } = msg.payload;
     const opponentId = player1_id === currentMyUserId ? player2_id : player1_id;
@@ -885,6 +928,10 @@ async function initializeLobby() {
         );
     });
 
+    document.getElementById('battle-queue-btn').addEventListener('click', () => {
+        sendMessage(battleQueued ? 'battle_queue_leave' : 'battle_queue_join', {});
+    });
+
     lobbyAreaEl.addEventListener('click', handlePetClick);
     closeChatBtn.onclick = closeChatBox;
 
@@ -896,6 +943,8 @@ async function initializeLobby() {
     registerCallback('lobby_state', handleLobbyState);
     registerCallback('player_joined', handlePlayerJoined);
     registerCallback('player_left', handlePlayerLeft);
+    registerCallback('player_entered_view', handlePlayerJoined);
+    registerCallback('player_left_view', handlePlayerLeftView);
     registerCallback('pet_state_update', handlePetStateUpdate);
     registerCallback('other_pet_moved', handleOtherPetMoved);
     registerCallback('chat_request', handleChatRequest);
@@ -905,8 +954,23 @@ async function initializeLobby() {
     registerCallback('battle_invite', handleBattleInvite);
     registerCallback('battle_not_allowed', handleBattleNotAllowed);
     registerCallback('battle_start', handleBattleStart);
+    registerCallback('battle_queue_joined', () => setBattleQueued(true));
+    registerCallback('battle_queue_left', handleBattleQueueLeft);
     registerCallback('battle_go', handleBattleGo); 
     registerCallback('battle_result', handleBattleResult);
+    registerCallback('battle_expired', handleBattleExpired);
+    // 全域頻道：所有伺服器一起收到的公告 / 排行榜
+    registerCallback('announcement', (msg) => {
+        const p = msg.payload || {};
+        showCustomAlert(p.title || '📢 公告', p.message || '');
+    });
+    registerCallback('leaderboard_update', (msg) => {
+        pushedLeaderboard = (msg.payload && msg.payload.leaderboard) || null;
+        updateLeaderboard();
+    });
+    registerCallback('session_replaced', () => {
+        showCustomAlert('⚠️ 重複登入', '這個帳號已在其他分頁登入，這裡的連線已中斷。');
+    });
     
 
     // [修正] 將包含 score 的完整 petData 傳給 init
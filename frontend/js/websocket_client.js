@@ -4,6 +4,28 @@ const callbacks = {};
 let ws = null;
 let isConnected = false;
 
+// 二進位協定：join_lobby 時提出，伺服器在 lobby_state.payload.protocol 回覆 "binary" 才啟用
+// 格式和 ws server 的 struct 定義一致（little-endian）
+const BIN_OP_UPDATE_POSITION = 0x01; // client → server：op(u8), x(f32), y(f32)
+const BIN_OP_PET_MOVED = 0x02;       // server → client：op(u8), user_id(u32), x(f32), y(f32)
+const BIN_OP_BATTLE_UPDATE = 0x03;   // client → server：op(u8), state(u8), score(i32)
+                                     // server → client：op(u8), state(u8), user_id(u32), score(i32)
+const BATTLE_STATE_CODES = { waiting: 0, running: 1 };
+const BATTLE_STATE_NAMES = ['waiting', 'running'];
+const WS_CLOSE_REPLACED = 4001;       // 同一個帳號在別處登入，伺服器關掉這條舊連線
+const BIN_OP_COMPRESSED = 0x10;      // server → client：op(u8) + zlib 壓縮的 JSON 文字
+let useBinary = false;
+// 瀏覽器有 DecompressionStream 才跟伺服器要壓縮版的大訊息（大廳快照等）
+const SUPPORTS_DEFLATE = typeof DecompressionStream !== 'undefined';
+// 解壓是非同步的，用 promise 串起來確保 callback 還是照收到的順序執行
+let inbound = Promise.resolve();
+
+// 大廳快取：視野內的玩家 + 最後看到的版本號 + session token，存在 sessionStorage
+// lobby.html ↔ game.html 換頁重連時帶上版本，伺服器只補中間漏掉的變動
+const LOBBY_CACHE_KEY = 'lobby_cache';
+let lobbyCache = null; // { server_id, user_id, epoch, version, session_token, players: { [uid]: player } }
+window.addEventListener('pagehide', saveLobbyCache);
+
 /**
  * 初始化 Web Socket 連線
  * @param {string} token 使用者 JWT Token
@@ -28,7 +50,10 @@ export function initWebSocket(token, userId, initialData = {}) {
 
     console.log(`[WS] 正在連線至: ${wsUrl}`);
 
+    lobbyCache = loadLobbyCache(serverId, parseInt(userId));
+
     ws = new WebSocket(wsUrl);
+    ws.binaryType = 'arraybuffer';
 
     // --- 連線開啟 ---
     ws.onopen = () => {
@@ -56,18 +81,25 @@ export function initWebSocket(token, userId, initialData = {}) {
                     `Player${userId}`,
                 pet_id: initialData.pet_id || 1,
                 pet_name: initialData.pet_name || "MyPet",
+                // 沒給就不帶（undefined 不會被序列化）：續連時沿用伺服器上的值，新玩家由伺服器補預設
                 energy:
                     typeof initialData.energy === "number"
                         ? initialData.energy
-                        : 100,
+                        : undefined,
                 status: initialData.status || "ACTIVE",
                 score:
                     typeof initialData.score === "number"
                         ? initialData.score
-                        : 0,
+                        : undefined,
                 // ❌ 不再自己決定 x, y
                 // x: 100,
                 // y: 100,
+                protocol: 'binary',
+                compression: SUPPORTS_DEFLATE ? 'deflate' : 'off',
+                since_version: lobbyCache ? lobbyCache.version : -1,
+                epoch: lobbyCache ? lobbyCache.epoch : '',
+                // grace 期內帶回上次的 session token，伺服器就直接接回原本的 session（含對戰房間）
+                resume_token: lobbyCache ? lobbyCache.session_token : '',
             },
         };
 
@@ -77,22 +109,50 @@ export function initWebSocket(token, userId, initialData = {}) {
 
     // --- 收到訊息 ---
     ws.onmessage = (event) => {
+        inbound = inbound.then(() => handleIncoming(event.data));
+    };
+
+    async function handleIncoming(raw) {
         try {
-            const data = JSON.parse(event.data);
+            let data;
+            if (raw instanceof ArrayBuffer) {
+                data = new Uint8Array(raw)[0] === BIN_OP_COMPRESSED
+                    ? JSON.parse(await inflateFrame(raw))
+                    : decodeBinaryFrame(raw);
+            } else {
+                data = JSON.parse(raw);
+            }
             // console.log("[WS] 收到訊息:", data);
+            if (!data) return;
+            if (data.type === 'ping') {
+                // 心跳：伺服器一段時間沒收到任何訊息就會送 ping，沒回會被當成斷線
+                sendRaw({ type: 'pong', user_id: parseInt(userId), payload: { ts: data.payload?.ts } });
+                return;
+            }
+            data = applyToLobbyCache(data);
+
+            if (data.type === 'lobby_state') {
+                // 伺服器不支援時會回 "json"（或根本沒有這個欄位），就維持 JSON
+                useBinary = data.payload?.protocol === 'binary';
+            }
 
             if (data.type && callbacks[data.type]) {
                 callbacks[data.type](data);
             }
         } catch (e) {
-            console.error("[WS] 解析訊息失敗:", event.data, e);
+            console.error("[WS] 解析訊息失敗:", raw, e);
         }
-    };
+    }
 
     // --- 連線關閉 ---
     ws.onclose = (event) => {
         console.warn("[WS] 連線已斷開", event);
+        if (event.code === WS_CLOSE_REPLACED && callbacks.session_replaced) {
+            callbacks.session_replaced({ type: 'session_replaced', payload: { reason: event.reason } });
+        }
         isConnected = false;
+        useBinary = false;
+        saveLobbyCache();
         ws = null;
     };
 
@@ -118,6 +178,14 @@ export function sendMessage(type, payload) {
         return;
     }
 
+    if (useBinary) {
+        const frame = encodeBinaryFrame(type, payload);
+        if (frame) {
+            ws.send(frame);
+            return;
+        }
+    }
+
     const serverId = localStorage.getItem('selected_server_id') || 'A';
     const userId = localStorage.getItem('user_id');
 
@@ -140,3 +208,154 @@ function sendRaw(obj) {
     }
 }
 
+/**
+ * 高頻訊息轉成二進位 frame；不支援的 type 回傳 null，改走 JSON
+ */
+function encodeBinaryFrame(type, payload) {
+    if (type === 'update_position') {
+        const view = new DataView(new ArrayBuffer(9));
+        view.setUint8(0, BIN_OP_UPDATE_POSITION);
+        view.setFloat32(1, payload.x, true);
+        view.setFloat32(5, payload.y, true);
+        return view.buffer;
+    }
+    if (type === 'battle_update' && payload.state in BATTLE_STATE_CODES) {
+        const view = new DataView(new ArrayBuffer(6));
+        view.setUint8(0, BIN_OP_BATTLE_UPDATE);
+        view.setUint8(1, BATTLE_STATE_CODES[payload.state]);
+        view.setInt32(2, payload.score | 0, true);
+        return view.buffer;
+    }
+    return null;
+}
+
+function loadLobbyCache(serverId, userId) {
+    try {
+        const cached = JSON.parse(sessionStorage.getItem(LOBBY_CACHE_KEY) || 'null');
+        if (cached && cached.server_id === serverId && cached.user_id === userId) {
+            return cached;
+        }
+    } catch (e) {
+        console.warn('[WS] 大廳快取格式錯誤，改拿完整快照', e);
+    }
+    return null;
+}
+
+function saveLobbyCache() {
+    if (lobbyCache) {
+        sessionStorage.setItem(LOBBY_CACHE_KEY, JSON.stringify(lobbyCache));
+    }
+}
+
+/**
+ * 收到的大廳變動同步進快取；增量的 lobby_state 會合併成完整快照再交給 callback，
+ * lobby_app 不需要知道有增量這回事
+ */
+function applyToLobbyCache(data) {
+    const payload = data.payload || {};
+
+    if (data.type === 'lobby_state') {
+        const players = (payload.incremental && lobbyCache) ? lobbyCache.players : {};
+        (payload.removed || []).forEach((uid) => { delete players[uid]; });
+        (payload.players || []).forEach((p) => { players[p.user_id] = p; });
+        lobbyCache = {
+            server_id: String(data.server_id),
+            user_id: data.user_id,
+            epoch: payload.epoch || '',
+            version: typeof payload.version === 'number' ? payload.version : -1,
+            session_token: payload.session_token || '',
+            players,
+        };
+        if (payload.incremental) {
+            return { ...data, payload: { ...payload, players: Object.values(players) } };
+        }
+        return data;
+    }
+
+    if (!lobbyCache) return data;
+    if (typeof payload.version === 'number' && payload.version > lobbyCache.version) {
+        lobbyCache.version = payload.version;
+    }
+
+    const player = payload.player;
+    switch (data.type) {
+        case 'player_joined':
+        case 'player_entered_view':
+            lobbyCache.players[player.user_id] = player;
+            break;
+        case 'pet_state_update':
+            lobbyCache.players[player.user_id] = { ...lobbyCache.players[player.user_id], ...player };
+            break;
+        case 'other_pet_moved': {
+            const cached = lobbyCache.players[player.user_id];
+            if (cached) {
+                cached.x = player.x;
+                cached.y = player.y;
+            }
+            break;
+        }
+        case 'player_left':
+        case 'player_left_view':
+            delete lobbyCache.players[data.user_id];
+            break;
+        default:
+            break;
+    }
+    return data;
+}
+
+/**
+ * 解開伺服器壓縮過的訊息（第一個 byte 是 op，後面是 zlib 格式）
+ */
+async function inflateFrame(buffer) {
+    const stream = new Blob([buffer.slice(1)])
+        .stream()
+        .pipeThrough(new DecompressionStream('deflate'));
+    return new Response(stream).text();
+}
+
+/**
+ * 伺服器送來的二進位 frame 還原成和 JSON 一樣的訊息格式，callback 不用分兩套
+ */
+function decodeBinaryFrame(buffer) {
+    const view = new DataView(buffer);
+    const op = view.getUint8(0);
+    const serverId = localStorage.getItem('selected_server_id');
+
+    if (op === BIN_OP_PET_MOVED) {
+        const uid = view.getUint32(1, true);
+        return {
+            type: 'other_pet_moved',
+            server_id: serverId,
+            user_id: uid,
+            payload: {
+                player: {
+                    user_id: uid,
+                    x: view.getFloat32(5, true),
+                    y: view.getFloat32(9, true),
+                },
+            },
+        };
+    }
+
+    if (op === BIN_OP_BATTLE_UPDATE) {
+        const state = BATTLE_STATE_NAMES[view.getUint8(1)] || 'running';
+        const uid = view.getUint32(2, true);
+        const score = view.getInt32(6, true);
+        return {
+            type: 'battle_update',
+            server_id: serverId,
+            user_id: uid,
+            payload: {
+                battle_id: localStorage.getItem('current_battle_id'),
+                user_id: uid,
+                score: score,
+                scores: { [uid]: score },
+                state: state,
+            },
+        };
+    }
+
+    console.warn('[WS] 未知的二進位訊息 op=', op);
+    return null;
+}
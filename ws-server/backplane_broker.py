@@ -0,0 +1,96 @@
+# ws-server/backplane_broker.py
+
+"""
+ws server 的本機 backplane broker：讓同一個邏輯伺服器（例如 wsA）可以開多個 uvicorn worker。
+
+用法：
+    python ws-server/backplane_broker.py /tmp/wsA-backplane.sock
+    WS_BACKPLANE=unix:/tmp/wsA-backplane.sock uvicorn wsA_main:app --workers 4
+
+協定（一行一則，UTF-8）：
+    SUB <channel>          訂閱 channel
+    PUB <channel> <json>   發佈；broker 不解 JSON，原封不動轉給其他訂閱這個 channel 的連線（不回送給自己）
+
+broker 不存任何狀態；worker 重連上來會自己重新公告身上的玩家。
+"""
+
+import asyncio
+import os
+import sys
+from typing import Dict, Set
+
+# 某個 worker 收太慢、積在 broker 的資料超過這個大小就把它斷掉，不拖累其他 worker
+MAX_BUFFER = int(os.getenv("WS_BACKPLANE_MAX_BUFFER", str(16 * 1024 * 1024)))
+MAX_LINE = 1024 * 1024
+
+
+def log(prefix: str, message: str) -> None:
+    print(f"[backplane][{prefix}] {message}", flush=True)
+
+
+class Broker:
+    def __init__(self) -> None:
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+        self.forwarded = 0
+
+    def unsubscribe_all(self, writer: asyncio.StreamWriter) -> None:
+        for channel in list(self.subscribers):
+            self.subscribers[channel].discard(writer)
+            if not self.subscribers[channel]:
+                del self.subscribers[channel]
+
+    def forward(self, sender: asyncio.StreamWriter, channel: str, line: bytes) -> None:
+        for writer in list(self.subscribers.get(channel, ())):
+            if writer is sender:
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_BUFFER:
+                log("SLOW_SUBSCRIBER", f"{writer.get_extra_info('peername')!r} 收太慢，斷開")
+                self.unsubscribe_all(writer)
+                writer.close()
+                continue
+            writer.write(line)
+            self.forwarded += 1
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        log("CONNECT", f"worker 連上，目前 channel 數={len(self.subscribers)}")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.startswith(b"PUB "):
+                    end = line.find(b" ", 4)
+                    if end < 0:
+                        continue
+                    self.forward(writer, line[4:end].decode(), line)
+                elif line.startswith(b"SUB "):
+                    channel = line[4:].strip().decode()
+                    self.subscribers.setdefault(channel, set()).add(writer)
+                else:
+                    log("BAD_LINE", f"看不懂的指令：{line[:80]!r}")
+        except (OSError, ValueError) as exc:
+            log("CLIENT_ERROR", f"worker 連線錯誤：{exc!r}")
+        finally:
+            self.unsubscribe_all(writer)
+            writer.close()
+            log("DISCONNECT", f"worker 離開，已轉送 {self.forwarded} 則")
+
+
+async def main(path: str) -> None:
+    if os.path.exists(path):
+        os.unlink(path)
+    broker = Broker()
+    server = await asyncio.start_unix_server(broker.handle_client, path=path, limit=MAX_LINE)
+    log("START", f"listening on {path}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: python backplane_broker.py <unix socket path>")
+        sys.exit(1)
+    try:
+        asyncio.run(main(sys.argv[1]))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,171 @@
+# ws-server/bench/bench_dispatch.py
+
+"""
+量每則訊息 decode + dispatch 的成本：原本 json.loads + if/elif + handler 自己 int(...) / .get(...)
+對照現在 decode_envelope + MESSAGE_ROUTES + MessageSchema.decode。
+
+用法：
+    python ws-server/bench/bench_dispatch.py [每種訊息跑幾次，預設 200000]
+
+只量解析和找 handler，不執行 handler 本身（兩邊的 handler 邏輯一樣）。
+"""
+
+import json
+import os
+import sys
+import timeit
+
+# 和 wsA/wsB/wsC 一樣把 ws-server/ 加進 sys.path；log 只留 WARNING 以上
+WS_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if WS_SERVER_DIR not in sys.path:
+    sys.path.insert(0, WS_SERVER_DIR)
+os.environ.setdefault("WS_LOG_LEVEL", "WARNING")
+
+from ws_engine import MESSAGE_ROUTES, MessageDecodeError, decode_envelope  # noqa: E402
+
+SAMPLES = {
+    "update_position": {"type": "update_position", "user_id": 42, "payload": {"x": 312.5, "y": 88.0}},
+    "battle_update": {
+        "type": "battle_update",
+        "user_id": 42,
+        "payload": {"battle_id": "A-42-77-1700000000", "score": 17, "state": "running"},
+    },
+    "chat_message": {"type": "chat_message", "user_id": 42, "payload": {"to_user_id": 77, "content": "hi 👋"}},
+    "pet_state_update": {
+        "type": "pet_state_update",
+        "user_id": 42,
+        "payload": {"energy": 80, "status": "ACTIVE", "score": 120},
+    },
+}
+BAD_FRAMES = {
+    "not_json": "hello",
+    "missing_field": '{"type":"update_position","user_id":42,"payload":{"x":1}}',
+}
+
+
+# =========================================================
+# 原本的寫法（從 baseline 的 websocket_endpoint / handler 摘出解析的部分）
+# =========================================================
+
+def old_update_position(message: dict):
+    user_id = int(message.get("user_id"))
+    payload = message.get("payload") or {}
+    x = payload.get("x")
+    y = payload.get("y")
+    if x is None or y is None:
+        return None
+    return user_id, float(x), float(y)
+
+
+def old_battle_update(message: dict):
+    user_id = int(message.get("user_id"))
+    payload = message.get("payload") or {}
+    battle_id_raw = payload.get("battle_id")
+    if not battle_id_raw:
+        return None
+    return user_id, str(battle_id_raw), int(payload.get("score", 0)), str(payload.get("state", "running"))
+
+
+def old_chat_message(message: dict):
+    user_id = int(message.get("user_id"))
+    payload = message.get("payload") or {}
+    content = str(payload.get("content", ""))
+    to_user_id = payload.get("to_user_id")
+    if to_user_id is None:
+        return None
+    return user_id, int(to_user_id), content
+
+
+def old_pet_state_update(message: dict):
+    user_id = int(message.get("user_id"))
+    payload = message.get("payload") or {}
+    state = {}
+    if "energy" in payload:
+        state["energy"] = int(payload["energy"])
+    if "status" in payload:
+        state["status"] = str(payload["status"])
+    if "score" in payload:
+        state["score"] = int(payload["score"])
+    return user_id, state
+
+
+def old_dispatch(raw: str, server_id: str = "A", user_id: int = 42):
+    try:
+        message = json.loads(raw)
+    except json.JSONDecodeError:
+        return None
+
+    msg_type = message.get("type")
+    message["server_id"] = server_id
+
+    msg_user_id_raw = message.get("user_id")
+    msg_user_id = None
+    if msg_user_id_raw is not None:
+        try:
+            msg_user_id = int(msg_user_id_raw)
+        except (TypeError, ValueError):
+            msg_user_id = None
+    if msg_user_id is not None and msg_user_id != user_id:
+        return None
+    message["user_id"] = user_id
+
+    # baseline 的分支順序；其他 type 在這裡用不到，只保留比較次數
+    if msg_type == "pet_state_update":
+        return old_pet_state_update(message)
+    elif msg_type == "update_position":
+        return old_update_position(message)
+    elif msg_type == "chat_request":
+        return None
+    elif msg_type == "chat_request_accept":
+        return None
+    elif msg_type == "chat_message":
+        return old_chat_message(message)
+    elif msg_type == "battle_invite":
+        return None
+    elif msg_type == "battle_accept":
+        return None
+    elif msg_type == "battle_update":
+        return old_battle_update(message)
+    return None
+
+
+# =========================================================
+# 現在的寫法（和 serve_connection 一樣的步驟）
+# =========================================================
+
+def new_dispatch(raw: str, user_id: int = 42):
+    try:
+        msg_type, msg_user_id, raw_payload = decode_envelope(raw)
+    except MessageDecodeError:
+        return None
+    if msg_user_id is not None and msg_user_id != user_id:
+        return None
+    route = MESSAGE_ROUTES.get(msg_type)
+    if route is None:
+        return None
+    schema, handler = route
+    try:
+        return handler, schema.decode(raw_payload)
+    except MessageDecodeError:
+        return None
+
+
+def per_message_us(fn, raw: str, number: int) -> float:
+    best = min(timeit.repeat(lambda: fn(raw), number=number, repeat=5))
+    return best / number * 1e6
+
+
+def main() -> None:
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    rows = [(name, json.dumps(sample, ensure_ascii=False)) for name, sample in SAMPLES.items()]
+    rows += list(BAD_FRAMES.items())
+
+    print(f"{'message':<18} {'before us':>10} {'after us':>10} {'ratio':>7}")
+    for name, raw in rows:
+        before = per_message_us(old_dispatch, raw, number)
+        after = per_message_us(new_dispatch, raw, number)
+        print(f"{name:<18} {before:>10.2f} {after:>10.2f} {before / after:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# ws-server/bench/bench_lobby_players.py
+
+"""
+大廳玩家資料的記憶體和組訊息成本：原本每人一個 dict 對照現在的 LobbyPlayer（__slots__ + 快取 JSON 片段）。
+
+用法：
+    python ws-server/bench/bench_lobby_players.py [玩家數，預設 10000]
+
+量三件事：
+- 每位玩家佔多少記憶體（tracemalloc；名字字串兩邊共用不算在內，分英文和中文名字各量一次）
+- 新玩家 join 時組完整 lobby_state 的時間（排序 + 序列化）
+- 廣播一筆 pet_state_update 給其他人時組訊息的時間（fan-out 每次都要做）
+"""
+
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+# 和 wsA/wsB/wsC 一樣把 ws-server/ 加進 sys.path；log 只留 WARNING 以上
+WS_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if WS_SERVER_DIR not in sys.path:
+    sys.path.insert(0, WS_SERVER_DIR)
+os.environ.setdefault("WS_LOG_LEVEL", "WARNING")
+
+from ws_engine import LobbyPlayer, configure_shards, encode_player_message, shards  # noqa: E402
+
+
+def make_rows(count: int, cjk: bool = True) -> list:
+    name_prefix, pet_prefix = ("玩家", "寵物") if cjk else ("Player", "Pet")
+    rng = random.Random(1)
+    user_ids = rng.sample(range(1, count * 10), count)
+    return [
+        (
+            uid,
+            f"{name_prefix}{uid}",
+            uid,
+            f"{pet_prefix}{uid % 97}",
+            rng.randint(0, 100),
+            "ACTIVE",
+            rng.randint(0, 2000),
+            float(rng.randint(0, 2000)),
+            float(rng.randint(0, 2000)),
+        )
+        for uid in user_ids
+    ]
+
+
+# =========================================================
+# 原本的寫法（baseline 的 upsert_lobby_player / get_lobby_players）
+# =========================================================
+
+class OldLobby:
+    def __init__(self) -> None:
+        self.lobby_player_states: dict = {}
+
+    def upsert_lobby_player(self, server_id: str, user_id: int, info: dict) -> None:
+        if server_id not in self.lobby_player_states:
+            self.lobby_player_states[server_id] = {}
+        info["user_id"] = user_id
+        self.lobby_player_states[server_id][user_id] = info
+
+    def get_lobby_players(self, server_id: str) -> list:
+        server_players = self.lobby_player_states.get(server_id, {})
+        return [server_players[uid] for uid in sorted(server_players.keys())]
+
+
+def old_build(rows: list) -> OldLobby:
+    lobby = OldLobby()
+    for uid, display_name, pet_id, pet_name, energy, status, score, x, y in rows:
+        lobby.upsert_lobby_player("A", uid, {
+            "user_id": uid,
+            "display_name": display_name,
+            "pet_id": pet_id,
+            "pet_name": pet_name,
+            "energy": energy,
+            "status": status,
+            "score": score,
+            "x": x,
+            "y": y,
+        })
+    return lobby
+
+
+def old_snapshot(lobby: OldLobby, user_id: int) -> str:
+    return json.dumps({
+        "type": "lobby_state",
+        "server_id": "A",
+        "user_id": user_id,
+        "payload": {"players": lobby.get_lobby_players("A")},
+    }, ensure_ascii=False)
+
+
+def old_fanout(lobby: OldLobby, user_id: int) -> str:
+    return json.dumps({
+        "type": "pet_state_update",
+        "server_id": "A",
+        "user_id": user_id,
+        "payload": {"player": lobby.lobby_player_states["A"][user_id]},
+    }, ensure_ascii=False)
+
+
+# =========================================================
+# 現在的寫法（ConnectionManager + LobbyPlayer）
+# =========================================================
+
+def new_build(rows: list):
+    configure_shards(["A"])
+    manager = shards["A"]
+    for row in rows:
+        manager.upsert_lobby_player("A", LobbyPlayer(*row))
+    return manager
+
+
+def new_snapshot(manager, user_id: int) -> str:
+    # 和 handle_join_lobby 一樣直接接快取的 JSON 片段（這裡放全部玩家，和原本的全量 lobby_state 比）
+    players_json = ",".join(p.to_json() for p in manager.get_lobby_players("A"))
+    return (
+        f'{{"type":"lobby_state","server_id":"A","user_id":{user_id},'
+        f'"payload":{{"players":[{players_json}]}}}}'
+    )
+
+
+def new_fanout(manager, user_id: int) -> str:
+    return encode_player_message(
+        "pet_state_update", "A", user_id, manager.get_player_state("A", user_id)
+    )
+
+
+def measure_memory(build, rows: list) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(rows)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / len(rows)
+
+
+def best_ms(fn, number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1000
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    rows = make_rows(count)
+    some_uid = rows[count // 2][0]
+
+    ascii_rows = make_rows(count, cjk=False)
+    old_ascii = measure_memory(old_build, ascii_rows)
+    new_ascii = measure_memory(new_build, ascii_rows)
+    old_bytes = measure_memory(old_build, rows)
+    new_bytes = measure_memory(new_build, rows)
+
+    old_lobby = old_build(rows)
+    manager = new_build(rows)
+    # 兩邊組出來的玩家內容要一樣才算公平
+    assert json.loads(old_snapshot(old_lobby, 1))["payload"] == json.loads(new_snapshot(manager, 1))["payload"]
+
+    old_snap = best_ms(lambda: old_snapshot(old_lobby, some_uid), 20)
+    new_snap = best_ms(lambda: new_snapshot(manager, some_uid), 20)
+    old_fan = best_ms(lambda: old_fanout(old_lobby, some_uid), 20000) * 1000
+    new_fan = best_ms(lambda: new_fanout(manager, some_uid), 20000) * 1000
+
+    print(f"players={count}")
+    print(f"{'':<26} {'before':>10} {'after':>10} {'ratio':>7}")
+    print(f"{'memory B/player (ascii)':<26} {old_ascii:>10.0f} {new_ascii:>10.0f} {old_ascii / new_ascii:>6.2f}x")
+    print(f"{'memory B/player (中文名)':<26} {old_bytes:>10.0f} {new_bytes:>10.0f} {old_bytes / new_bytes:>6.2f}x")
+    print(f"{'lobby_state build ms':<26} {old_snap:>10.2f} {new_snap:>10.2f} {old_snap / new_snap:>6.2f}x")
+    print(f"{'pet_state_update us':<26} {old_fan:>10.2f} {new_fan:>10.2f} {old_fan / new_fan:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
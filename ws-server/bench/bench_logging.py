@@ -0,0 +1,161 @@
+# ws-server/bench/bench_logging.py
+
+"""
+log 開 / 關時的訊息吞吐量：一個玩家狂送 pet_state_update，同一個視野裡 10 個玩家收，
+量伺服器每秒吃得下幾則。stdout 分成寫到檔案、以及接到一個永遠不讀的 pipe（模擬卡住的 log 收集器）兩種。
+
+用法：
+    python ws-server/bench/bench_logging.py [--app-dir DIR] [--messages N] [--runs N]
+
+--app-dir 是要跑的 wsA_main.py 所在目錄，預設是這個 repo 的 ws-server/wsA。
+要對照改版前直接 print 的版本：
+    git worktree add /tmp/ws-baseline <舊的 commit>
+    python ws-server/bench/bench_logging.py --app-dir /tmp/ws-baseline/ws-server/wsA
+舊版不看 WS_LOG_LEVEL，每一則都 print，所以 log on / off 兩行量的是同一件事。
+
+需要 uvicorn 和 websockets。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+WS_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIEWERS = 10
+# 卡住的 pipe 會讓舊版整個停住，超過這個秒數就算「卡死」
+RUN_TIMEOUT = 60.0
+
+MODES = [
+    # (名稱, 環境變數)
+    ("log off (INFO)", {"WS_LOG_LEVEL": "INFO"}),
+    ("log on (DEBUG, no cap)", {"WS_LOG_LEVEL": "DEBUG", "WS_LOG_RATE_CAP": "0"}),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(url: str) -> None:
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            async with websockets.connect(url):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def flood(url: str, messages: int) -> tuple:
+    """回傳 (每秒送進幾則, 收到的則數)；收不完就在 RUN_TIMEOUT 時停下來。"""
+    await wait_ready(url)
+    viewers = []
+    for uid in range(2, 2 + VIEWERS):
+        ws = await websockets.connect(url, max_queue=None)
+        await ws.send(json.dumps({"type": "join_lobby", "user_id": uid, "payload": {"x": 50, "y": 50}}))
+        viewers.append(ws)
+    sender = await websockets.connect(url, max_queue=None)
+    await sender.send(json.dumps({"type": "join_lobby", "user_id": 1, "payload": {"x": 50, "y": 50}}))
+    await asyncio.sleep(0.5)
+
+    received = [0] * VIEWERS
+
+    async def count(idx: int, ws) -> None:
+        # 伺服器卡住時 keepalive ping 會逾時把連線關掉，這裡就停下來，由 received 判斷有沒有收完
+        try:
+            async for frame in ws:
+                if '"pet_state_update"' in frame and '"user_id":1,' in frame:
+                    received[idx] += 1
+                    if received[idx] == messages:
+                        return
+        except websockets.ConnectionClosed:
+            return
+
+    async def send_all() -> None:
+        try:
+            for i in range(messages):
+                await sender.send(json.dumps({
+                    "type": "pet_state_update",
+                    "user_id": 1,
+                    "payload": {"energy": i % 100, "x": 50, "y": 50},
+                }))
+        except websockets.ConnectionClosed:
+            return
+
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(count(i, ws)) for i, ws in enumerate(viewers)]
+    sending = asyncio.create_task(send_all())
+    done, pending = await asyncio.wait(tasks + [sending], timeout=RUN_TIMEOUT)
+    elapsed = time.perf_counter() - started
+    for task in pending:
+        task.cancel()
+    for ws in viewers + [sender]:
+        ws.transport.abort()
+    if pending or min(received) < messages:
+        return None, sum(received)
+    return messages / elapsed, sum(received)
+
+
+def run_once(app_dir: str, env_extra: dict, stdout_to_pipe: bool, messages: int) -> str:
+    port = free_port()
+    env = dict(
+        os.environ,
+        WS_RATE_LIMITS="pet_state_update=100000:100000",
+        WS_COMPRESSION="off",
+        **env_extra,
+    )
+    log_file = None
+    if stdout_to_pipe:
+        # 開了 pipe 但從來不讀：pipe buffer 滿了之後寫 stdout 就會卡住
+        stdout = subprocess.PIPE
+    else:
+        log_file = tempfile.TemporaryFile()
+        stdout = log_file
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "wsA_main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=app_dir,
+        env=env,
+        stdout=stdout,
+        stderr=subprocess.STDOUT,
+    )
+    try:
+        rate, received = asyncio.run(flood(f"ws://127.0.0.1:{port}/ws/", messages))
+    finally:
+        proc.kill()
+        proc.wait()
+        if log_file is not None:
+            log_file.close()
+    if rate is None:
+        return f"stalled ({received}/{messages * VIEWERS} delivered)"
+    return f"{rate:.0f} msg/s in"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app-dir", default=os.path.join(WS_SERVER_DIR, "wsA"))
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"app={args.app_dir}, {args.messages} pet_state_update -> {VIEWERS} viewers")
+    for stdout_to_pipe in (False, True):
+        target = "unread pipe" if stdout_to_pipe else "file"
+        for name, env_extra in MODES:
+            results = [run_once(args.app_dir, env_extra, stdout_to_pipe, args.messages) for _ in range(args.runs)]
+            print(f"stdout={target:<12} {name:<24} {', '.join(results)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# ws-server/bench/bench_matchmaking.py
+
+"""
+對戰配對佇列（MatchQueue）的模擬負載：幾千到幾萬人同時排隊時，排入和一次配對 tick 要多久。
+
+用法：
+    python ws-server/bench/bench_matchmaking.py
+
+量三件事：
+- MatchQueue.add / pair 在 1k、10k、50k 人排隊時的成本，對照沒有分桶、每人掃全部找最接近積分的寫法
+- 5000 人排隊時跑一次完整的 run_matchmaking（清佇列 + 配對 + 開房，送訊息的部分換成只計數）
+- 穩定狀態：每個 tick 進來 200 人，連跑 50 個 tick 的 p50 / max
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+
+# 和 wsA/wsB/wsC 一樣把 ws-server/ 加進 sys.path；log 只留 WARNING 以上
+WS_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if WS_SERVER_DIR not in sys.path:
+    sys.path.insert(0, WS_SERVER_DIR)
+os.environ.setdefault("WS_LOG_LEVEL", "WARNING")
+
+from ws_engine import LobbyPlayer, MatchQueue, configure_shards, pet_cache, run_matchmaking, shards  # noqa: E402
+
+MAX_SCORE = 2000
+rng = random.Random(1)
+
+
+def naive_pair(players: dict) -> int:
+    """沒有分桶時最直覺的寫法：每個人掃一遍剩下的人，找積分最接近的。"""
+    left = dict(players)
+    pairs = 0
+    for user_id in list(left):
+        if user_id not in left:
+            continue
+        score = left[user_id]
+        best = None
+        for other_id, other_score in left.items():
+            if other_id != user_id and (best is None or abs(other_score - score) < best[0]):
+                best = (abs(other_score - score), other_id)
+        if best is not None:
+            del left[user_id]
+            del left[best[1]]
+            pairs += 1
+    return pairs
+
+
+def bench_queue() -> None:
+    for count in (1_000, 10_000, 50_000):
+        players = {uid: rng.randint(0, MAX_SCORE) for uid in range(1, count + 1)}
+        match_queue = MatchQueue()
+        started = time.perf_counter()
+        for uid, score in players.items():
+            match_queue.add(uid, score, 0.0)
+        add_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        pairs = match_queue.pair(1.0)
+        pair_s = time.perf_counter() - started
+
+        row = (
+            f"queued={count:>6}: add {add_s / count * 1e6:.2f} us/player, "
+            f"pair tick {pair_s * 1000:.1f} ms ({len(pairs)} pairs)"
+        )
+        # O(n^2) 的寫法到 50k 要跑好幾分鐘，只量到 10k
+        if count <= 10_000:
+            started = time.perf_counter()
+            naive_pair(players)
+            row += f", naive {(time.perf_counter() - started) * 1000:.0f} ms"
+        print(row)
+
+
+async def bench_ticks() -> None:
+    configure_shards(["A"])
+    manager = shards["A"]
+    sent = [0]
+
+    async def count_send(server_id: str, to_user_id: int, msg: dict) -> None:
+        sent[0] += 1
+
+    manager.send_json = count_send
+    next_uid = [0]
+
+    def join() -> None:
+        next_uid[0] += 1
+        uid = next_uid[0]
+        score = rng.randint(0, MAX_SCORE)
+        manager.upsert_lobby_player("A", LobbyPlayer(uid, f"Player{uid}", uid, "MyPet", 100, "ACTIVE", score, 0.0, 0.0))
+        # 體力要有 backend 的值才能配對，這裡直接當作已經載到快取
+        pet_cache.entries[uid] = (100, score, "ACTIVE")
+        # 只要有 key 就算在線，run_matchmaking 不會碰到連線本身
+        manager.active_connections[("A", uid)] = object()
+        manager.get_match_queue("A").add(uid, score, time.time())
+
+    for _ in range(5000):
+        join()
+    match_queue = manager.get_match_queue("A")
+    started = time.perf_counter()
+    await run_matchmaking("A")
+    first_ms = (time.perf_counter() - started) * 1000
+    print(
+        f"run_matchmaking with 5000 queued: {first_ms:.1f} ms "
+        f"(prune+pair {match_queue.last_tick_ms:.1f} ms, {match_queue.matched} pairs, {sent[0]} battle_start)"
+    )
+
+    ticks = []
+    for _ in range(50):
+        for _ in range(200):
+            join()
+        started = time.perf_counter()
+        await run_matchmaking("A")
+        ticks.append((time.perf_counter() - started) * 1000)
+    ticks.sort()
+    print(
+        f"steady 200 joins/tick: p50 {ticks[len(ticks) // 2]:.2f} ms, max {ticks[-1]:.2f} ms, "
+        f"rooms={len(manager.battles)}"
+    )
+
+
+if __name__ == "__main__":
+    bench_queue()
+    asyncio.run(bench_ticks())
@@ -0,0 +1,89 @@
+# ws-server/tests/test_battle_membership.py
+
+"""
+對戰房間只接受房裡兩個玩家送的 battle_ready / battle_update / battle_result。
+
+用法：
+    python -m pytest ws-server/tests
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+WS_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if WS_SERVER_DIR not in sys.path:
+    sys.path.insert(0, WS_SERVER_DIR)
+os.environ.setdefault("WS_LOG_LEVEL", "WARNING")
+
+import ws_engine  # noqa: E402
+from ws_engine import (  # noqa: E402
+    BattleReadyPayload,
+    BattleScorePayload,
+    handle_battle_ready,
+    handle_battle_result,
+    handle_battle_update,
+)
+
+PLAYER1 = 1
+PLAYER2 = 2
+OUTSIDER = 3
+
+
+@pytest.fixture
+def battle(monkeypatch):
+    """A 伺服器上開一間 1 對 2 的房間；送出的訊息和回報給 backend 的結果都只記下來。"""
+    ws_engine.configure_shards(["A"])
+    manager = ws_engine.shards["A"]
+    sent = []
+    reported = []
+
+    async def record_json(server_id, to_user_id, msg):
+        sent.append((to_user_id, msg["type"]))
+
+    async def record_text(server_id, user_ids, text, msg_type="other", relay=True):
+        sent.extend((uid, msg_type) for uid in user_ids)
+
+    monkeypatch.setattr(manager, "send_json", record_json)
+    monkeypatch.setattr(manager, "send_text_to_users", record_text)
+    monkeypatch.setattr(ws_engine, "report_battle", lambda room, s1, s2, winner: reported.append(winner))
+    monkeypatch.setattr(ws_engine, "BATTLE_RELAY_INTERVAL", 0)
+
+    room = manager.create_battle("A", PLAYER1, PLAYER2)
+    return manager, room, sent, reported
+
+
+def test_outsider_battle_result_is_ignored(battle):
+    manager, room, sent, reported = battle
+
+    asyncio.run(handle_battle_result("A", OUTSIDER, BattleScorePayload(room.battle_id, 999, "finished")))
+
+    assert manager.get_battle(room.battle_id) is room
+    assert room.results == {}
+    assert OUTSIDER not in room.scores
+    assert reported == []
+    assert sent == []
+
+
+def test_outsider_battle_update_and_ready_are_ignored(battle):
+    manager, room, sent, reported = battle
+
+    asyncio.run(handle_battle_update("A", OUTSIDER, BattleScorePayload(room.battle_id, 50, "running")))
+    asyncio.run(handle_battle_ready("A", OUTSIDER, BattleReadyPayload(room.battle_id)))
+
+    assert room.scores == {PLAYER1: 0, PLAYER2: 0}
+    assert room.ready == {PLAYER1: False, PLAYER2: False}
+    assert room.state == "waiting"
+    assert sent == []
+
+
+def test_member_battle_result_still_settles(battle):
+    manager, room, sent, reported = battle
+
+    asyncio.run(handle_battle_result("A", PLAYER1, BattleScorePayload(room.battle_id, 10, "finished")))
+
+    assert reported == [PLAYER1]
+    assert manager.get_battle(room.battle_id) is None
+    assert (PLAYER2, "battle_result") in sent
@@ -0,0 +1,4387 @@
+# ws-server/ws_engine.py
+"""
+ws server 引擎：A / B / C 伺服器共用這一份程式，一個行程可以同時跑好幾個 shard（伺服器）。
+每個 shard 有自己的 ConnectionManager（連線、大廳、對戰、聊天、限流、backplane 全部分開）。
+
+- 一個行程一個 shard：wsA/wsA_main.py 這種 shim，呼叫 configure_shards(["A"])，路徑和以前一樣是 /ws/
+- 一個行程多個 shard：WS_SHARDS=A,B,C uvicorn ws_engine:app
+  每個 shard 的連線走 /ws/<shard_id>/（Nginx 把 /serverB/ws 轉到 /ws/B/），/ws/ 是第一個 shard
+"""
+
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+from typing import Any, Awaitable, Callable, Dict, Tuple, List, Set
+from dataclasses import asdict, dataclass, field
+from collections import deque
+import asyncio
+import bisect
+import contextvars
+import fcntl
+import functools
+import logging
+import logging.handlers
+import queue
+import sys
+import math
+import struct
+import time
+import json
+import os
+import random
+import secrets
+import threading
+import zlib
+
+import httpx
+
+WORLD_WIDTH = 200
+WORLD_HEIGHT = 200
+
+# 視野半徑：只有距離在這個範圍內的玩家才會收到彼此的移動 / 狀態更新
+VIEW_RADIUS = float(os.getenv("WS_VIEW_RADIUS", "60"))
+# 空間索引的格子大小，和視野半徑一樣大時查詢只需要看 3x3 格
+GRID_CELL_SIZE = float(os.getenv("WS_GRID_CELL_SIZE", str(VIEW_RADIUS)))
+
+# 對戰房間回收：waiting 太久、或 running 中太久沒收到任何對戰訊息的房間會被背景工作收掉（秒）
+BATTLE_WAITING_TIMEOUT = float(os.getenv("WS_BATTLE_WAITING_TIMEOUT", "120"))
+BATTLE_RUNNING_TIMEOUT = float(os.getenv("WS_BATTLE_RUNNING_TIMEOUT", "600"))
+BATTLE_REAP_INTERVAL = float(os.getenv("WS_BATTLE_REAP_INTERVAL", "10"))
+# 對戰分數轉送：battle_update 先記在房間，每隔這麼久才把雙方最新分數合成一則送出（毫秒）
+# 0 = 每則 battle_update 都立刻轉送
+BATTLE_RELAY_INTERVAL = float(os.getenv("WS_BATTLE_RELAY_MS", "100")) / 1000
+# 對戰需要的最低體力（邀請 / 接受 / 配對佇列共用）
+BATTLE_MIN_ENERGY = 70
+# backend 的體力還沒載到（連不上、沒設定 WS_BACKEND_URL、沒有這隻寵物）時，看體力的動作一律拒絕
+ENERGY_UNKNOWN_MESSAGE = "暫時無法確認小寵物的體力，請稍後再試。"
+# 對戰勝者加幾分，要和 backend 的 BATTLE_WIN_SCORE 一樣（backend 寫完會推回權威分數，兩邊不同大廳會跳一下）
+BATTLE_WIN_SCORE = int(os.getenv("WS_BATTLE_WIN_SCORE", "5"))
+# 配對佇列多久配一次對（battle_queue_join 進來的玩家在下一次 tick 才配）
+MATCH_TICK = float(os.getenv("WS_MATCH_TICK_MS", "500")) / 1000
+
+# 聊天許可的有效時間（秒），過期要重新發 chat_request
+CHAT_APPROVAL_TTL = float(os.getenv("WS_CHAT_APPROVAL_TTL", "1800"))
+
+# 單一 WebSocket 文字訊息的長度上限，超過直接丟掉不解析
+MAX_FRAME_CHARS = int(os.getenv("WS_MAX_FRAME_CHARS", "16384"))
+
+# 應用層壓縮：只壓超過門檻的訊息（大廳快照、長聊天），移動這類小訊息直接送省 CPU
+# deflate = 開啟（客戶端 join_lobby 時也要帶 compression: "deflate"），off = 全部不壓
+WS_COMPRESSION = os.getenv("WS_COMPRESSION", "deflate")
+COMPRESS_MIN_BYTES = int(os.getenv("WS_COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.getenv("WS_COMPRESS_LEVEL", "6"))
+
+# 大廳狀態版本：每個 server 一個遞增版本號，每個玩家記最後一次變動的版本，最多記這麼多人
+# 重連時帶上次看到的版本，還記得到就只補差異，不然給完整快照
+LOBBY_DELTA_BUFFER = int(os.getenv("WS_LOBBY_DELTA_BUFFER", "4096"))
+# 斷線後保留大廳狀態、對戰房間幾秒才真的離開（lobby.html ↔ game.html 換頁靠這段時間重連）
+# 重連時要帶 join 時拿到的 session token 才算同一個 session
+LOBBY_LEAVE_GRACE = float(os.getenv("WS_LOBBY_LEAVE_GRACE", "5"))
+# 心跳：連線閒置超過 interval 就送 ping，超過 timeout 都沒收到任何訊息（含 pong）就踢掉
+# 還沒 join_lobby 的連線超過 timeout 也直接關掉
+HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "15"))
+HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", "45"))
+
+# 上行限流：每條連線、每種訊息 type 一個 token bucket，(每秒補幾個, 最多存幾個)
+# 可以用 WS_RATE_LIMITS="chat_message=1:3,pet_state_update=2:5" 覆寫個別 type
+DEFAULT_RATE_LIMIT = (10.0, 20.0)
+RATE_LIMITS: Dict[str, Tuple[float, float]] = {
+    "join_lobby": (0.5, 3.0),
+    "pet_state_update": (5.0, 10.0),
+    # 大廳每個 animation frame 都會送（60~144 Hz），上限要比這個高，本來就有 50ms 的廣播節流
+    "update_position": (120.0, 240.0),
+    "chat_request": (1.0, 3.0),
+    "chat_request_accept": (1.0, 3.0),
+    "chat_message": (2.0, 5.0),
+    "battle_invite": (1.0, 3.0),
+    "battle_accept": (1.0, 3.0),
+    "battle_queue_join": (1.0, 3.0),
+    "battle_queue_leave": (1.0, 3.0),
+    "battle_ready": (1.0, 3.0),
+    "battle_update": (20.0, 40.0),
+    "battle_result": (1.0, 3.0),
+}
+for _item in filter(None, os.getenv("WS_RATE_LIMITS", "").split(",")):
+    _msg_type, _, _limit = _item.partition("=")
+    _rate, _, _burst = _limit.partition(":")
+    RATE_LIMITS[_msg_type.strip()] = (float(_rate), float(_burst or _rate))
+
+# 下行背壓：送給某條連線、還卡在 await 的訊息數到這個量，就先暫停讀它的上行訊息，
+# 降到一半以下再繼續（對方收不完，就別再讓他產生更多要回給他的工作）
+OUTBOUND_PAUSE_AT = int(os.getenv("WS_OUTBOUND_PAUSE_AT", "8"))
+
+# 同一個帳號從別的分頁 / 裝置登入時，舊連線用這個 close code 關掉（4000 以上是應用程式自訂）
+WS_CLOSE_REPLACED = 4001
+
+# 每次啟動換一個，伺服器重開後舊的版本號就對不上，一律給完整快照
+# 加上亂數：uvicorn --workers N 同一毫秒啟動的 worker 版本號各走各的，epoch 不能一樣
+LOBBY_EPOCH = f"{int(time.time() * 1000):x}{secrets.token_hex(4)}"
+
+# 沒有 shim 指定時，這個行程要跑哪些 shard（逗號分隔）
+SHARD_IDS_DEFAULT = [s.strip() for s in os.getenv("WS_SHARDS", "A").split(",") if s.strip()]
+
+# /metrics：每幾秒算一次各 type 的每秒訊息數；event loop 延遲探針多久量一次
+METRICS_WINDOW = float(os.getenv("WS_METRICS_WINDOW", "5"))
+LOOP_LAG_INTERVAL = float(os.getenv("WS_LOOP_LAG_INTERVAL", "0.5"))
+
+# /admin/* 要帶 X-Admin-Token；沒設定就整組關掉（前面有 Nginx，不能用來源 IP 判斷）
+ADMIN_TOKEN = os.getenv("WS_ADMIN_TOKEN", "")
+# 同一個邏輯伺服器開多個 worker 行程時，worker 之間用 backplane 同步大廳 / 對戰 / 聊天狀態、轉送訊息
+# memory = 單一行程（預設，完全不多做事）；unix:/路徑 = 接到本機的 backplane_broker.py
+BACKPLANE_URL = os.getenv("WS_BACKPLANE", "memory")
+# 寫給 broker 還沒送出去的資料超過這個大小就丟掉新的訊息，不讓記憶體一直長
+BACKPLANE_MAX_BUFFER = int(os.getenv("WS_BACKPLANE_MAX_BUFFER", str(4 * 1024 * 1024)))
+BACKPLANE_MAX_LINE = 1024 * 1024
+# 這個行程在 backplane 上的名字；每個 worker 另外訂閱 "<server_id>:<WORKER_ID>" 收指定給自己的訊息
+WORKER_ID = f"{os.getpid():x}{secrets.token_hex(2)}"
+# 跨 shard / 跨伺服器的全域頻道（公告、全域排行榜）：A/B/C 各自的行程都要接到同一個 broker
+# 沒設定就和 WS_BACKPLANE 一樣；memory 時只送給這個行程裡的 shard
+GLOBAL_BACKPLANE_URL = os.getenv("WS_GLOBAL_BACKPLANE", BACKPLANE_URL)
+GLOBAL_CHANNEL = "global"
+# 管理 API 只能發這幾種，避免拿來冒充對戰 / 聊天訊息
+GLOBAL_EVENT_TYPES = {"announcement", "leaderboard_update"}
+
+# 對戰結果回報 backend（POST /api/battle/result）；設成空字串就不回報
+BACKEND_URL = os.getenv("WS_BACKEND_URL", "http://127.0.0.1:8000")
+BACKEND_TIMEOUT = float(os.getenv("WS_BACKEND_TIMEOUT", "5"))
+BACKEND_MAX_CONNECTIONS = int(os.getenv("WS_BACKEND_MAX_CONNECTIONS", "4"))
+# 還沒送成功的結果先寫在本機 append-only 檔，backend 掛掉或 ws 重開都不會掉
+# 沒設定就放 ws-server/data/battle_reports-<wsA>.jsonl
+BATTLE_REPORT_QUEUE = os.getenv("WS_BATTLE_REPORT_QUEUE", "")
+# 待送筆數上限，超過就丟最舊的；積壓時一次最多送幾筆（走 /api/battle/results）
+BATTLE_REPORT_MAX_PENDING = int(os.getenv("WS_BATTLE_REPORT_MAX_PENDING", "10000"))
+BATTLE_REPORT_BATCH = int(os.getenv("WS_BATTLE_REPORT_BATCH", "50"))
+# 送失敗的重試間隔：從 min 開始每次加倍，最多 max（秒）
+BATTLE_REPORT_RETRY_MIN = float(os.getenv("WS_BATTLE_REPORT_RETRY_MIN", "1"))
+BATTLE_REPORT_RETRY_MAX = float(os.getenv("WS_BATTLE_REPORT_RETRY_MAX", "60"))
+# 聊天紀錄寫回 backend 的 messages：湊滿幾筆、或最舊的一筆等了幾毫秒就送一批
+CHAT_FLUSH_SIZE = int(os.getenv("WS_CHAT_FLUSH_SIZE", "100"))
+CHAT_FLUSH_INTERVAL = float(os.getenv("WS_CHAT_FLUSH_INTERVAL_MS", "500")) / 1000
+# backend 掛掉時最多留幾筆在記憶體，超過就丟最舊的
+CHAT_BUFFER_MAX = int(os.getenv("WS_CHAT_BUFFER_MAX", "20000"))
+# 體力 / 積分快取：以 backend 的值為準，不信任客戶端帶的
+# backend 改到寵物時會推到全域頻道的 "pet:<server_id>"；保險起見每 REFRESH 秒把大廳裡的人整批重抓
+PET_CACHE_REFRESH = float(os.getenv("WS_PET_CACHE_REFRESH", "60"))
+# backend 連不上時，這段時間內不再打，先用大廳裡的值
+PET_CACHE_RETRY = float(os.getenv("WS_PET_CACHE_RETRY", "5"))
+PET_CACHE_BATCH = 500
+
+# 效能剖析：啟動時是否就打開、單次 handler 超過幾毫秒算慢、取樣最多跑幾秒
+PROFILE_ENABLED = os.getenv("WS_PROFILE", "0") == "1"
+SLOW_HANDLER_MS = float(os.getenv("WS_SLOW_HANDLER_MS", "50"))
+PROFILE_SAMPLE_MAX_SECONDS = float(os.getenv("WS_PROFILE_SAMPLE_MAX_SECONDS", "60"))
+
+
+# ---------------------------------------------------------
+# Log 函式
+# 寫 stdout 交給背景 thread（QueueListener），event loop 只負責丟進 queue
+# 高頻事件預設是 DEBUG，正式環境（INFO）不會輸出；每種事件可以抽樣、限制每秒筆數
+# ---------------------------------------------------------
+LOG_LEVEL = os.getenv("WS_LOG_LEVEL", "INFO").upper()
+# text = 原本的 [wsA][EVENT] 訊息 格式（多個 shard 時是 [wsABC]），json = 一行一筆 JSON（給 log 收集器）
+LOG_FORMAT = os.getenv("WS_LOG_FORMAT", "text")
+# 每種事件每秒最多輸出幾筆，0 = 不限制
+LOG_RATE_CAP = float(os.getenv("WS_LOG_RATE_CAP", "100"))
+# queue 滿了（stdout 太慢）就丟掉新的 log，不讓記憶體一直長
+LOG_QUEUE_SIZE = int(os.getenv("WS_LOG_QUEUE_SIZE", "10000"))
+# 個別事件的抽樣比例，例如 WS_LOG_SAMPLE="BATTLE_UPDATE=0.1,JOIN_LOBBY=0.5"
+LOG_SAMPLE_RATES: Dict[str, float] = {}
+for _item in filter(None, os.getenv("WS_LOG_SAMPLE", "").split(",")):
+    _event, _, _rate = _item.partition("=")
+    LOG_SAMPLE_RATES[_event.strip()] = float(_rate)
+
+# 每則訊息 / 每次移動都會觸發的事件
+HOT_PATH_EVENTS = {
+    "PET_STATE_UPDATE",
+    "PET_PUSH",
+    "CHAT",
+    "BATTLE_UPDATE",
+    "BATTLE_RELAY",
+    "JOIN_LOBBY_POS",
+    "HEALTH_CHECK",
+    "WS_ACCEPT",
+    "WS_BIND_USER",
+}
+WARNING_EVENTS = {
+    "EVICT",
+    "WS_STALE",
+    "WS_IDLE",
+    "CONNECT_REPLACED",
+    "JOIN_LOBBY_IMPERSONATE",
+    "SLOW_HANDLER",
+    "BACKPLANE_CONNECT_ERROR",
+    "BACKPLANE_DISCONNECTED",
+    "BATTLE_REPORT_RETRY",
+    "BATTLE_REPORT_DROPPED",
+    "BATTLE_REPORT_REJECTED",
+    "CHAT_PERSIST_RETRY",
+    "CHAT_PERSIST_DROPPED",
+    "CHAT_PERSIST_REJECTED",
+}
+
+
+class LogSampler:
+    """每種事件先依比例抽樣，再限制每秒最多幾筆；被丟掉的只計數。"""
+
+    def __init__(self, sample_rates: Dict[str, float], rate_cap: float) -> None:
+        self.sample_rates = sample_rates
+        self.rate_cap = rate_cap
+        # event -> [這一秒的開始時間, 已輸出筆數]
+        self.windows: Dict[str, List[float]] = {}
+        self.dropped: Dict[str, int] = {}
+
+    def allow(self, event: str, now: float) -> bool:
+        rate = self.sample_rates.get(event, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            self.dropped[event] = self.dropped.get(event, 0) + 1
+            return False
+        if self.rate_cap > 0:
+            window = self.windows.get(event)
+            if window is None or now - window[0] >= 1.0:
+                self.windows[event] = [now, 1]
+                return True
+            if window[1] >= self.rate_cap:
+                self.dropped[event] = self.dropped.get(event, 0) + 1
+                return False
+            window[1] += 1
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogFormatter(logging.Formatter):
+    # configure_shards 設定，例如 "wsA"；一個行程跑多個 shard 時是 "wsABC"
+    name = "ws"
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = getattr(record, "event", "LOG")
+        if LOG_FORMAT == "json":
+            return json.dumps(
+                {
+                    "ts": round(record.created, 3),
+                    "server": self.name,
+                    "level": record.levelname,
+                    "event": event,
+                    "msg": record.getMessage(),
+                },
+                ensure_ascii=False,
+            )
+        return f"[{self.name}][{event}] {record.getMessage()}"
+
+
+logger = logging.getLogger("ws_engine")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+log_queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+logger.addHandler(log_queue_handler)
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(LogFormatter())
+log_listener = logging.handlers.QueueListener(log_queue_handler.queue, _log_stream)
+log_listener.start()
+log_sampler = LogSampler(LOG_SAMPLE_RATES, LOG_RATE_CAP)
+_event_levels: Dict[str, int] = {}
+
+
+def event_level(prefix: str) -> int:
+    level = _event_levels.get(prefix)
+    if level is None:
+        if prefix in HOT_PATH_EVENTS:
+            level = logging.DEBUG
+        elif "ERROR" in prefix or prefix in WARNING_EVENTS:
+            level = logging.WARNING
+        else:
+            level = logging.INFO
+        _event_levels[prefix] = level
+    return level
+
+
+def log_enabled(prefix: str) -> bool:
+    """組訊息本身就很貴的地方（整個玩家狀態、聊天內容）先問一下，關掉時連字串都不用組。"""
+    return logger.isEnabledFor(event_level(prefix))
+
+
+def log(prefix: str, message: str) -> None:
+    level = event_level(prefix)
+    if not logger.isEnabledFor(level):
+        return
+    if not log_sampler.allow(prefix, time.time()):
+        return
+    logger.log(level, message, extra={"event": prefix})
+
+
+app = FastAPI()
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+UserKey = Tuple[str, int]
+
+
+@dataclass
+class BattleRoom:
+    battle_id: str
+    server_id: str
+    player1_id: int
+    player2_id: int
+    # 遊戲中即時更新用
+    scores: Dict[int, int] = field(default_factory=dict)
+    # waiting / running
+    state: str = "waiting"
+    # 雙方 ready 狀態
+    ready: Dict[int, bool] = field(default_factory=dict)
+    # ⭐ 新增：雙方送上來的「最終分數」
+    results: Dict[int, int] = field(default_factory=dict)
+    # 建立時間 / 進入目前 state 的時間 / 最後一次收到對戰訊息的時間（給過期回收用）
+    created_at: float = field(default_factory=time.time)
+    state_since: float = field(default_factory=time.time)
+    last_activity: float = field(default_factory=time.time)
+
+    def has_player(self, user_id: int) -> bool:
+        return user_id == self.player1_id or user_id == self.player2_id
+
+
+# json.dumps(..., ensure_ascii=False) 每次呼叫都會新建一個 JSONEncoder；
+# 玩家 JSON 片段裡的字串欄位改用同一個 encoder（輸出一樣）
+encode_json_string = json.JSONEncoder(ensure_ascii=False).encode
+
+
+class LobbyPlayer:
+    """
+    大廳玩家狀態：
+    - 用 __slots__ 取代每人一個 dict，一萬人在線時記憶體小很多
+    - user_id / 名字這些不會變的欄位在建立時就先 encode 成 JSON 片段，
+      之後組 lobby_state / pet_state_update 只要接上會變的欄位
+    - 片段存成 UTF-8 bytes：str 只要有一個中文字整串都會變成每字 2~4 bytes，
+      名字大多是中文，bytes 比較省
+    """
+
+    __slots__ = (
+        "user_id",
+        "display_name",
+        "pet_id",
+        "pet_name",
+        "energy",
+        "status",
+        "score",
+        "x",
+        "y",
+        "_static_utf8",
+    )
+
+    def __init__(
+        self,
+        user_id: int,
+        display_name: str,
+        pet_id: int,
+        pet_name: str,
+        energy: int,
+        status: str,
+        score: int,
+        x: float,
+        y: float,
+    ) -> None:
+        self.user_id = user_id
+        self.display_name = display_name
+        self.pet_id = pet_id
+        self.pet_name = pet_name
+        self.energy = energy
+        self.status = status
+        self.score = score
+        self.x = x
+        self.y = y
+        self._static_utf8 = (
+            f'"user_id":{user_id},'
+            f'"display_name":{encode_json_string(display_name)},'
+            f'"pet_id":{pet_id},'
+            f'"pet_name":{encode_json_string(pet_name)}'
+        ).encode()
+
+    def to_dict(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "display_name": self.display_name,
+            "pet_id": self.pet_id,
+            "pet_name": self.pet_name,
+            "energy": self.energy,
+            "status": self.status,
+            "score": self.score,
+            "x": self.x,
+            "y": self.y,
+        }
+
+    def to_json(self) -> str:
+        return (
+            f'{{{self._static_utf8.decode()},'
+            f'"energy":{self.energy},'
+            f'"status":{encode_json_string(self.status)},'
+            f'"score":{self.score},'
+            f'"x":{self.x!r},"y":{self.y!r}}}'
+        )
+
+
+def encode_player_message(
+    msg_type: str,
+    server_id: str,
+    user_id: int,
+    player: LobbyPlayer,
+    version: int | None = None,
+) -> str:
+    """組 {type, server_id, user_id, payload: {player, version}} 這種訊息，直接用玩家快取的 JSON 片段。"""
+    version_json = "" if version is None else f',"version":{version}'
+    return (
+        f'{{"type":"{msg_type}","server_id":{json.dumps(server_id)},'
+        f'"user_id":{user_id},"payload":{{"player":{player.to_json()}{version_json}}}}}'
+    )
+
+
+# ---------------------------------------------------------
+# 二進位協定（join_lobby 時 payload.protocol = "binary" 協商）
+# 只用在高頻的小訊息：移動、對戰分數；其他訊息仍然走 JSON
+# 格式一律 little-endian，和 frontend/js/websocket_client.js 對齊
+# ---------------------------------------------------------
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY = "binary"
+
+BIN_OP_UPDATE_POSITION = 0x01  # client → server：op, x, y
+BIN_OP_PET_MOVED = 0x02  # server → client：op, user_id, x, y
+BIN_OP_BATTLE_UPDATE = 0x03  # client → server：op, state, score / server → client：op, state, user_id, score
+BIN_OP_COMPRESSED = 0x10  # server → client：op + zlib 壓縮後的 JSON 文字
+
+BIN_UPDATE_POSITION = struct.Struct("<Bff")
+BIN_PET_MOVED = struct.Struct("<BIff")
+BIN_BATTLE_UPDATE_IN = struct.Struct("<BBi")
+BIN_BATTLE_UPDATE_OUT = struct.Struct("<BBIi")
+
+BATTLE_STATE_CODES = {"waiting": 0, "running": 1}
+BATTLE_STATE_NAMES = {code: name for name, code in BATTLE_STATE_CODES.items()}
+
+
+class CompressionStats:
+    """依訊息 type 統計（只算有協商壓縮的連線）：送出幾則、壓了幾則、原始 / 實際 bytes、壓縮花的 CPU 時間。"""
+
+    def __init__(self) -> None:
+        self.by_type: Dict[str, List[float]] = {}
+
+    def record(self, msg_type: str, raw_bytes: int, sent_bytes: int, cpu_seconds: float) -> None:
+        stats = self.by_type.get(msg_type)
+        if stats is None:
+            # [messages, compressed, raw_bytes, sent_bytes, cpu_seconds]
+            stats = [0, 0, 0, 0, 0.0]
+            self.by_type[msg_type] = stats
+        stats[0] += 1
+        if sent_bytes != raw_bytes:
+            stats[1] += 1
+        stats[2] += raw_bytes
+        stats[3] += sent_bytes
+        stats[4] += cpu_seconds
+
+    def snapshot(self) -> dict:
+        result = {}
+        for msg_type, (messages, compressed, raw_bytes, sent_bytes, cpu) in self.by_type.items():
+            result[msg_type] = {
+                "messages": messages,
+                "compressed": compressed,
+                "raw_bytes": raw_bytes,
+                "sent_bytes": sent_bytes,
+                "ratio": round(sent_bytes / raw_bytes, 3) if raw_bytes else 1.0,
+                "cpu_ms": round(cpu * 1000, 3),
+                "cpu_us_per_compressed": round(cpu * 1e6 / compressed, 1) if compressed else 0.0,
+            }
+        return result
+
+
+class LatencyHistogram:
+    """固定分桶（毫秒）的延遲分佈，observe 是 O(log 桶數)，不留原始樣本。"""
+
+    BOUNDS_MS = (0.1, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self) -> None:
+        # 最後一格是超過 1000ms 的
+        self.buckets: List[int] = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float) -> None:
+        ms = seconds * 1000
+        self.buckets[bisect.bisect_left(self.BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def snapshot(self) -> dict:
+        # 累積分桶（<= 上界的筆數），和 Prometheus histogram 的 le 一樣
+        cumulative: Dict[str, int] = {}
+        running = 0
+        for bound, n in zip(self.BOUNDS_MS, self.buckets):
+            running += n
+            cumulative[f"le_{bound}"] = running
+        cumulative["le_inf"] = self.count
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "buckets": cumulative,
+        }
+
+
+class RuntimeMetrics:
+    """
+    收 / 送訊息依 type 計數（每個 METRICS_WINDOW 換算成每秒），
+    fan-out 延遲（開始廣播 → 這一個人的 send 完成）依 type 分開統計。每個 shard 一份。
+    """
+
+    def __init__(self) -> None:
+        self.inbound: Dict[str, int] = {}
+        self.outbound: Dict[str, int] = {}
+        self.inbound_rate: Dict[str, float] = {}
+        self.outbound_rate: Dict[str, float] = {}
+        self.fanout: Dict[str, LatencyHistogram] = {}
+        # 全域頻道：收到幾則、送給幾個人、從發佈到這個 shard 全部送完花多久
+        self.global_events = 0
+        self.global_recipients = 0
+        self.global_delivery = LatencyHistogram()
+        # 上一次 roll 時的計數，算區間差用
+        self._inbound_prev: Dict[str, int] = {}
+        self._outbound_prev: Dict[str, int] = {}
+        self._rolled_at = time.time()
+
+    def count_inbound(self, msg_type: str) -> None:
+        self.inbound[msg_type] = self.inbound.get(msg_type, 0) + 1
+
+    def record_outbound(self, msg_type: str, started: float) -> None:
+        self.outbound[msg_type] = self.outbound.get(msg_type, 0) + 1
+        hist = self.fanout.get(msg_type)
+        if hist is None:
+            hist = LatencyHistogram()
+            self.fanout[msg_type] = hist
+        hist.observe(time.perf_counter() - started)
+
+    def record_global(self, recipients: int, seconds: float) -> None:
+        self.global_events += 1
+        self.global_recipients += recipients
+        self.global_delivery.observe(seconds)
+
+    @staticmethod
+    def _rates(current: Dict[str, int], previous: Dict[str, int], elapsed: float) -> Dict[str, float]:
+        return {
+            msg_type: round((n - previous.get(msg_type, 0)) / elapsed, 2)
+            for msg_type, n in current.items()
+        }
+
+    def roll(self, now: float) -> None:
+        elapsed = now - self._rolled_at
+        if elapsed <= 0:
+            return
+        self.inbound_rate = self._rates(self.inbound, self._inbound_prev, elapsed)
+        self.outbound_rate = self._rates(self.outbound, self._outbound_prev, elapsed)
+        self._inbound_prev = dict(self.inbound)
+        self._outbound_prev = dict(self.outbound)
+        self._rolled_at = now
+
+    def snapshot(self) -> dict:
+        return {
+            "inbound_per_second": dict(self.inbound_rate),
+            "outbound_per_second": dict(self.outbound_rate),
+            "inbound_total": dict(self.inbound),
+            "outbound_total": dict(self.outbound),
+            "fanout_latency_ms": {t: h.snapshot() for t, h in self.fanout.items()},
+            "global_channel": {
+                "events": self.global_events,
+                "recipients": self.global_recipients,
+                "delivery_latency_ms": self.global_delivery.snapshot(),
+            },
+        }
+
+
+class LoopLagStats(LatencyHistogram):
+    """event loop 延遲探針的結果；整個行程共用一個 loop，所以不分 shard。"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.last_ms = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.last_ms = seconds * 1000
+        self.observe(seconds)
+
+    def snapshot(self) -> dict:
+        return {"last": round(self.last_ms, 3), **super().snapshot()}
+
+
+loop_lag = LoopLagStats()
+
+
+# 目前正在處理的訊息 type；每條連線是自己的 task，所以 handler 裡呼叫的廣播也看得到
+current_msg_type: contextvars.ContextVar[str] = contextvars.ContextVar("current_msg_type", default="background")
+
+
+class HandlerProfiler:
+    """
+    剖析模式打開時，記錄每個 handler / 廣播函式的呼叫次數和 wall time（含裡面 await 的時間），
+    單次超過 slow_ms 的另外留下來（最近 100 筆）並寫 SLOW_HANDLER log。關掉時只多一次 bool 判斷。
+    """
+
+    def __init__(self, slow_ms: float, enabled: bool) -> None:
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        # name -> [count, total_seconds, max_seconds]
+        self.stats: Dict[str, List[float]] = {}
+        self.slow: deque = deque(maxlen=100)
+        self.enabled_since = time.time() if enabled else None
+        # 同一時間只跑一個 stack 取樣
+        self.sampling = False
+
+    def set_enabled(self, enabled: bool) -> None:
+        if enabled and not self.enabled:
+            self.enabled_since = time.time()
+        self.enabled = enabled
+
+    def reset(self) -> None:
+        self.stats.clear()
+        self.slow.clear()
+        if self.enabled:
+            self.enabled_since = time.time()
+
+    def record(self, name: str, seconds: float, user_id: int | None = None) -> None:
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = [0, 0.0, 0.0]
+            self.stats[name] = stats
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds > stats[2]:
+            stats[2] = seconds
+        ms = seconds * 1000
+        if ms >= self.slow_ms:
+            msg_type = current_msg_type.get()
+            self.slow.append(
+                {"at": time.time(), "handler": name, "msg_type": msg_type, "user_id": user_id, "ms": round(ms, 3)}
+            )
+            log("SLOW_HANDLER", f"{name} 處理 type={msg_type} (user_id={user_id}) 花了 {ms:.1f}ms")
+
+    def snapshot(self) -> dict:
+        handlers = {}
+        for name, (count, total, worst) in sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True):
+            handlers[name] = {
+                "count": int(count),
+                "total_ms": round(total * 1000, 3),
+                "avg_ms": round(total * 1000 / count, 3) if count else 0.0,
+                "max_ms": round(worst * 1000, 3),
+            }
+        return {
+            "enabled": self.enabled,
+            "enabled_since": self.enabled_since,
+            "slow_threshold_ms": self.slow_ms,
+            "handlers": handlers,
+            "slow": list(self.slow),
+        }
+
+
+profiler = HandlerProfiler(SLOW_HANDLER_MS, PROFILE_ENABLED)
+
+
+def profiled(func):
+    """廣播這類會在 handler 裡面被呼叫的函式用：剖析模式打開時也單獨計時。"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not profiler.enabled:
+            return await func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            profiler.record(name, time.perf_counter() - started)
+
+    return wrapper
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> str:
+    """
+    在另一個 thread 裡每 interval 秒看一次 event loop thread 的 call stack，
+    輸出 flamegraph.pl / speedscope 吃的 folded 格式：每行 "外層;...;內層 次數"。
+    loop 閒著的時候會停在 select，那一塊就是 idle 的比例。
+    """
+    counts: Dict[str, int] = {}
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            folded = ";".join(reversed(stack))
+            counts[folded] = counts.get(folded, 0) + 1
+        time.sleep(interval)
+    return "".join(f"{folded} {n}\n" for folded, n in sorted(counts.items(), key=lambda item: -item[1]))
+
+
+class InboundLimiter:
+    """每條連線、每種訊息 type 的 token bucket；被擋掉的訊息依 type 計數。"""
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], default: Tuple[float, float]) -> None:
+        self.limits = limits
+        self.default = default
+        # (server_id, user_id) -> type -> [剩餘 token, 上次補充時間]
+        self.buckets: Dict[UserKey, Dict[str, List[float]]] = {}
+        self.throttled: Dict[str, int] = {}
+
+    def allow(self, key: UserKey, msg_type: str, now: float) -> bool:
+        # type 是前端給的任意字串：沒設定限流、也沒有 handler 的 type 全部共用一個 default bucket，
+        # 不然一條連線換著 type 名稱送就能無限長出 bucket / throttled 計數
+        if msg_type not in self.limits and msg_type not in MESSAGE_ROUTES:
+            msg_type = "default"
+        rate, burst = self.limits.get(msg_type, self.default)
+        conn_buckets = self.buckets.get(key)
+        if conn_buckets is None:
+            conn_buckets = {}
+            self.buckets[key] = conn_buckets
+        bucket = conn_buckets.get(msg_type)
+        if bucket is None:
+            bucket = [burst, now]
+            conn_buckets[msg_type] = bucket
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return True
+        self.throttled[msg_type] = self.throttled.get(msg_type, 0) + 1
+        return False
+
+    def forget(self, key: UserKey) -> None:
+        self.buckets.pop(key, None)
+
+
+class SpatialGrid:
+    """
+    均勻格子空間索引：
+    - 依座標把 user_id 放進 cell_size 大小的格子
+    - 查詢某點附近的玩家時只掃描覆蓋半徑的那幾格，不用掃整個大廳
+    """
+
+    def __init__(self, cell_size: float) -> None:
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Set[int]] = {}
+        self.positions: Dict[int, Tuple[float, float]] = {}
+
+    def _cell_of(self, x: float, y: float) -> Tuple[int, int]:
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def _remove_from_cell(self, cell: Tuple[int, int], user_id: int) -> None:
+        bucket = self.cells.get(cell)
+        if bucket is None:
+            return
+        bucket.discard(user_id)
+        if not bucket:
+            del self.cells[cell]
+
+    def upsert(self, user_id: int, x: float, y: float) -> None:
+        new_cell = self._cell_of(x, y)
+        old_pos = self.positions.get(user_id)
+        if old_pos is not None:
+            old_cell = self._cell_of(*old_pos)
+            if old_cell != new_cell:
+                self._remove_from_cell(old_cell, user_id)
+                self.cells.setdefault(new_cell, set()).add(user_id)
+        else:
+            self.cells.setdefault(new_cell, set()).add(user_id)
+        self.positions[user_id] = (x, y)
+
+    def remove(self, user_id: int) -> None:
+        old_pos = self.positions.pop(user_id, None)
+        if old_pos is not None:
+            self._remove_from_cell(self._cell_of(*old_pos), user_id)
+
+    def query(
+        self,
+        x: float,
+        y: float,
+        radius: float,
+        exclude: int | None = None,
+    ) -> Set[int]:
+        min_cx, min_cy = self._cell_of(x - radius, y - radius)
+        max_cx, max_cy = self._cell_of(x + radius, y + radius)
+        radius_sq = radius * radius
+        found: Set[int] = set()
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                bucket = self.cells.get((cx, cy))
+                if not bucket:
+                    continue
+                for uid in bucket:
+                    if uid == exclude:
+                        continue
+                    px, py = self.positions[uid]
+                    dx = px - x
+                    dy = py - y
+                    if dx * dx + dy * dy <= radius_sq:
+                        found.add(uid)
+        return found
+
+
+class LobbyLog:
+    """
+    單一 server 的大廳變動紀錄：
+    - version 每次有玩家狀態變動（加入、移動、狀態、離開）就 +1
+    - changed_at 每個玩家只記最後一次變動的版本（依版本排序），一直移動的人也只佔一格；
+      補差異時直接拿玩家「現在」的狀態，不用存舊內容
+    - 記的玩家超過 capacity 就丟掉最久沒變動的，floor 是丟掉的最新版本，比它舊的只能給完整快照
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.version = 0
+        self.capacity = capacity
+        self.changed_at: Dict[int, int] = {}
+        self.floor = 0
+
+    def record(self, user_id: int) -> int:
+        self.version += 1
+        # 先拿掉再放回去，dict 的順序就一直是依版本排好的
+        self.changed_at.pop(user_id, None)
+        self.changed_at[user_id] = self.version
+        if len(self.changed_at) > self.capacity:
+            oldest = next(iter(self.changed_at))
+            self.floor = self.changed_at.pop(oldest)
+        return self.version
+
+    def changed_since(self, since_version: int) -> Set[int] | None:
+        """since_version 之後有變動的 user_id；比 floor 舊（或版本不合理）回 None。"""
+        if since_version > self.version or since_version < 0:
+            return None
+        if since_version == self.version:
+            return set()
+        if since_version < self.floor:
+            return None
+        changed: Set[int] = set()
+        for user_id in reversed(self.changed_at):
+            if self.changed_at[user_id] <= since_version:
+                break
+            changed.add(user_id)
+        return changed
+
+
+class ChatApprovalStore:
+    """
+    聊天許可表：
+    - 依 server_id 分開存，每個玩家記一份「已同意的對象 -> 同意時間」
+    - 玩家離線時只要看他自己的鄰接表就能把相關配對全部清掉
+    - 超過 ttl 的配對視為過期
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.adjacency: Dict[str, Dict[int, Dict[int, float]]] = {}
+
+    def approve(self, server_id: str, user1_id: int, user2_id: int, now: float) -> None:
+        server_adj = self.adjacency.setdefault(server_id, {})
+        server_adj.setdefault(user1_id, {})[user2_id] = now
+        server_adj.setdefault(user2_id, {})[user1_id] = now
+
+    def is_approved(self, server_id: str, user1_id: int, user2_id: int, now: float) -> bool:
+        peers = self.adjacency.get(server_id, {}).get(user1_id)
+        if not peers:
+            return False
+        approved_at = peers.get(user2_id)
+        if approved_at is None:
+            return False
+        if now - approved_at > self.ttl:
+            self.revoke(server_id, user1_id, user2_id)
+            return False
+        return True
+
+    def revoke(self, server_id: str, user1_id: int, user2_id: int) -> None:
+        server_adj = self.adjacency.get(server_id)
+        if not server_adj:
+            return
+        for a, b in ((user1_id, user2_id), (user2_id, user1_id)):
+            peers = server_adj.get(a)
+            if peers is None:
+                continue
+            peers.pop(b, None)
+            if not peers:
+                del server_adj[a]
+
+    def drop_user(self, server_id: str, user_id: int) -> int:
+        """移除某玩家的所有配對，回傳移除了幾組。"""
+        server_adj = self.adjacency.get(server_id)
+        if not server_adj:
+            return 0
+        peers = server_adj.pop(user_id, None)
+        if not peers:
+            return 0
+        for peer_id in peers:
+            peer_peers = server_adj.get(peer_id)
+            if peer_peers is None:
+                continue
+            peer_peers.pop(user_id, None)
+            if not peer_peers:
+                del server_adj[peer_id]
+        return len(peers)
+
+    def prune(self, now: float) -> int:
+        """清掉所有過期配對，回傳清掉幾組。"""
+        removed = 0
+        for server_id, server_adj in list(self.adjacency.items()):
+            for user_id, peers in list(server_adj.items()):
+                for peer_id, approved_at in list(peers.items()):
+                    if user_id < peer_id and now - approved_at > self.ttl:
+                        self.revoke(server_id, user_id, peer_id)
+                        removed += 1
+            if not server_adj:
+                del self.adjacency[server_id]
+        return removed
+
+    def pair_count(self, server_id: str | None = None) -> int:
+        servers = [server_id] if server_id is not None else list(self.adjacency)
+        total = 0
+        for sid in servers:
+            for peers in self.adjacency.get(sid, {}).values():
+                total += len(peers)
+        return total // 2
+
+    def user_count(self, server_id: str | None = None) -> int:
+        if server_id is not None:
+            return len(self.adjacency.get(server_id, {}))
+        return sum(len(server_adj) for server_adj in self.adjacency.values())
+
+
+class QueueWaitHistogram(LatencyHistogram):
+    """配對佇列的排隊時間，分桶比 RPC 延遲粗（秒等級）。"""
+
+    BOUNDS_MS = (100, 500, 1000, 2000, 5000, 10000, 30000, 60000, 120000, 300000)
+
+
+class MatchQueue:
+    """
+    一個 server 的對戰配對佇列，依積分分桶：
+    - scores：目前有人在排的積分，排好序（bisect 找最接近的積分 O(log 不同積分數)）
+    - buckets：積分 -> {user_id: 排入時間}，同分的先來先配（dict 保持插入順序）
+    - entries：user_id -> (積分, 排入時間)，依排入順序，離開佇列時 O(1) 找到桶
+    只有一個桶新增 / 清空時才動到 scores，同分的人再多也不會變慢。
+    """
+
+    def __init__(self) -> None:
+        self.scores: List[int] = []
+        self.buckets: Dict[int, Dict[int, float]] = {}
+        self.entries: Dict[int, Tuple[int, float]] = {}
+        self.matched = 0
+        self.removed: Dict[str, int] = {}
+        self.wait = QueueWaitHistogram()
+        self.last_tick_ms = 0.0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.entries
+
+    def add(self, user_id: int, score: int, now: float) -> bool:
+        """已經在排就不動（保留原本的排入時間），回傳 False。"""
+        if user_id in self.entries:
+            return False
+        bucket = self.buckets.get(score)
+        if bucket is None:
+            bucket = self.buckets[score] = {}
+            bisect.insort(self.scores, score)
+        bucket[user_id] = now
+        self.entries[user_id] = (score, now)
+        return True
+
+    def remove(self, user_id: int, reason: str | None = None) -> Tuple[int, float] | None:
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return None
+        score = entry[0]
+        bucket = self.buckets[score]
+        del bucket[user_id]
+        if not bucket:
+            del self.buckets[score]
+            del self.scores[bisect.bisect_left(self.scores, score)]
+        if reason is not None:
+            self.removed[reason] = self.removed.get(reason, 0) + 1
+        return entry
+
+    def closest(self, user_id: int) -> int | None:
+        """積分最接近的另一位；一樣近就配等比較久的。"""
+        score = self.entries[user_id][0]
+        for other in self.buckets[score]:
+            if other != user_id:
+                return other
+
+        idx = bisect.bisect_left(self.scores, score)
+        best: Tuple[int, float, int] | None = None
+        for neighbor in (idx - 1, idx + 1):
+            if 0 <= neighbor < len(self.scores):
+                bucket = self.buckets[self.scores[neighbor]]
+                other = next(iter(bucket))
+                candidate = (abs(self.scores[neighbor] - score), bucket[other], other)
+                if best is None or candidate < best:
+                    best = candidate
+        return best[2] if best is not None else None
+
+    def pair(self, now: float) -> List[Tuple[int, int]]:
+        """依排入順序，每個人配給積分最接近的人，配到的兩個人移出佇列。"""
+        pairs: List[Tuple[int, int]] = []
+        for user_id in list(self.entries):
+            if user_id not in self.entries or len(self.entries) < 2:
+                continue
+            other = self.closest(user_id)
+            if other is None:
+                continue
+            for uid in (user_id, other):
+                _, enqueued_at = self.remove(uid)
+                self.wait.observe(now - enqueued_at)
+            pairs.append((user_id, other))
+        self.matched += len(pairs)
+        return pairs
+
+    def snapshot(self, now: float) -> dict:
+        oldest = next(iter(self.entries.values()), None)
+        return {
+            "queued": len(self.entries),
+            "distinct_scores": len(self.scores),
+            "matched_pairs": self.matched,
+            "removed": dict(self.removed),
+            "oldest_wait_s": round(now - oldest[1], 3) if oldest else 0.0,
+            "last_tick_ms": round(self.last_tick_ms, 3),
+            "wait": self.wait.snapshot(),
+        }
+
+
+# =========================================================
+# Backplane：一個邏輯伺服器跨多個 worker 行程
+# 每個 worker 都有整個大廳的副本（玩家狀態 / 位置、對戰房間在哪個 worker、聊天配對），
+# 連線只在自己身上；要送給別的 worker 上的玩家就丟到 backplane，由那個 worker 送
+# =========================================================
+
+BackplaneHandler = Callable[[dict], Awaitable[None]]
+
+
+class Backplane:
+    """
+    worker 之間的 pub/sub 介面：訊息是 JSON 物件，同一個 worker 送出的訊息，其他 worker 收到的順序不變。
+    distributed = False 代表只有一個行程，ConnectionManager 完全不會 publish。
+    """
+
+    distributed = False
+
+    def __init__(self) -> None:
+        self.handlers: Dict[str, BackplaneHandler] = {}
+        # 連上（或重連上）之後要做的事：重新公告自己身上的玩家
+        self.on_connect: Callable[[], None] | None = None
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+
+    def subscribe(self, channel: str, handler: BackplaneHandler) -> None:
+        self.handlers[channel] = handler
+
+    def publish(self, channel: str, message: dict) -> None:
+        raise NotImplementedError
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def dispatch(self, channel: str, message: dict) -> None:
+        handler = self.handlers.get(channel)
+        if handler is None:
+            return
+        self.received += 1
+        try:
+            await handler(message)
+        except Exception as exc:
+            log("BACKPLANE_ERROR", f"處理 channel={channel} op={message.get('op')} 失敗：{exc!r}")
+
+    def snapshot(self) -> dict:
+        return {
+            "type": type(self).__name__,
+            "worker_id": WORKER_ID,
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+        }
+
+
+class InMemoryBackplane(Backplane):
+    """單一行程用：publish 排進 queue，由一個 task 依序交給同一個行程裡的訂閱者。"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.queue: asyncio.Queue | None = None
+        self.task: asyncio.Task | None = None
+
+    def publish(self, channel: str, message: dict) -> None:
+        if self.queue is None or channel not in self.handlers:
+            return
+        self.published += 1
+        self.queue.put_nowait((channel, message))
+
+    async def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._pump())
+
+    async def _pump(self) -> None:
+        while True:
+            channel, message = await self.queue.get()
+            await self.dispatch(channel, message)
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+
+class UnixSocketBackplane(Backplane):
+    """
+    接到本機的 ws-server/backplane_broker.py，一行一則：
+      SUB <channel>          訂閱
+      PUB <channel> <json>   發佈；broker 原封不動轉給其他訂閱這個 channel 的連線
+    斷線自動重連，斷線期間 publish 的訊息直接丟掉（計數），重連後由 on_connect 重新公告狀態。
+    """
+
+    distributed = True
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self.writer: asyncio.StreamWriter | None = None
+        self.task: asyncio.Task | None = None
+        self.connects = 0
+
+    def subscribe(self, channel: str, handler: BackplaneHandler) -> None:
+        super().subscribe(channel, handler)
+        if self.writer is not None:
+            self.writer.write(f"SUB {channel}\n".encode())
+
+    def publish(self, channel: str, message: dict) -> None:
+        writer = self.writer
+        if writer is None or writer.transport.get_write_buffer_size() > BACKPLANE_MAX_BUFFER:
+            self.dropped += 1
+            return
+        self.published += 1
+        body = json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+        writer.write(f"PUB {channel} {body}\n".encode())
+
+    async def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        delay = 0.5
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=BACKPLANE_MAX_LINE)
+            except OSError as exc:
+                log("BACKPLANE_CONNECT_ERROR", f"連不上 broker {self.path}（{exc!r}），{delay:.1f} 秒後重試")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+                continue
+            delay = 0.5
+            for channel in self.handlers:
+                writer.write(f"SUB {channel}\n".encode())
+            self.writer = writer
+            self.connects += 1
+            log("BACKPLANE_CONNECTED", f"已連上 broker {self.path}，worker={WORKER_ID}")
+            if self.on_connect is not None:
+                self.on_connect()
+            try:
+                await self._read_loop(reader)
+            except (OSError, ValueError) as exc:
+                log("BACKPLANE_DISCONNECTED", f"broker 連線中斷：{exc!r}")
+            else:
+                log("BACKPLANE_DISCONNECTED", "broker 關閉了連線")
+            finally:
+                self.writer = None
+                writer.close()
+
+    async def _read_loop(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                _, channel, body = line.decode().split(" ", 2)
+                message = json.loads(body)
+            except ValueError:
+                log("BACKPLANE_ERROR", f"broker 送來格式錯誤的一行：{line[:200]!r}")
+                continue
+            await self.dispatch(channel, message)
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    def snapshot(self) -> dict:
+        return {**super().snapshot(), "path": self.path, "connected": self.writer is not None, "connects": self.connects}
+
+
+def make_backplane(url: str) -> Backplane:
+    if url.startswith("unix:"):
+        return UnixSocketBackplane(url[len("unix:"):])
+    return InMemoryBackplane()
+
+
+# =========================================================
+# 對戰結果回報 backend
+# handler 只把結果交給 battle_reporter（不等網路），背景 task 先寫進本機檔案再送出
+# =========================================================
+
+class BattleReportQueue:
+    """
+    本機 append-only 檔，一行一筆：{"op": "add", "key": ..., "report": {...}} 或 {"op": "ack", "key": ...}。
+    啟動時重播一次，add 了還沒 ack 的就是要重送的；ack 的行數多了就整理成只剩待送的。
+    一個檔案只給一個行程用（flock），同一台機器多個 worker 會各自拿 path、path.1、path.2 ...
+    這個 class 的方法都是同步 I/O，由 BattleReporter 丟到 thread 執行。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.base_path = path
+        self.path = path
+        # dict 保持插入順序，也就是送出順序
+        self.pending: Dict[str, dict] = {}
+        self.lines = 0
+        self.file = None
+        self.lock_file = None
+
+    def open(self) -> None:
+        os.makedirs(os.path.dirname(self.base_path) or ".", exist_ok=True)
+        slot = 0
+        while True:
+            path = self.base_path if slot == 0 else f"{self.base_path}.{slot}"
+            lock_file = open(path + ".lock", "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                lock_file.close()
+                slot += 1
+        self.path = path
+        self.lock_file = lock_file
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 寫到一半當掉的最後一行
+                    if record.get("op") == "add":
+                        self.pending[record["key"]] = record["report"]
+                    else:
+                        self.pending.pop(record.get("key"), None)
+        # 順便整理掉已經 ack 的，也把可能殘缺的最後一行去掉
+        self.compact(list(self.pending.items()))
+
+    def append(self, records: List[dict]) -> None:
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.lines += len(records)
+
+    def compact(self, items: List[Tuple[str, dict]]) -> None:
+        """items 是呼叫端在 event loop 裡先拍好的 pending 快照，這裡在 thread 裡跑。"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, report in items:
+                f.write(json.dumps({"op": "add", "key": key, "report": report}, ensure_ascii=False, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.lines = len(items)
+
+    def needs_compact(self) -> bool:
+        return self.lines >= 1000 and self.lines > 4 * len(self.pending)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class BattleReporter:
+    """
+    submit() 同步、不做 I/O：結果放進待送清單，叫醒背景 task。
+    背景 task：先把新結果寫進 BattleReportQueue（fsync 完才送），再用共用的 keep-alive client 送出；
+    只有一筆就打 /api/battle/result，積壓時一次最多 BATTLE_REPORT_BATCH 筆打 /api/battle/results。
+    backend 連不上 / 5xx 就指數退避重試；回 4xx 或 success=false 代表重送也沒用，記 log 後丟掉。
+    backend 用 battle_key 去重，重送不會多算一場。
+    """
+
+    def __init__(self) -> None:
+        self.queue: BattleReportQueue | None = None
+        self.client: httpx.AsyncClient | None = None
+        self.task: asyncio.Task | None = None
+        self.wakeup = asyncio.Event()
+        # 還沒寫進檔案的紀錄
+        self.unsaved: List[dict] = []
+        self.submitted = 0
+        self.sent = 0
+        self.batches = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.failures = 0
+        self.last_error = ""
+        self.send_latency = LatencyHistogram()
+
+    async def start(self, client: httpx.AsyncClient, path: str) -> None:
+        self.queue = BattleReportQueue(path)
+        await asyncio.to_thread(self.queue.open)
+        self.client = client
+        self.task = asyncio.create_task(self._run())
+        if self.queue.pending:
+            # 上次沒送完的，啟動就開始補送
+            self.wakeup.set()
+        log("BATTLE_REPORT", f"queue={self.queue.path}, 待補送 {len(self.queue.pending)} 筆")
+
+    def submit(self, server_id: str, battle_id: str, report: dict) -> None:
+        if self.queue is None:
+            return
+        key = f"{server_id}:{battle_id}"
+        report = {**report, "server_id": server_id, "battle_key": key}
+        pending = self.queue.pending
+        if key in pending:
+            return
+        pending[key] = report
+        self.unsaved.append({"op": "add", "key": key, "report": report})
+        self.submitted += 1
+        while len(pending) > BATTLE_REPORT_MAX_PENDING:
+            oldest = next(iter(pending))
+            del pending[oldest]
+            self.unsaved.append({"op": "ack", "key": oldest})
+            self.dropped += 1
+            log("BATTLE_REPORT_DROPPED", f"待送超過 {BATTLE_REPORT_MAX_PENDING} 筆，丟掉最舊的 {oldest}")
+        self.wakeup.set()
+
+    async def _flush(self, acks: List[dict] | None = None) -> None:
+        """把還沒寫檔的新結果（和這次送完的 ack）寫進檔案；失敗就放回去，下次再寫。"""
+        records = self.unsaved + (acks or [])
+        self.unsaved = []
+        if not records:
+            return
+        try:
+            await asyncio.to_thread(self.queue.append, records)
+        except OSError:
+            self.unsaved = records + self.unsaved
+            raise
+        if self.queue.needs_compact():
+            await asyncio.to_thread(self.queue.compact, list(self.queue.pending.items()))
+
+    async def _run(self) -> None:
+        delay = 0.0
+        retry_at = 0.0
+        while True:
+            timeout = max(retry_at - time.monotonic(), 0.0) if retry_at else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self._flush()
+                if time.monotonic() < retry_at:
+                    # 退避中：新結果只先寫檔，時間到才送
+                    continue
+                while self.queue.pending:
+                    batch = list(self.queue.pending.items())[:BATTLE_REPORT_BATCH]
+                    done = await self._send(batch)
+                    for key in done:
+                        self.queue.pending.pop(key, None)
+                    await self._flush([{"op": "ack", "key": key} for key in done])
+                delay = 0.0
+                retry_at = 0.0
+            except (httpx.HTTPError, ValueError) as exc:
+                self.failures += 1
+                self.last_error = repr(exc)
+                delay = min(max(delay * 2, BATTLE_REPORT_RETRY_MIN), BATTLE_REPORT_RETRY_MAX)
+                retry_at = time.monotonic() + delay
+                log(
+                    "BATTLE_REPORT_RETRY",
+                    f"送 backend 失敗：{exc!r}，{len(self.queue.pending)} 筆待送，{delay:.1f} 秒後重試",
+                )
+            except OSError as exc:
+                # 寫檔失敗：結果還在記憶體裡，等一下再寫
+                self.failures += 1
+                self.last_error = repr(exc)
+                retry_at = time.monotonic() + BATTLE_REPORT_RETRY_MAX
+                log("BATTLE_REPORT_IO_ERROR", f"寫 {self.queue.path} 失敗：{exc!r}")
+
+    async def _send(self, batch: List[Tuple[str, dict]]) -> List[str]:
+        """回傳這次處理完（成功或確定送不進去）的 key；要重試的情況丟例外。"""
+        started = time.perf_counter()
+        if len(batch) == 1:
+            response = await self.client.post("/api/battle/result", json=batch[0][1])
+        else:
+            response = await self.client.post("/api/battle/results", json={"results": [r for _, r in batch]})
+        if response.status_code >= 500 or response.status_code in (408, 429):
+            response.raise_for_status()
+        self.send_latency.observe(time.perf_counter() - started)
+        self.batches += 1
+        keys = [key for key, _ in batch]
+        if response.status_code >= 400:
+            self.rejected += len(keys)
+            log("BATTLE_REPORT_REJECTED", f"backend 回 {response.status_code}：{response.text[:200]}，丟掉 {keys}")
+            return keys
+        body = response.json()
+        results = (body.get("data") or {}).get("results") if len(batch) > 1 else None
+        if results is None:
+            # 單筆，或整批都被擋下來（success=false）
+            results = [body] * len(keys)
+        for key, result in zip(keys, results):
+            if result.get("success"):
+                self.sent += 1
+            else:
+                self.rejected += 1
+                log("BATTLE_REPORT_REJECTED", f"{key}：{result.get('error')}")
+        return keys
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.queue is not None:
+            if self.unsaved:
+                self.queue.append(self.unsaved)
+                self.unsaved = []
+            self.queue.close()
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.client is not None,
+            "queue_path": self.queue.path if self.queue else None,
+            "pending": len(self.queue.pending) if self.queue else 0,
+            "submitted": self.submitted,
+            "sent": self.sent,
+            "batches": self.batches,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "send_latency_ms": self.send_latency.snapshot(),
+        }
+
+
+class ChatWriter:
+    """
+    聊天紀錄寫回 backend 的 messages：handler 只 append 到 buffer，
+    背景 task 湊滿 CHAT_FLUSH_SIZE 筆、或最舊的一筆等了 CHAT_FLUSH_INTERVAL 就打一次 POST /api/chat/messages
+    （backend 那邊一次 multi-row INSERT）。聊天送達完全不等 DB。
+    backend 掛掉時這批放回 buffer 前面、指數退避重試；ws 重開時 buffer 裡的會掉（不像對戰結果有寫檔）。
+    """
+
+    def __init__(self) -> None:
+        self.client: httpx.AsyncClient | None = None
+        self.task: asyncio.Task | None = None
+        # (進 buffer 的時間 monotonic, 要寫的那一列)
+        self.buffer: deque = deque()
+        self.wakeup = asyncio.Event()
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failures = 0
+        self.last_error = ""
+        self.last_flush_size = 0
+        self.max_flush_size = 0
+        # 一次 POST 花多久；最舊的一筆從進 buffer 到寫進 DB 花多久
+        self.flush_latency = LatencyHistogram()
+        self.lag = LatencyHistogram()
+
+    def start(self, client: httpx.AsyncClient) -> None:
+        self.client = client
+        self.task = asyncio.create_task(self._run())
+
+    def submit(self, server_id: str, from_user_id: int, to_user_id: int, content: str) -> None:
+        if self.client is None:
+            return
+        self.buffer.append((time.monotonic(), {
+            "server_id": server_id,
+            "from_user_id": from_user_id,
+            "to_user_id": to_user_id,
+            "content": content,
+            "created_at": time.time(),
+        }))
+        self._trim()
+        # 第一筆進來要開始計時；湊滿一批就馬上送
+        if len(self.buffer) == 1 or len(self.buffer) >= CHAT_FLUSH_SIZE:
+            self.wakeup.set()
+
+    def _trim(self) -> None:
+        while len(self.buffer) > CHAT_BUFFER_MAX:
+            self.buffer.popleft()
+            self.dropped += 1
+            log("CHAT_PERSIST_DROPPED", f"待寫的聊天超過 {CHAT_BUFFER_MAX} 筆，丟掉最舊的")
+
+    async def _run(self) -> None:
+        delay = 0.0
+        while True:
+            if delay:
+                await asyncio.sleep(delay)
+            elif len(self.buffer) < CHAT_FLUSH_SIZE:
+                timeout = CHAT_FLUSH_INTERVAL - (time.monotonic() - self.buffer[0][0]) if self.buffer else None
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            self.wakeup.clear()
+            if not self.buffer:
+                continue
+            if not delay and len(self.buffer) < CHAT_FLUSH_SIZE and time.monotonic() - self.buffer[0][0] < CHAT_FLUSH_INTERVAL:
+                # 第一筆剛進來：回去照它的時間重新等
+                continue
+            try:
+                await self.flush()
+                delay = 0.0
+            except (httpx.HTTPError, ValueError) as exc:
+                self.failures += 1
+                self.last_error = repr(exc)
+                delay = min(max(delay * 2, BATTLE_REPORT_RETRY_MIN), BATTLE_REPORT_RETRY_MAX)
+                log("CHAT_PERSIST_RETRY", f"寫聊天紀錄失敗：{exc!r}，{len(self.buffer)} 筆待寫，{delay:.1f} 秒後重試")
+
+    async def flush(self) -> None:
+        batch = [self.buffer.popleft() for _ in range(min(len(self.buffer), CHAT_FLUSH_SIZE))]
+        started = time.perf_counter()
+        try:
+            response = await self.client.post("/api/chat/messages", json={"messages": [row for _, row in batch]})
+            if response.status_code >= 500 or response.status_code in (408, 429):
+                response.raise_for_status()
+        except httpx.HTTPError:
+            # 放回前面，下次照原本順序再送
+            self.buffer.extendleft(reversed(batch))
+            self._trim()
+            raise
+        now = time.monotonic()
+        if response.status_code >= 400:
+            self.rejected += len(batch)
+            log("CHAT_PERSIST_REJECTED", f"backend 回 {response.status_code}：{response.text[:200]}，丟掉 {len(batch)} 筆")
+            return
+        self.flush_latency.observe(time.perf_counter() - started)
+        self.lag.observe(now - batch[0][0])
+        self.flushes += 1
+        self.written += len(batch)
+        self.last_flush_size = len(batch)
+        self.max_flush_size = max(self.max_flush_size, len(batch))
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        # 關機前盡量把剩下的寫掉，backend 不通就算了
+        try:
+            while self.buffer and self.client is not None:
+                await asyncio.wait_for(self.flush(), BACKEND_TIMEOUT)
+        except (httpx.HTTPError, ValueError, asyncio.TimeoutError) as exc:
+            log("CHAT_PERSIST_RETRY", f"關機時寫聊天紀錄失敗：{exc!r}，丟掉 {len(self.buffer)} 筆")
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.client is not None,
+            "buffered": len(self.buffer),
+            "oldest_buffered_ms": round((time.monotonic() - self.buffer[0][0]) * 1000, 1) if self.buffer else 0.0,
+            "written": self.written,
+            "flushes": self.flushes,
+            "avg_flush_size": round(self.written / self.flushes, 1) if self.flushes else 0.0,
+            "last_flush_size": self.last_flush_size,
+            "max_flush_size": self.max_flush_size,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "flush_latency_ms": self.flush_latency.snapshot(),
+            "lag_ms": self.lag.snapshot(),
+        }
+
+
+class PetStateCache:
+    """
+    整個行程共用的寵物 energy / score / status（user_id 在 A/B/C 之間不會重複），值都是 backend 給的。
+    - join_lobby 時在背景載入；同時有好幾個人要載就一起送一次 POST /api/pet/states（single-flight）
+    - backend 改到寵物時推到 "pet:<server_id>"，收到直接覆蓋（push invalidation）
+    - 體力檢查只查 dict，O(1)、不打 HTTP；還沒載到（backend 連不上）就當作不知道，
+      大廳裡的值是客戶端帶來的，不拿來判斷能不能聊天 / 對戰
+    載到的新值會順便寫回這個 worker 自己的大廳玩家（別的 worker 的玩家由他自己的 worker 更新、同步過來）。
+    """
+
+    def __init__(self) -> None:
+        self.client: httpx.AsyncClient | None = None
+        # None = backend 沒有這個人的寵物（測試帳號），體力一樣當作不知道
+        self.entries: Dict[int, Tuple[int, int, str] | None] = {}
+        self.inflight: Dict[int, asyncio.Task] = {}
+        self.retry_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.pushes = 0
+        self.failures = 0
+        self.last_error = ""
+        self.load_latency = LatencyHistogram()
+        # backend commit 完推出來 → 這裡收到
+        self.push_latency = LatencyHistogram()
+
+    def start(self, client: httpx.AsyncClient) -> None:
+        self.client = client
+
+    def get(self, user_id: int) -> Tuple[int, int, str] | None:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def energy(self, user_id: int) -> int | None:
+        """backend 給的體力；不知道就回 None，呼叫端要拒絕，不能退回客戶端帶的值。"""
+        entry = self.get(user_id)
+        return None if entry is None else entry[0]
+
+    def _start_load(self, user_ids) -> Set[asyncio.Task]:
+        """還沒在快取、也還沒在載的人開一個 load；回傳這些人要等的 task。"""
+        missing = [uid for uid in user_ids if uid not in self.entries]
+        if not missing or self.client is None or time.monotonic() < self.retry_at:
+            return set()
+        new = [uid for uid in missing if uid not in self.inflight]
+        if new:
+            task = asyncio.create_task(self.load(new))
+            for uid in new:
+                self.inflight[uid] = task
+            task.add_done_callback(functools.partial(self._load_done, new))
+        return {self.inflight[uid] for uid in missing}
+
+    def prefetch(self, user_id: int) -> None:
+        """join 時呼叫：不等它，載到了會自己寫回大廳玩家。"""
+        self._start_load((user_id,))
+
+    async def ensure(self, user_ids) -> None:
+        """確定這些人都在快取裡；已經在的話什麼都不做（不 await 任何東西）。"""
+        tasks = self._start_load(user_ids)
+        if tasks:
+            # 用 wait 不用 gather：這條連線的 handler 被取消時，不能把別人也在等的 load 一起取消
+            await asyncio.wait(tasks)
+
+    def _load_done(self, user_ids: List[int], task: asyncio.Task) -> None:
+        for uid in user_ids:
+            if self.inflight.get(uid) is task:
+                del self.inflight[uid]
+
+    async def load(self, user_ids: List[int]) -> None:
+        started = time.perf_counter()
+        try:
+            response = await self.client.post("/api/pet/states", json={"user_ids": user_ids})
+            response.raise_for_status()
+            pets = response.json()["data"]
+        except (httpx.HTTPError, ValueError, KeyError, TypeError) as exc:
+            self.failures += 1
+            self.last_error = repr(exc)
+            self.retry_at = time.monotonic() + PET_CACHE_RETRY
+            log("PET_CACHE_LOAD_ERROR", f"載入 {len(user_ids)} 人的寵物狀態失敗：{exc!r}，{PET_CACHE_RETRY:.0f} 秒內要看體力的動作一律拒絕")
+            return
+        self.load_latency.observe(time.perf_counter() - started)
+        self.loads += 1
+        for user_id in user_ids:
+            self.entries.setdefault(user_id, None)
+        changed: List[Tuple[str, LobbyPlayer, int]] = []
+        for pet in pets:
+            changed += self.apply(pet["user_id"], pet["energy"], pet["score"], pet["status"])
+        # join 時客戶端帶的值和 backend 不一樣 → 馬上更正給看得到他的人
+        await broadcast_pet_changes(changed)
+
+    def apply(self, user_id: int, energy: int, score: int, status: str) -> List[Tuple[str, LobbyPlayer, int]]:
+        """寫進快取，再寫回這個 worker 身上的大廳玩家；回傳真的有變的 (shard_id, player, version)。"""
+        self.entries[user_id] = (energy, score, status)
+        changed: List[Tuple[str, LobbyPlayer, int]] = []
+        for shard_id, manager in shards.items():
+            player = manager.get_player_state(shard_id, user_id)
+            if player is None or (shard_id, user_id) in manager.remote_users:
+                continue
+            if (player.energy, player.score, player.status) == (energy, score, status):
+                continue
+            player.energy, player.score, player.status = energy, score, status
+            changed.append((shard_id, player, manager.touch_lobby_player(shard_id, user_id)))
+        return changed
+
+    def add_score(self, user_id: int, delta: int) -> None:
+        """對戰贏了先在本地加分，backend 寫完後推回來的才是準的。"""
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            self.entries[user_id] = (entry[0], entry[1] + delta, entry[2])
+
+    def overlay(self, player: LobbyPlayer) -> None:
+        """客戶端帶來的 energy / score / status 換成快取裡的。"""
+        entry = self.get(player.user_id)
+        if entry is not None:
+            player.energy, player.score, player.status = entry
+
+    async def refresh(self) -> None:
+        """整批重抓所有大廳裡的人，順便把已經不在任何大廳的人清出快取。"""
+        user_ids: Set[int] = set()
+        for shard_id, manager in shards.items():
+            user_ids.update(manager.lobby_player_states.get(shard_id, {}))
+        for user_id in [uid for uid in self.entries if uid not in user_ids]:
+            del self.entries[user_id]
+        if self.client is None or time.monotonic() < self.retry_at:
+            return
+        ordered = sorted(user_ids)
+        for i in range(0, len(ordered), PET_CACHE_BATCH):
+            await self.load(ordered[i:i + PET_CACHE_BATCH])
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.client is not None,
+            "entries": len(self.entries),
+            "inflight": len(self.inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "pushes": self.pushes,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "load_latency_ms": self.load_latency.snapshot(),
+            "push_latency_ms": self.push_latency.snapshot(),
+        }
+
+
+# 對戰結果、聊天紀錄、寵物狀態共用一個 keep-alive 連線池，啟動時建立
+backend_client: httpx.AsyncClient | None = None
+battle_reporter = BattleReporter()
+chat_writer = ChatWriter()
+pet_cache = PetStateCache()
+
+
+def report_battle(room: BattleRoom, player1_score: int, player2_score: int, winner_user_id: int) -> None:
+    battle_reporter.submit(room.server_id, room.battle_id, {
+        "player1_id": room.player1_id,
+        "player2_id": room.player2_id,
+        "player1_score": player1_score,
+        "player2_score": player2_score,
+        # 0 = 平手；斷線判輸時勝方不一定分數比較高，所以直接帶 ws 判的結果
+        "winner_user_id": winner_user_id or None,
+    })
+
+
+class ConnectionManager:
+    def __init__(self) -> None:
+        self.active_connections: Dict[UserKey, WebSocket] = {}
+        self.lobby_users: Dict[str, Set[int]] = {}
+        self.lobby_player_states: Dict[str, Dict[int, LobbyPlayer]] = {}
+        # 每個 server 依 user_id 排好的名單，join 時不用每次重新 sort
+        self.lobby_order: Dict[str, List[int]] = {}
+        self.battles: Dict[str, BattleRoom] = {}
+        # (server_id, user_id) -> battle_id，斷線時 O(1) 找房間
+        self.user_battles: Dict[UserKey, str] = {}
+        # 上次轉送後分數有變的房間：battle_id -> 分數有變的玩家
+        self.dirty_battles: Dict[str, Set[int]] = {}
+        self.chat_approvals = ChatApprovalStore(CHAT_APPROVAL_TTL)
+        # battle_queue_join 的配對佇列：server_id -> MatchQueue
+        self.match_queues: Dict[str, MatchQueue] = {}
+        self.last_position_broadcast: Dict[UserKey, float] = {}
+        self.spatial_grids: Dict[str, SpatialGrid] = {}
+        # join_lobby 時協商用二進位協定的連線
+        self.binary_clients: Set[UserKey] = set()
+        # join_lobby 時表示能解 deflate 的連線
+        self.compression_clients: Set[UserKey] = set()
+        self.compression_stats = CompressionStats()
+        self.lobby_logs: Dict[str, LobbyLog] = {}
+        # 斷線但還在 grace 期的玩家：(server_id, user_id) -> 真正離開的時間點
+        self.pending_leaves: Dict[UserKey, float] = {}
+        # 可續連的 session：token -> (server_id, user_id)，反查用 session_tokens
+        self.sessions: Dict[str, UserKey] = {}
+        self.session_tokens: Dict[UserKey, str] = {}
+        # 最後一次收到這條連線任何訊息的時間，心跳用
+        self.last_seen: Dict[UserKey, float] = {}
+        # 被伺服器主動踢掉的次數：reason -> count
+        self.eviction_counts: Dict[str, int] = {}
+        self.inbound_limiter = InboundLimiter(RATE_LIMITS, DEFAULT_RATE_LIMIT)
+        # 每條連線還在 await 中的送出數，和等它降下來的讀取端
+        self.outbound_pending: Dict[UserKey, int] = {}
+        self.outbound_waiters: Dict[UserKey, asyncio.Event] = {}
+        self.read_pauses = 0
+        self.metrics = RuntimeMetrics()
+        self.backplane = make_backplane(BACKPLANE_URL)
+        # 連在其他 worker 上的玩家：(server_id, user_id) -> worker id
+        self.remote_users: Dict[UserKey, str] = {}
+        # 開在其他 worker 上的對戰房間：battle_id -> worker id，以及玩家 -> battle_id
+        self.remote_battles: Dict[str, str] = {}
+        self.remote_user_battles: Dict[UserKey, str] = {}
+
+    # ------------------ 基本連線管理 ------------------ #
+    def connect(self, server_id: str, user_id: int, websocket: WebSocket) -> WebSocket | None:
+        """
+        登記這個玩家目前的連線；同一個玩家已經有另一條連線時，新的取代舊的，
+        回傳被取代的舊連線讓呼叫端關掉（舊連線之後的斷線處理會因為不是 owner 而略過）。
+        """
+        key: UserKey = (server_id, user_id)
+        replaced = self.active_connections.get(key)
+        if replaced is websocket:
+            replaced = None
+        self.active_connections[key] = websocket
+        self.last_seen[key] = time.time()
+        # 從別的 worker 換過來的玩家：通知原本的 worker 放掉他（取消 grace、關掉重複登入的舊連線）
+        self.remote_users.pop(key, None)
+        self.publish(server_id, {"op": "claim", "user_id": user_id})
+        if server_id not in self.lobby_users:
+            self.lobby_users[server_id] = set()
+        self.lobby_users[server_id].add(user_id)
+        if replaced is not None:
+            self.eviction_counts["replaced"] = self.eviction_counts.get("replaced", 0) + 1
+            log("CONNECT_REPLACED", f"server={server_id}, user_id={user_id} 重複登入，舊連線會被關閉")
+        log("CONNECT", f"server={server_id}, user_id={user_id} 加入連線與大廳")
+        return replaced
+
+    def release_connection(self, server_id: str, user_id: int) -> None:
+        """只收掉連線本身的東西；大廳狀態、視野、聊天配對先留著等 grace 期。"""
+        key: UserKey = (server_id, user_id)
+        self.active_connections.pop(key, None)
+        if server_id in self.lobby_users:
+            self.lobby_users[server_id].discard(user_id)
+        self.last_position_broadcast.pop(key, None)
+        self.last_seen.pop(key, None)
+        self.binary_clients.discard(key)
+        self.compression_clients.discard(key)
+        self.inbound_limiter.forget(key)
+        waiter = self.outbound_waiters.pop(key, None)
+        if waiter is not None:
+            waiter.set()
+
+    def drop_connection(self, server_id: str, user_id: int, websocket: WebSocket, reason: str) -> bool:
+        """
+        斷線、送訊失敗、心跳逾時共用的收尾：放掉連線，大廳狀態排進 grace 期等著離開。
+        只處理「目前登記的就是這條 websocket」的情況，同一條連線不會被收兩次。
+        """
+        key: UserKey = (server_id, user_id)
+        if self.active_connections.get(key) is not websocket:
+            return False
+        self.release_connection(server_id, user_id)
+        self.schedule_leave(server_id, user_id, time.time() + max(LOBBY_LEAVE_GRACE, 0.0))
+        if reason != "disconnect":
+            self.eviction_counts[reason] = self.eviction_counts.get(reason, 0) + 1
+            log("EVICT", f"server={server_id}, user_id={user_id}, reason={reason}，移除連線")
+        return True
+
+    def disconnect(self, server_id: str, user_id: int) -> None:
+        key: UserKey = (server_id, user_id)
+        self.release_connection(server_id, user_id)
+        self.pending_leaves.pop(key, None)
+        token = self.session_tokens.pop(key, None)
+        if token is not None:
+            self.sessions.pop(token, None)
+        self.remove_lobby_player(server_id, user_id)
+        log("DISCONNECT", f"server={server_id}, user_id={user_id} 離線並退出大廳")
+
+    def remove_lobby_player(self, server_id: str, user_id: int) -> None:
+        if server_id in self.lobby_player_states:
+            if self.lobby_player_states[server_id].pop(user_id, None) is not None:
+                order = self.lobby_order[server_id]
+                idx = bisect.bisect_left(order, user_id)
+                if idx < len(order) and order[idx] == user_id:
+                    del order[idx]
+        if server_id in self.spatial_grids:
+            self.spatial_grids[server_id].remove(user_id)
+        self.chat_approvals.drop_user(server_id, user_id)
+        if server_id in self.match_queues:
+            self.match_queues[server_id].remove(user_id, "LEFT_LOBBY")
+
+    def set_protocol(self, server_id: str, user_id: int, protocol: str) -> str:
+        key: UserKey = (server_id, user_id)
+        if protocol == PROTOCOL_BINARY:
+            self.binary_clients.add(key)
+            return PROTOCOL_BINARY
+        self.binary_clients.discard(key)
+        return PROTOCOL_JSON
+
+    def uses_binary(self, server_id: str, user_id: int) -> bool:
+        return (server_id, user_id) in self.binary_clients
+
+    def set_compression(self, server_id: str, user_id: int, compression: str) -> str:
+        key: UserKey = (server_id, user_id)
+        if compression == "deflate" and WS_COMPRESSION == "deflate":
+            self.compression_clients.add(key)
+            return "deflate"
+        self.compression_clients.discard(key)
+        return "off"
+
+    def compress_frame(self, text: str, msg_type: str) -> bytes | None:
+        """超過門檻的訊息壓成 op + zlib；太小或壓了沒變小就回 None，照原樣送文字。"""
+        if len(text) < COMPRESS_MIN_BYTES:
+            self.compression_stats.record(msg_type, len(text), len(text), 0.0)
+            return None
+        raw = text.encode("utf-8")
+        started = time.perf_counter()
+        packed = zlib.compress(raw, COMPRESS_LEVEL)
+        cpu_seconds = time.perf_counter() - started
+        if len(packed) + 1 >= len(raw):
+            self.compression_stats.record(msg_type, len(raw), len(raw), cpu_seconds)
+            return None
+        self.compression_stats.record(msg_type, len(raw), len(packed) + 1, cpu_seconds)
+        return bytes((BIN_OP_COMPRESSED,)) + packed
+
+    def get_online_users(self, server_id: str) -> List[int]:
+        return sorted(self.lobby_users.get(server_id, set()))
+
+    def get_ws(self, server_id: str, user_id: int):
+        return self.active_connections.get((server_id, user_id))
+
+    async def send_json(self, server_id: str, to_user_id: int, msg: dict) -> None:
+        text = json.dumps(msg, ensure_ascii=False)
+        await self.send_text(server_id, to_user_id, text, msg.get("type", "other"))
+
+    async def deliver(
+        self,
+        server_id: str,
+        user_id: int,
+        ws: WebSocket,
+        frame: str | bytes,
+        msg_type: str = "other",
+        started: float | None = None,
+    ) -> None:
+        """
+        所有送出都走這裡：記錄這條連線卡住的送出數（背壓用），送不出去就踢掉。
+        started 是這則訊息開始 fan-out 的 perf_counter，送完記進 /metrics 的延遲分佈。
+        """
+        if started is None:
+            started = time.perf_counter()
+        key: UserKey = (server_id, user_id)
+        self.outbound_pending[key] = self.outbound_pending.get(key, 0) + 1
+        try:
+            if isinstance(frame, bytes):
+                await ws.send_bytes(frame)
+            else:
+                await ws.send_text(frame)
+            self.metrics.record_outbound(msg_type, started)
+        except (RuntimeError, WebSocketDisconnect):
+            log("SEND_ERROR", f"server={server_id}, user_id={user_id} 傳送失敗，移除連線")
+            self.drop_connection(server_id, user_id, ws, "send_failed")
+        finally:
+            pending = self.outbound_pending.get(key, 1) - 1
+            if pending > 0:
+                self.outbound_pending[key] = pending
+            else:
+                self.outbound_pending.pop(key, None)
+            if pending <= OUTBOUND_PAUSE_AT // 2 and key in self.outbound_waiters:
+                self.outbound_waiters.pop(key).set()
+
+    async def wait_outbound_drained(self, server_id: str, user_id: int) -> None:
+        """讀取端在這裡等：送給這個玩家的訊息消化到一半以下（或連線被收掉）才繼續。"""
+        key: UserKey = (server_id, user_id)
+        if self.outbound_pending.get(key, 0) < OUTBOUND_PAUSE_AT:
+            return
+        waiter = self.outbound_waiters.get(key)
+        if waiter is None:
+            waiter = asyncio.Event()
+            self.outbound_waiters[key] = waiter
+        self.read_pauses += 1
+        await waiter.wait()
+
+    async def send_text(
+        self,
+        server_id: str,
+        to_user_id: int,
+        text: str,
+        msg_type: str = "other",
+        started: float | None = None,
+    ) -> None:
+        ws = self.get_ws(server_id, to_user_id)
+        if ws is None:
+            worker = self.remote_users.get((server_id, to_user_id))
+            if worker is not None:
+                self.relay(server_id, worker, [to_user_id], text, msg_type)
+            return
+        frame = None
+        if (server_id, to_user_id) in self.compression_clients:
+            frame = self.compress_frame(text, msg_type)
+        await self.deliver(
+            server_id, to_user_id, ws, frame if frame is not None else text, msg_type, started
+        )
+
+    async def send_bytes(
+        self,
+        server_id: str,
+        to_user_id: int,
+        data: bytes,
+        msg_type: str = "other",
+        started: float | None = None,
+    ) -> None:
+        ws = self.get_ws(server_id, to_user_id)
+        if ws is not None:
+            await self.deliver(server_id, to_user_id, ws, data, msg_type, started)
+
+    async def broadcast_in_server(
+        self,
+        server_id: str,
+        msg: dict,
+        exclude: int | None = None,
+    ) -> None:
+        for (sid, uid), ws in list(self.active_connections.items()):
+            if sid != server_id:
+                continue
+            if exclude is not None and uid == exclude:
+                continue
+            await self.deliver(sid, uid, ws, json.dumps(msg, ensure_ascii=False), msg.get("type", "other"))
+
+    async def send_to_users(self, server_id: str, user_ids, msg: dict) -> None:
+        """只送給指定的幾個玩家，訊息只 encode 一次。"""
+        if not user_ids:
+            return
+        text = json.dumps(msg, ensure_ascii=False)
+        await self.send_text_to_users(server_id, user_ids, text, msg.get("type", "other"))
+
+    @profiled
+    async def send_text_to_users(
+        self,
+        server_id: str,
+        user_ids,
+        text: str,
+        msg_type: str = "other",
+        relay: bool = True,
+    ) -> None:
+        """relay=False：其他 worker 轉過來的，只送給自己身上的連線，不再往外轉。"""
+        started = time.perf_counter()
+        # 壓縮版只在第一個需要的人出現時算一次
+        frame: bytes | None = None
+        compress_checked = False
+        remote: Dict[str, List[int]] | None = None
+        for uid in user_ids:
+            ws = self.get_ws(server_id, uid)
+            if ws is None:
+                worker = self.remote_users.get((server_id, uid)) if relay else None
+                if worker is not None:
+                    if remote is None:
+                        remote = {}
+                    remote.setdefault(worker, []).append(uid)
+                continue
+            if (server_id, uid) in self.compression_clients and not compress_checked:
+                frame = self.compress_frame(text, msg_type)
+                compress_checked = True
+            if frame is not None and (server_id, uid) in self.compression_clients:
+                await self.deliver(server_id, uid, ws, frame, msg_type, started)
+            else:
+                await self.deliver(server_id, uid, ws, text, msg_type, started)
+        if remote:
+            # 每個 worker 只轉一次，由它自己壓縮 / 送出
+            for worker, uids in remote.items():
+                self.relay(server_id, worker, uids, text, msg_type)
+
+    # ------------------ Backplane（多 worker） ------------------ #
+    def publish(self, server_id: str, message: dict, worker: str | None = None) -> None:
+        """廣播給同一個 server 的其他 worker；指定 worker 就只送給它。單一行程時什麼都不做。"""
+        if not self.backplane.distributed:
+            return
+        message["server_id"] = server_id
+        message["origin"] = WORKER_ID
+        channel = server_id if worker is None else f"{server_id}:{worker}"
+        self.backplane.publish(channel, message)
+
+    def relay(self, server_id: str, worker: str, user_ids: List[int], text: str, msg_type: str) -> None:
+        self.publish(
+            server_id,
+            {"op": "deliver", "user_ids": user_ids, "text": text, "msg_type": msg_type},
+            worker,
+        )
+
+    def is_online(self, server_id: str, user_id: int) -> bool:
+        key: UserKey = (server_id, user_id)
+        return key in self.active_connections or key in self.remote_users
+
+    def apply_remote_claim(self, server_id: str, user_id: int, worker: str) -> WebSocket | None:
+        """
+        玩家連上了別的 worker：這邊的 grace 期 / session 作廢；
+        如果這邊也還連著（兩個分頁打到不同 worker），回傳這邊的舊連線讓呼叫端用 4001 關掉。
+        """
+        key: UserKey = (server_id, user_id)
+        self.remote_users[key] = worker
+        self.pending_leaves.pop(key, None)
+        token = self.session_tokens.pop(key, None)
+        if token is not None:
+            self.sessions.pop(token, None)
+        replaced = self.active_connections.get(key)
+        if replaced is not None:
+            self.release_connection(server_id, user_id)
+            self.eviction_counts["replaced"] = self.eviction_counts.get("replaced", 0) + 1
+            log("CONNECT_REPLACED", f"server={server_id}, user_id={user_id} 在 worker={worker} 重複登入，關閉這邊的連線")
+        return replaced
+
+    def apply_remote_player(self, server_id: str, user_id: int, worker: str, data: dict | None) -> None:
+        """其他 worker 的玩家狀態變動：只更新副本，訊息已經由發出的 worker 送給所有看得到的人。"""
+        key: UserKey = (server_id, user_id)
+        if data is None:
+            # 離開大廳：只認目前擁有這個玩家的 worker 發的（他可能已經換到別的 worker）
+            if self.remote_users.get(key) != worker:
+                return
+            del self.remote_users[key]
+            self.remove_lobby_player(server_id, user_id)
+        else:
+            player = LobbyPlayer(**data)
+            self.upsert_lobby_player(server_id, player)
+            self.get_grid(server_id).upsert(user_id, player.x, player.y)
+        self.get_lobby_log(server_id).record(user_id)
+
+    def replicate_local_state(self, server_id: str) -> None:
+        """連上 backplane / 有新 worker 加入時，把自己身上的玩家、聊天配對、對戰房間再公告一次。"""
+        for sid, uid in list(self.active_connections):
+            if sid != server_id:
+                continue
+            self.publish(server_id, {"op": "claim", "user_id": uid})
+            player = self.get_player_state(server_id, uid)
+            if player is not None:
+                self.publish(server_id, {"op": "player", "user_id": uid, "player": player.to_dict()})
+            for peer_id, approved_at in self.chat_approvals.adjacency.get(server_id, {}).get(uid, {}).items():
+                self.publish(server_id, {"op": "chat_approve", "user_ids": [uid, peer_id], "at": approved_at})
+        for room in self.battles.values():
+            if room.server_id == server_id:
+                self.publish(server_id, {
+                    "op": "battle_open",
+                    "battle_id": room.battle_id,
+                    "user_ids": [room.player1_id, room.player2_id],
+                })
+
+    # ------------------ 視野範圍（AOI） ------------------ #
+    def get_grid(self, server_id: str) -> SpatialGrid:
+        grid = self.spatial_grids.get(server_id)
+        if grid is None:
+            grid = SpatialGrid(GRID_CELL_SIZE)
+            self.spatial_grids[server_id] = grid
+        return grid
+
+    def get_viewers(self, server_id: str, user_id: int) -> Set[int]:
+        """視野半徑大家都一樣，所以「我看得到的人」就是「看得到我的人」。"""
+        grid = self.spatial_grids.get(server_id)
+        if grid is None:
+            return set()
+        pos = grid.positions.get(user_id)
+        if pos is None:
+            return set()
+        return grid.query(pos[0], pos[1], VIEW_RADIUS, exclude=user_id)
+
+    def move_player(
+        self,
+        server_id: str,
+        user_id: int,
+        x: float,
+        y: float,
+    ) -> Tuple[Set[int], Set[int], Set[int]]:
+        """
+        更新空間索引裡的位置，回傳：
+        (移動前後都在視野內, 新進入視野, 離開視野)
+        """
+        grid = self.get_grid(server_id)
+        before = self.get_viewers(server_id, user_id)
+        grid.upsert(user_id, x, y)
+        after = grid.query(x, y, VIEW_RADIUS, exclude=user_id)
+        return before & after, after - before, before - after
+
+    # ------------------ 大廳玩家資訊 ------------------ #
+    def upsert_lobby_player(self, server_id: str, player: LobbyPlayer) -> None:
+        if server_id not in self.lobby_player_states:
+            self.lobby_player_states[server_id] = {}
+            self.lobby_order[server_id] = []
+        server_players = self.lobby_player_states[server_id]
+        if player.user_id not in server_players:
+            bisect.insort(self.lobby_order[server_id], player.user_id)
+        server_players[player.user_id] = player
+
+    def get_lobby_players(self, server_id: str) -> List[LobbyPlayer]:
+        server_players = self.lobby_player_states.get(server_id, {})
+        return [server_players[uid] for uid in self.lobby_order.get(server_id, [])]
+
+    def get_player_state(self, server_id: str, user_id: int) -> LobbyPlayer | None:
+        return self.lobby_player_states.get(server_id, {}).get(user_id)
+
+    def get_player_energy(self, server_id: str, user_id: int) -> int | None:
+        """backend 給的體力；不在大廳或還不知道就回 None（不採信 player.energy，那是客戶端帶的）。"""
+        if self.get_player_state(server_id, user_id) is None:
+            return None
+        return pet_cache.energy(user_id)
+
+    # ------------------ 大廳版本 / 斷線 grace ------------------ #
+    def get_lobby_log(self, server_id: str) -> LobbyLog:
+        lobby_log = self.lobby_logs.get(server_id)
+        if lobby_log is None:
+            lobby_log = LobbyLog(LOBBY_DELTA_BUFFER)
+            self.lobby_logs[server_id] = lobby_log
+        return lobby_log
+
+    def touch_lobby_player(self, server_id: str, user_id: int) -> int:
+        """
+        記一筆玩家狀態變動，回傳新的版本號（拿去標在廣播訊息上）。
+        所有玩家狀態變動都會經過這裡，多 worker 時順便把最新狀態（離開大廳就是 None）同步出去。
+        """
+        if self.backplane.distributed:
+            player = self.get_player_state(server_id, user_id)
+            self.publish(server_id, {
+                "op": "player",
+                "user_id": user_id,
+                "player": player.to_dict() if player is not None else None,
+            })
+        return self.get_lobby_log(server_id).record(user_id)
+
+    def lobby_version(self, server_id: str) -> int:
+        return self.get_lobby_log(server_id).version
+
+    def schedule_leave(self, server_id: str, user_id: int, deadline: float) -> None:
+        self.pending_leaves[(server_id, user_id)] = deadline
+
+    def cancel_leave(self, server_id: str, user_id: int) -> bool:
+        return self.pending_leaves.pop((server_id, user_id), None) is not None
+
+    def issue_session(self, server_id: str, user_id: int) -> str:
+        """每次 join 換一個新 token，舊的立刻失效。"""
+        key: UserKey = (server_id, user_id)
+        old_token = self.session_tokens.get(key)
+        if old_token is not None:
+            self.sessions.pop(old_token, None)
+        token = secrets.token_urlsafe(16)
+        self.sessions[token] = key
+        self.session_tokens[key] = token
+        return token
+
+    def resume_session(self, server_id: str, user_id: int, token: str) -> bool:
+        """token 對得上、而且人還在 grace 期 → 取消離開，直接接回原本的 session。"""
+        key: UserKey = (server_id, user_id)
+        if not token or self.sessions.get(token) != key:
+            return False
+        return self.pending_leaves.pop(key, None) is not None
+
+    def pop_expired_leaves(self, now: float) -> List[UserKey]:
+        expired = [key for key, deadline in self.pending_leaves.items() if deadline <= now]
+        for key in expired:
+            del self.pending_leaves[key]
+        return expired
+
+    # ------------------ 對戰配對佇列 ------------------ #
+    def get_match_queue(self, server_id: str) -> MatchQueue:
+        match_queue = self.match_queues.get(server_id)
+        if match_queue is None:
+            match_queue = MatchQueue()
+            self.match_queues[server_id] = match_queue
+        return match_queue
+
+    # ------------------ 聊天配對 ------------------ #
+    def approve_chat_pair(self, server_id: str, user1_id: int, user2_id: int) -> None:
+        now = time.time()
+        self.chat_approvals.approve(server_id, user1_id, user2_id, now)
+        self.publish(server_id, {"op": "chat_approve", "user_ids": [user1_id, user2_id], "at": now})
+        pair = tuple(sorted((user1_id, user2_id)))
+        log("CHAT_APPROVED", f"server={server_id}, pair={pair} 已允許聊天")
+
+    def is_chat_approved(self, server_id: str, from_user_id: int, to_user_id: int) -> bool:
+        return self.chat_approvals.is_approved(server_id, from_user_id, to_user_id, time.time())
+
+    # ------------------ 對戰房間 ------------------ #
+    def create_battle(self, server_id: str, player1_id: int, player2_id: int) -> BattleRoom:
+        ts = int(time.time() * 1000)
+        battle_id = f"{min(player1_id, player2_id)}_{max(player1_id, player2_id)}_{ts}"
+        room = BattleRoom(
+            battle_id=battle_id,
+            server_id=server_id,
+            player1_id=player1_id,
+            player2_id=player2_id,
+            scores={player1_id: 0, player2_id: 0},
+            ready={player1_id: False, player2_id: False},
+        )
+        self.battles[battle_id] = room
+        self.user_battles[(server_id, player1_id)] = battle_id
+        self.user_battles[(server_id, player2_id)] = battle_id
+        self.publish(server_id, {"op": "battle_open", "battle_id": battle_id, "user_ids": [player1_id, player2_id]})
+        log(
+            "BATTLE_CREATE",
+            f"server={server_id}, battle_id={battle_id}, "
+            f"player1={player1_id}, player2={player2_id}",
+        )
+        return room
+
+    def get_battle(self, battle_id: str) -> BattleRoom | None:
+        return self.battles.get(battle_id)
+
+    def finish_battle(self, battle_id: str) -> None:
+        room = self.battles.pop(battle_id, None)
+        self.dirty_battles.pop(battle_id, None)
+        if room is not None:
+            for pid in (room.player1_id, room.player2_id):
+                key: UserKey = (room.server_id, pid)
+                # 玩家可能已經進了新房間，只清掉還指向這間的索引
+                if self.user_battles.get(key) == battle_id:
+                    del self.user_battles[key]
+            self.publish(room.server_id, {
+                "op": "battle_close",
+                "battle_id": battle_id,
+                "user_ids": [room.player1_id, room.player2_id],
+            })
+        log("BATTLE_FINISH", f"battle_id={battle_id} 已移除，剩餘房間數={len(self.battles)}")
+
+    def find_battle_by_user(self, server_id: str, user_id: int) -> BattleRoom | None:
+        battle_id = self.user_battles.get((server_id, user_id))
+        if battle_id is None:
+            return None
+        return self.battles.get(battle_id)
+
+    def remote_battle_owner(self, server_id: str, user_id: int) -> str | None:
+        battle_id = self.remote_user_battles.get((server_id, user_id))
+        if battle_id is None:
+            return None
+        return self.remote_battles.get(battle_id)
+
+    def apply_remote_battle(self, server_id: str, worker: str, battle_id: str, user_ids: List[int], opened: bool) -> None:
+        if opened:
+            self.remote_battles[battle_id] = worker
+            for uid in user_ids:
+                self.remote_user_battles[(server_id, uid)] = battle_id
+            return
+        self.remote_battles.pop(battle_id, None)
+        for uid in user_ids:
+            if self.remote_user_battles.get((server_id, uid)) == battle_id:
+                del self.remote_user_battles[(server_id, uid)]
+
+    def set_battle_state(self, room: BattleRoom, state: str) -> None:
+        room.last_activity = time.time()
+        if room.state != state:
+            room.state = state
+            room.state_since = room.last_activity
+
+    def get_expired_battles(self, now: float) -> List[BattleRoom]:
+        expired: List[BattleRoom] = []
+        for room in self.battles.values():
+            if room.state == "waiting":
+                if now - room.state_since > BATTLE_WAITING_TIMEOUT:
+                    expired.append(room)
+            # running 中還在互送 battle_update 的不算卡住，從最後一則訊息開始算
+            elif now - room.last_activity > BATTLE_RUNNING_TIMEOUT:
+                expired.append(room)
+        return expired
+
+    def live_battle_count(self) -> int:
+        return len(self.battles)
+
+
+# shard_id -> 這個 shard 的 ConnectionManager；handler 一律用 shards[server_id] 拿
+shards: Dict[str, ConnectionManager] = {}
+background_tasks: List[asyncio.Task] = []
+
+
+def configure_shards(shard_ids: List[str]) -> None:
+    """指定這個行程要跑哪些 shard，要在 app 啟動前呼叫。"""
+    if background_tasks:
+        raise RuntimeError("configure_shards() must be called before the app starts")
+    shards.clear()
+    for shard_id in shard_ids:
+        shards[shard_id] = ConnectionManager()
+    LogFormatter.name = "ws" + "".join(shard_ids)
+
+
+closing_tasks: Set[asyncio.Task] = set()
+
+
+@profiled
+async def send_pet_moved(
+    server_id: str,
+    user_ids,
+    user_id: int,
+    x: float,
+    y: float,
+    version: int,
+) -> None:
+    """
+    other_pet_moved：二進位連線送 13 bytes 的 struct，其他連線送 JSON，兩種都只 encode 一次。
+    二進位格式不帶版本號，重連時最多多補幾筆，不會漏。
+    """
+    manager = shards[server_id]
+    started = time.perf_counter()
+    data: bytes | None = None
+    json_user_ids: List[int] = []
+    for uid in user_ids:
+        if manager.uses_binary(server_id, uid):
+            if data is None:
+                data = BIN_PET_MOVED.pack(BIN_OP_PET_MOVED, user_id, x, y)
+            await manager.send_bytes(server_id, uid, data, "other_pet_moved", started)
+        else:
+            # 包含連在其他 worker 上的玩家，send_text_to_users 會每個 worker 轉一次
+            json_user_ids.append(uid)
+    if json_user_ids:
+        msg = {
+            "type": "other_pet_moved",
+            "server_id": server_id,
+            "user_id": user_id,
+            "payload": {
+                "player": {
+                    "user_id": user_id,
+                    "x": x,
+                    "y": y,
+                },
+                "version": version,
+            },
+        }
+        text = json.dumps(msg, ensure_ascii=False)
+        await manager.send_text_to_users(server_id, json_user_ids, text, "other_pet_moved")
+
+
+@profiled
+async def send_battle_update(server_id: str, room: BattleRoom, changed: Set[int]) -> None:
+    """
+    把房間目前的分數送給雙方：每人最多一則，只在「對手」的分數有變時才送（自己的分數自己知道）。
+    user_id / score 是對手的（前端舊的寫法只看這兩個），scores 是雙方最新分數。
+    """
+    manager = shards[server_id]
+    started = time.perf_counter()
+    state_code = BATTLE_STATE_CODES.get(room.state)
+    for pid, other_id in ((room.player1_id, room.player2_id), (room.player2_id, room.player1_id)):
+        if other_id not in changed:
+            continue
+        score = room.scores.get(other_id, 0)
+        if state_code is not None and manager.uses_binary(server_id, pid):
+            data = BIN_BATTLE_UPDATE_OUT.pack(BIN_OP_BATTLE_UPDATE, state_code, other_id, score)
+            await manager.send_bytes(server_id, pid, data, "battle_update", started)
+            continue
+        update_msg = {
+            "type": "battle_update",
+            "server_id": server_id,
+            "user_id": other_id,
+            "payload": {
+                "battle_id": room.battle_id,
+                "user_id": other_id,
+                "score": score,
+                "scores": room.scores,
+                "state": room.state,
+            },
+        }
+        await manager.send_text(server_id, pid, json.dumps(update_msg, ensure_ascii=False), "battle_update", started)
+
+
+@profiled
+async def notify_view_changes(
+    server_id: str,
+    user_id: int,
+    entered: Set[int],
+    left: Set[int],
+) -> None:
+    """
+    玩家移動後，處理雙向的進出視野事件：
+    - 新看到的人：互相送 player_entered_view（帶完整狀態）
+    - 看不到的人：互相送 player_left_view
+    """
+    manager = shards[server_id]
+    version = manager.lobby_version(server_id)
+    if entered:
+        me = manager.get_player_state(server_id, user_id)
+        me_text = encode_player_message("player_entered_view", server_id, user_id, me, version)
+        await manager.send_text_to_users(server_id, entered, me_text, "player_entered_view")
+        for uid in sorted(entered):
+            other = manager.get_player_state(server_id, uid)
+            other_text = encode_player_message("player_entered_view", server_id, uid, other, version)
+            await manager.send_text(server_id, user_id, other_text, "player_entered_view")
+
+    if left:
+        me_msg = {
+            "type": "player_left_view",
+            "server_id": server_id,
+            "user_id": user_id,
+            "payload": {"version": version},
+        }
+        await manager.send_to_users(server_id, left, me_msg)
+        for uid in sorted(left):
+            other_msg = {
+                "type": "player_left_view",
+                "server_id": server_id,
+                "user_id": uid,
+                "payload": {"version": version},
+            }
+            await manager.send_json(server_id, user_id, other_msg)
+
+# =========================================================
+# 訊息格式：信封解碼 + 各 type 的 payload schema
+# =========================================================
+
+class MessageDecodeError(ValueError):
+    pass
+
+
+def finite_float(value: Any) -> float:
+    result = float(value)
+    if not math.isfinite(result):
+        raise ValueError("座標必須是有限數字")
+    return result
+
+
+# json.loads 每次都要檢查型別、BOM、前後空白，一則小訊息這些就佔掉一半以上的時間；
+# decode_envelope 已經確認開頭是 "{"，直接用底層的 scanner
+scan_json = json.JSONDecoder().scan_once
+
+
+def decode_envelope(raw: str) -> Tuple[str, int | None, Any]:
+    """
+    解析最外層 {type, user_id, payload}：
+    - 太長、不是 JSON 物件的訊息在解析 JSON 之前就擋掉
+    - user_id 轉不成 int 時當作沒帶
+    """
+    if len(raw) > MAX_FRAME_CHARS:
+        raise MessageDecodeError(f"訊息過長（{len(raw)} 字元）")
+    if not raw.startswith("{"):
+        raise MessageDecodeError("不是 JSON 物件")
+    # 開頭是 "{" 的話 scanner 一定回傳 dict 或丟錯
+    try:
+        message, end = scan_json(raw, 0)
+    except (ValueError, StopIteration):
+        raise MessageDecodeError("不是合法 JSON")
+    if end != len(raw) and not raw[end:].isspace():
+        raise MessageDecodeError("不是合法 JSON")
+
+    msg_type = message.get("type")
+    if msg_type.__class__ is not str:
+        raise MessageDecodeError("缺少 type")
+
+    msg_user_id: int | None = None
+    msg_user_id_raw = message.get("user_id")
+    if msg_user_id_raw.__class__ is int:
+        msg_user_id = msg_user_id_raw
+    elif msg_user_id_raw is not None:
+        try:
+            msg_user_id = int(msg_user_id_raw)
+        except (TypeError, ValueError):
+            msg_user_id = None
+
+    return msg_type, msg_user_id, message.get("payload")
+
+
+# (欄位名稱, 轉型函式, 是否必填, 預設值)
+FieldSpec = Tuple[str, Callable[[Any], Any], bool, Any]
+
+
+class MessageSchema:
+    """
+    把 payload dict 一次轉成對應的 dataclass：
+    - 欄位依宣告順序轉型，必填欄位缺少或轉型失敗就丟 MessageDecodeError
+    - handler 拿到的就是型別確定的物件，不用再自己 int(...) / .get(...)
+    - 建立時依欄位產生一個專用的 decode（直接取 key、呼叫一次建構子），
+      不用每則訊息都跑一遍欄位迴圈；有欄位出錯才回到 decode_fields 找出是哪一個
+    """
+
+    def __init__(self, payload_cls: type, fields: List[FieldSpec]) -> None:
+        self.payload_cls = payload_cls
+        self.fields = tuple(fields)
+        self.decode = self.compile_decoder()
+
+    def compile_decoder(self) -> Callable[[Any], Any]:
+        namespace: Dict[str, Any] = {
+            "cls": self.payload_cls,
+            "slow": self.decode_fields,
+            "MessageDecodeError": MessageDecodeError,
+        }
+        lines = [
+            "def decode(raw_payload):",
+            "    if raw_payload.__class__ is not dict:",
+            "        if raw_payload is None:",
+            "            raw_payload = {}",
+            "        elif not isinstance(raw_payload, dict):",
+            "            raise MessageDecodeError('payload 必須是物件')",
+        ]
+        required = []
+        args = []
+        for i, (name, convert, is_required, default) in enumerate(self.fields):
+            namespace[f"c{i}"] = convert
+            namespace[f"d{i}"] = default
+            lines.append(f"    v{i} = raw_payload.get({name!r})")
+            if is_required:
+                required.append(f"v{i} is None")
+                args.append(f"c{i}(v{i})")
+            else:
+                args.append(f"d{i} if v{i} is None else c{i}(v{i})")
+        if required:
+            lines.append(f"    if {' or '.join(required)}:")
+            lines.append("        return slow(raw_payload)")
+        lines += [
+            "    try:",
+            f"        return cls({', '.join(args)})",
+            "    except (TypeError, ValueError):",
+            "        return slow(raw_payload)",
+        ]
+        exec("\n".join(lines), namespace)
+        return namespace["decode"]
+
+    def decode_fields(self, raw_payload: Any) -> Any:
+        values = []
+        for name, convert, required, default in self.fields:
+            value = raw_payload.get(name)
+            if value is None:
+                if required:
+                    raise MessageDecodeError(f"缺少 {name}")
+                values.append(default)
+                continue
+            try:
+                values.append(convert(value))
+            except (TypeError, ValueError):
+                raise MessageDecodeError(f"{name} 格式錯誤：{value!r}")
+        return self.payload_cls(*values)
+
+
+@dataclass(slots=True)
+class JoinLobbyPayload:
+    display_name: str
+    pet_id: int
+    pet_name: str
+    energy: int | None
+    status: str
+    score: int | None
+    x: float | None
+    y: float | None
+    protocol: str
+    compression: str
+    since_version: int
+    epoch: str
+    resume_token: str
+
+
+@dataclass(slots=True)
+class PetStatePayload:
+    energy: int | None
+    status: str | None
+    score: int | None
+    x: float | None
+    y: float | None
+
+
+@dataclass(slots=True)
+class PositionPayload:
+    x: float
+    y: float
+
+
+@dataclass(slots=True)
+class ToUserPayload:
+    to_user_id: int
+
+
+@dataclass(slots=True)
+class FromUserPayload:
+    from_user_id: int
+
+
+@dataclass(slots=True)
+class ChatMessagePayload:
+    to_user_id: int
+    content: str
+
+
+@dataclass(slots=True)
+class EmptyPayload:
+    pass
+
+
+@dataclass(slots=True)
+class BattleReadyPayload:
+    battle_id: str
+
+
+@dataclass(slots=True)
+class BattleScorePayload:
+    battle_id: str
+    score: int
+    state: str
+
+
+JOIN_LOBBY_SCHEMA = MessageSchema(JoinLobbyPayload, [
+    ("display_name", str, False, ""),
+    ("pet_id", int, False, 0),
+    ("pet_name", str, False, ""),
+    ("energy", int, False, None),
+    ("status", str, False, ""),
+    ("score", int, False, None),
+    ("x", finite_float, False, None),
+    ("y", finite_float, False, None),
+    ("protocol", str, False, PROTOCOL_JSON),
+    ("compression", str, False, "off"),
+    ("since_version", int, False, -1),
+    ("epoch", str, False, ""),
+    ("resume_token", str, False, ""),
+])
+PET_STATE_SCHEMA = MessageSchema(PetStatePayload, [
+    ("energy", int, False, None),
+    ("status", str, False, None),
+    ("score", int, False, None),
+    ("x", finite_float, False, None),
+    ("y", finite_float, False, None),
+])
+POSITION_SCHEMA = MessageSchema(PositionPayload, [
+    ("x", finite_float, True, None),
+    ("y", finite_float, True, None),
+])
+TO_USER_SCHEMA = MessageSchema(ToUserPayload, [
+    ("to_user_id", int, True, None),
+])
+FROM_USER_SCHEMA = MessageSchema(FromUserPayload, [
+    ("from_user_id", int, True, None),
+])
+CHAT_MESSAGE_SCHEMA = MessageSchema(ChatMessagePayload, [
+    ("to_user_id", int, True, None),
+    ("content", str, False, ""),
+])
+EMPTY_SCHEMA = MessageSchema(EmptyPayload, [])
+BATTLE_READY_SCHEMA = MessageSchema(BattleReadyPayload, [
+    ("battle_id", str, True, None),
+])
+BATTLE_SCORE_SCHEMA = MessageSchema(BattleScorePayload, [
+    ("battle_id", str, True, None),
+    ("score", int, False, 0),
+    ("state", str, False, "running"),
+])
+
+
+def decode_binary_frame(server_id: str, user_id: int, data: bytes) -> Tuple[str, Any]:
+    """把二進位 frame 直接轉成和 JSON 路徑一樣的 (type, payload)。"""
+    manager = shards[server_id]
+    if not data:
+        raise MessageDecodeError("空的二進位訊息")
+    op = data[0]
+    try:
+        if op == BIN_OP_UPDATE_POSITION:
+            _, x, y = BIN_UPDATE_POSITION.unpack(data)
+            if not (math.isfinite(x) and math.isfinite(y)):
+                raise MessageDecodeError("座標必須是有限數字")
+            return "update_position", PositionPayload(x, y)
+        if op == BIN_OP_BATTLE_UPDATE:
+            _, state_code, score = BIN_BATTLE_UPDATE_IN.unpack(data)
+            state = BATTLE_STATE_NAMES.get(state_code)
+            if state is None:
+                raise MessageDecodeError(f"未知的對戰狀態 {state_code}")
+            # 二進位版不帶 battle_id，直接用玩家目前所在的房間
+            room = manager.find_battle_by_user(server_id, user_id)
+            if room is None:
+                raise MessageDecodeError("不在任何對戰房間中")
+            return "battle_update", BattleScorePayload(room.battle_id, score, state)
+    except struct.error:
+        raise MessageDecodeError(f"op={op} 長度錯誤（{len(data)} bytes）")
+    raise MessageDecodeError(f"未知的 op={op}")
+
+
+# =========================================================
+# 事件處理：大廳 / 位置 / 聊天
+# =========================================================
+
+
+async def handle_join_lobby(
+    server_id: str,
+    user_id: int,
+    payload: JoinLobbyPayload,
+    websocket: WebSocket,
+) -> None:
+    manager = shards[server_id]
+    # grace 期內帶著有效 token 重連：大廳狀態、對戰房間都還在，別人也還看得到他
+    resumed = manager.resume_session(server_id, user_id, payload.resume_token)
+    if not resumed and manager.cancel_leave(server_id, user_id):
+        # 斷線後沒拿 token 回來 → 舊 session 先正式離開，再當新玩家加入
+        await finish_lobby_leave(server_id, user_id)
+
+    replaced = manager.connect(server_id, user_id, websocket)
+    if replaced is not None:
+        close_in_background(replaced, WS_CLOSE_REPLACED, "replaced by a newer login")
+    protocol = manager.set_protocol(server_id, user_id, payload.protocol)
+    compression = manager.set_compression(server_id, user_id, payload.compression)
+    session_token = manager.issue_session(server_id, user_id)
+    previous = manager.get_player_state(server_id, user_id)
+    previous_pos = None if previous is None else (previous.x, previous.y)
+
+    x = payload.x
+    y = payload.y
+    if x is None or y is None:
+        if previous_pos is not None:
+            # 換頁重連沒帶座標 → 留在原地，不要每次都隨機傳送
+            x, y = previous_pos
+        else:
+            x = float(random.randint(0, WORLD_WIDTH))
+            y = float(random.randint(0, WORLD_HEIGHT))
+
+    if resumed and previous is not None:
+        # 續連直接沿用伺服器上的玩家資料（積分可能在對戰後被加過），只套用有帶的欄位
+        player = previous
+        if payload.energy is not None:
+            player.energy = payload.energy
+        if payload.score is not None:
+            player.score = payload.score
+        player.x = x
+        player.y = y
+        pet_cache.overlay(player)
+    else:
+        player = LobbyPlayer(
+            user_id=user_id,
+            display_name=payload.display_name or f"Player{user_id}",
+            pet_id=payload.pet_id,
+            pet_name=payload.pet_name or "MyPet",
+            # 只用來顯示；能不能聊天 / 對戰看 pet_cache 裡 backend 給的值
+            energy=payload.energy if payload.energy is not None else 100,
+            status=payload.status or "ACTIVE",
+            # ⭐ 大廳裡也有紀錄積分
+            score=payload.score if payload.score is not None else 0,
+            x=x,
+            y=y,
+        )
+        pet_cache.overlay(player)
+        manager.upsert_lobby_player(server_id, player)
+    version = manager.touch_lobby_player(server_id, user_id)
+    # 還沒在快取裡的話背景載入，載到後直接改大廳裡的值
+    pet_cache.prefetch(user_id)
+
+    log(
+        "JOIN_LOBBY_POS",
+        f"server={server_id}, user_id={user_id}, x={player.x}, y={player.y}, "
+        f"resumed={resumed}, version={version}",
+    )
+
+    stay, entered, left = manager.move_player(server_id, user_id, player.x, player.y)
+    viewers = stay | entered
+
+    # 客戶端帶了上次看到的版本，而且人沒有移動（視野不變）→ 只補這段期間有變動的玩家
+    changed = None
+    if payload.epoch == LOBBY_EPOCH and previous_pos == (player.x, player.y):
+        changed = manager.get_lobby_log(server_id).changed_since(payload.since_version)
+
+    if changed is None:
+        # 只把視野內的玩家放進 lobby_state，大廳再大也不會一次塞給新玩家
+        players = [player] + [
+            manager.get_player_state(server_id, uid) for uid in sorted(viewers)
+        ]
+        extra_json = ""
+    else:
+        players = [player] + [
+            manager.get_player_state(server_id, uid) for uid in sorted(changed & viewers)
+        ]
+        removed = sorted(changed - viewers - {user_id})
+        extra_json = (
+            f',"incremental":true,"since_version":{payload.since_version},'
+            f'"removed":{json.dumps(removed)}'
+        )
+    log(
+        "JOIN_LOBBY",
+        f"server={server_id}, user_id={user_id}, players_count={len(players)}, "
+        f"incremental={changed is not None}",
+    )
+
+    players_json = ",".join(p.to_json() for p in players)
+    lobby_state_text = (
+        f'{{"type":"lobby_state","server_id":{json.dumps(server_id)},'
+        f'"user_id":{user_id},"payload":{{"players":[{players_json}],'
+        f'"version":{version},"epoch":"{LOBBY_EPOCH}"{extra_json},'
+        f'"session_token":"{session_token}","resumed":{"true" if resumed else "false"},'
+        f'"protocol":"{protocol}","compression":"{compression}"}}}}'
+    )
+    await manager.send_text(server_id, user_id, lobby_state_text, "lobby_state")
+
+    # 取代原本全伺服器廣播的 player_joined：只通知看得到新玩家的人
+    # 本來就看得到他的人（grace 期重連）只需要一筆 pet_state_update
+    player_entered_text = encode_player_message(
+        "player_entered_view", server_id, user_id, player, version
+    )
+    await manager.send_text_to_users(server_id, entered, player_entered_text, "player_entered_view")
+    if stay:
+        update_text = encode_player_message("pet_state_update", server_id, user_id, player, version)
+        await manager.send_text_to_users(server_id, stay, update_text, "pet_state_update")
+
+    if left:
+        player_left_view_msg = {
+            "type": "player_left_view",
+            "server_id": server_id,
+            "user_id": user_id,
+            "payload": {"version": version},
+        }
+        await manager.send_to_users(server_id, left, player_left_view_msg)
+
+
+async def handle_pet_state_update(server_id: str, user_id: int, payload: PetStatePayload) -> None:
+    manager = shards[server_id]
+    player = manager.get_player_state(server_id, user_id)
+    if player is None:
+        log("PET_STATE_UPDATE_ERROR", f"server={server_id}, user_id={user_id} 尚未加入大廳，忽略")
+        return
+
+    if payload.energy is not None:
+        player.energy = payload.energy
+    if payload.status is not None:
+        player.status = payload.status
+    if payload.score is not None:
+        player.score = payload.score
+    if payload.x is not None:
+        player.x = payload.x
+    if payload.y is not None:
+        player.y = payload.y
+    # 體力 / 積分以 backend 為準，客戶端帶的只在快取還沒載到時暫用
+    pet_cache.overlay(player)
+
+    if log_enabled("PET_STATE_UPDATE"):
+        log(
+            "PET_STATE_UPDATE",
+            f"server={server_id}, user_id={user_id}, state={player.to_dict()}",
+        )
+
+    version = manager.touch_lobby_player(server_id, user_id)
+    stay, entered, left = manager.move_player(server_id, user_id, player.x, player.y)
+    await notify_view_changes(server_id, user_id, entered, left)
+
+    # 自己 + 視野內（新進入視野的人已經拿到完整狀態）
+    text = encode_player_message("pet_state_update", server_id, user_id, player, version)
+    await manager.send_text_to_users(server_id, stay | {user_id}, text, "pet_state_update")
+
+
+async def handle_update_position(server_id: str, user_id: int, payload: PositionPayload) -> None:
+    manager = shards[server_id]
+    now = time.time()
+    key: UserKey = (server_id, user_id)
+    last_ts = manager.last_position_broadcast.get(key, 0.0)
+    if now - last_ts < 0.05:
+        return
+    manager.last_position_broadcast[key] = now
+
+    player = manager.get_player_state(server_id, user_id)
+    if player is None:
+        return
+    player.x = payload.x
+    player.y = payload.y
+
+    version = manager.touch_lobby_player(server_id, user_id)
+    stay, entered, left = manager.move_player(server_id, user_id, player.x, player.y)
+    await notify_view_changes(server_id, user_id, entered, left)
+
+    await send_pet_moved(server_id, stay, user_id, player.x, player.y, version)
+
+
+async def handle_chat_request(server_id: str, from_user_id: int, payload: ToUserPayload) -> None:
+    manager = shards[server_id]
+    to_user_id = payload.to_user_id
+
+    if not manager.is_online(server_id, to_user_id):
+        log(
+            "CHAT_REQ_OFFLINE",
+            f"server={server_id}, from={from_user_id}, to={to_user_id} 對方不在線，無法送出聊天請求",
+        )
+        error_msg = {
+            "type": "chat_not_allowed",
+            "server_id": server_id,
+            "user_id": from_user_id,
+            "payload": {
+                "reason": "TARGET_OFFLINE",
+                "message": "對方目前不在線上，無法發送聊天邀請。",
+            },
+        }
+        await manager.send_json(server_id, from_user_id, error_msg)
+        return
+
+    log(
+        "CHAT_REQUEST",
+        f"server={server_id}, from={from_user_id}, to={to_user_id}",
+    )
+
+    msg = {
+        "type": "chat_request",
+        "server_id": server_id,
+        "user_id": from_user_id,
+        "payload": {
+            "from_user_id": from_user_id,
+            "to_user_id": to_user_id,
+        },
+    }
+    await manager.send_json(server_id, to_user_id, msg)
+
+
+async def handle_chat_request_accept(
+    server_id: str,
+    accept_user_id: int,
+    payload: FromUserPayload,
+) -> None:
+    manager = shards[server_id]
+    from_user_id = payload.from_user_id
+
+    manager.approve_chat_pair(server_id, accept_user_id, from_user_id)
+
+    log(
+        "CHAT_REQUEST_ACCEPT",
+        f"server={server_id}, from={from_user_id}, accepted_by={accept_user_id}",
+    )
+
+    for uid in (accept_user_id, from_user_id):
+        msg = {
+            "type": "chat_approved",
+            "server_id": server_id,
+            "user_id": uid,
+            "payload": {
+                "user_id_1": from_user_id,
+                "user_id_2": accept_user_id,
+            },
+        }
+        await manager.send_json(server_id, uid, msg)
+
+
+async def handle_chat_message(server_id: str, user_id: int, payload: ChatMessagePayload) -> None:
+    manager = shards[server_id]
+    content = payload.content
+    to_user_id = payload.to_user_id
+
+    await pet_cache.ensure((user_id,))
+    energy = manager.get_player_energy(server_id, user_id)
+    if energy is None or energy <= 30:
+        log(
+            "CHAT_BLOCKED_ENERGY",
+            f"server={server_id}, from={user_id}, to={to_user_id}, energy={energy} (休眠或體力未知，禁止聊天)",
+        )
+        error_msg = {
+            "type": "chat_not_allowed",
+            "server_id": server_id,
+            "user_id": user_id,
+            "payload": {
+                "reason": "ENERGY_UNKNOWN" if energy is None else "LOW_ENERGY",
+                "message": ENERGY_UNKNOWN_MESSAGE if energy is None else "您的小寵物正在休眠狀態，無法聊天。",
+            },
+        }
+        await manager.send_json(server_id, user_id, error_msg)
+        return
+
+    if not manager.is_chat_approved(server_id, user_id, to_user_id):
+        log(
+            "CHAT_BLOCKED",
+            f"server={server_id}, from={user_id}, to={to_user_id} 尚未同意聊天，拒絕傳送",
+        )
+        error_msg = {
+            "type": "chat_not_allowed",
+            "server_id": server_id,
+            "user_id": user_id,
+            "payload": {
+                "reason": "CHAT_NOT_APPROVED",
+                "message": "對方尚未同意與你聊天。",
+            },
+        }
+        await manager.send_json(server_id, user_id, error_msg)
+        return
+
+    if not manager.is_online(server_id, to_user_id):
+        log(
+            "CHAT_TARGET_OFFLINE",
+            f"server={server_id}, from={user_id}, to={to_user_id} 對方不在線",
+        )
+        error_msg = {
+            "type": "chat_not_allowed",
+            "server_id": server_id,
+            "user_id": user_id,
+            "payload": {
+                "reason": "TARGET_OFFLINE",
+                "message": "對方目前不在線上。",
+            },
+        }
+        await manager.send_json(server_id, user_id, error_msg)
+        return
+
+    if log_enabled("CHAT"):
+        log(
+            "CHAT",
+            f"server={server_id}, from={user_id}, to={to_user_id}, content={content!r}",
+        )
+
+    chat_msg = {
+        "type": "chat_message",
+        "server_id": server_id,
+        "user_id": user_id,
+        "payload": {
+            "from_user_id": user_id,
+            "to_user_id": to_user_id,
+            "content": content,
+        },
+    }
+
+    await manager.send_json(server_id, user_id, chat_msg)
+    await manager.send_json(server_id, to_user_id, chat_msg)
+    chat_writer.submit(server_id, user_id, to_user_id, content)
+
+
+# =========================================================
+# 對戰流程：邀請 / 接受 / ready / 更新分數 / 最後結果
+# =========================================================
+
+async def handle_battle_invite(server_id: str, user_id: int, payload: ToUserPayload) -> None:
+    manager = shards[server_id]
+    to_user_id = payload.to_user_id
+
+    await pet_cache.ensure((user_id,))
+    inviter_energy = manager.get_player_energy(server_id, user_id)
+    if inviter_energy is None or inviter_energy < BATTLE_MIN_ENERGY:
+        log(
+            "BATTLE_INVITE_BLOCKED_ENERGY",
+            f"server={server_id}, inviter={user_id}, energy={inviter_energy} (<{BATTLE_MIN_ENERGY} 或未知，不可對戰)",
+        )
+        msg = {
+            "type": "battle_not_allowed",
+            "server_id": server_id,
+            "user_id": user_id,
+            "payload": {
+                "reason": "ENERGY_UNKNOWN" if inviter_energy is None else "INVITER_LOW_ENERGY",
+                "message": (
+                    ENERGY_UNKNOWN_MESSAGE if inviter_energy is None else "您的小寵物疲累或休眠，無法發起對戰。"
+                ),
+            },
+        }
+        await manager.send_json(server_id, user_id, msg)
+        return
+
+    if not manager.is_online(server_id, to_user_id):
+        log(
+            "BATTLE_INVITE_OFFLINE",
+            f"server={server_id}, inviter={user_id}, to={to_user_id} 對方不在線，無法發出對戰邀請",
+        )
+        msg = {
+            "type": "battle_not_allowed",
+            "server_id": server_id,
+            "user_id": user_id,
+            "payload": {
+                "reason": "TARGET_OFFLINE",
+                "message": "對方目前不在線上，無法發起對戰。",
+            },
+        }
+        await manager.send_json(server_id, user_id, msg)
+        return
+
+    log("BATTLE_INVITE", f"server={server_id}, from={user_id}, to={to_user_id}")
+
+    invite_msg = {
+        "type": "battle_invite",
+        "server_id": server_id,
+        "user_id": user_id,
+        "payload": {
+            "from_user_id": user_id,
+            "to_user_id": to_user_id,
+        },
+    }
+    await manager.send_json(server_id, to_user_id, invite_msg)
+
+
+async def handle_battle_accept(server_id: str, accept_user_id: int, payload: FromUserPayload) -> None:
+    manager = shards[server_id]
+    from_user_id = payload.from_user_id
+
+    await pet_cache.ensure((from_user_id, accept_user_id))
+    p1_energy = manager.get_player_energy(server_id, from_user_id)
+    p2_energy = manager.get_player_energy(server_id, accept_user_id)
+
+    # 任一邊的體力不知道也不能開打
+    unknown = p1_energy is None or p2_energy is None
+    if unknown or p1_energy < BATTLE_MIN_ENERGY or p2_energy < BATTLE_MIN_ENERGY:
+        log(
+            "BATTLE_ACCEPT_BLOCKED_ENERGY",
+            f"server={server_id}, A(user={from_user_id}, energy={p1_energy}), "
+            f"B(user={accept_user_id}, energy={p2_energy}) 中有人 <{BATTLE_MIN_ENERGY} 或未知，不可對戰",
+        )
+        reason = "ENERGY_UNKNOWN" if unknown else "LOW_ENERGY"
+        message = ENERGY_UNKNOWN_MESSAGE if unknown else "雙方必須保持精神飽滿（體力 ≥ 70）才可以開始對戰。"
+
+        msg_a = {
+            "type": "battle_not_allowed",
+            "server_id": server_id,
+            "user_id": from_user_id,
+            "payload": {"reason": reason, "message": message},
+        }
+        msg_b = {
+            "type": "battle_not_allowed",
+            "server_id": server_id,
+            "user_id": accept_user_id,
+            "payload": {"reason": reason, "message": message},
+        }
+        await manager.send_json(server_id, from_user_id, msg_a)
+        await manager.send_json(server_id, accept_user_id, msg_b)
+        return
+
+    room = await start_battle(server_id, from_user_id, accept_user_id)
+    log(
+        "BATTLE_ACCEPT",
+        f"server={server_id}, from={from_user_id}, accepted_by={accept_user_id}, "
+        f"battle_id={room.battle_id}",
+    )
+
+
+async def start_battle(server_id: str, player1_id: int, player2_id: int) -> BattleRoom:
+    """開房間並通知雙方 battle_start（邀請被接受、配對佇列配到都走這裡）。"""
+    manager = shards[server_id]
+    match_queue = manager.get_match_queue(server_id)
+    for pid in (player1_id, player2_id):
+        match_queue.remove(pid, "INVITE_ACCEPTED")
+    room = manager.create_battle(server_id, player1_id, player2_id)
+
+    battle_start_payload = {
+        "battle_id": room.battle_id,
+        "player1_id": room.player1_id,
+        "player2_id": room.player2_id,
+    }
+
+    for pid in (room.player1_id, room.player2_id):
+        msg = {
+            "type": "battle_start",
+            "server_id": server_id,
+            "user_id": pid,
+            "payload": battle_start_payload,
+        }
+        await manager.send_json(server_id, pid, msg)
+    return room
+
+
+# =========================================================
+# 對戰配對佇列：battle_queue_join / battle_queue_leave，背景定期依積分配對
+# 多 worker 時每個 worker 只配自己身上的玩家
+# =========================================================
+
+async def send_queue_left(server_id: str, user_id: int, reason: str, message: str) -> None:
+    msg = {
+        "type": "battle_queue_left",
+        "server_id": server_id,
+        "user_id": user_id,
+        "payload": {"reason": reason, "message": message},
+    }
+    await shards[server_id].send_json(server_id, user_id, msg)
+
+
+async def handle_battle_queue_join(server_id: str, user_id: int, payload: EmptyPayload) -> None:
+    manager = shards[server_id]
+    match_queue = manager.get_match_queue(server_id)
+
+    await pet_cache.ensure((user_id,))
+    player = manager.get_player_state(server_id, user_id)
+    energy = manager.get_player_energy(server_id, user_id)
+    reason = None
+    if player is None:
+        reason, message = "NOT_IN_LOBBY", "請先進入大廳再開始配對。"
+    elif energy is None:
+        reason, message = "ENERGY_UNKNOWN", ENERGY_UNKNOWN_MESSAGE
+    elif energy < BATTLE_MIN_ENERGY:
+        reason, message = "LOW_ENERGY", f"小寵物體力要 ≥ {BATTLE_MIN_ENERGY} 才可以排隊對戰。"
+    elif manager.find_battle_by_user(server_id, user_id) or manager.remote_battle_owner(server_id, user_id):
+        reason, message = "IN_BATTLE", "您已經在對戰中。"
+    if reason is not None:
+        log("BATTLE_QUEUE_BLOCKED", f"server={server_id}, user={user_id}, reason={reason}, energy={energy}")
+        msg = {
+            "type": "battle_not_allowed",
+            "server_id": server_id,
+            "user_id": user_id,
+            "payload": {"reason": reason, "message": message},
+        }
+        await manager.send_json(server_id, user_id, msg)
+        return
+
+    cached = pet_cache.get(user_id)
+    score = cached[1] if cached is not None else player.score
+    if match_queue.add(user_id, score, time.time()):
+        log("BATTLE_QUEUE_JOIN", f"server={server_id}, user={user_id}, score={score}, queued={len(match_queue)}")
+    msg = {
+        "type": "battle_queue_joined",
+        "server_id": server_id,
+        "user_id": user_id,
+        "payload": {"queue_size": len(match_queue)},
+    }
+    await manager.send_json(server_id, user_id, msg)
+
+
+async def handle_battle_queue_leave(server_id: str, user_id: int, payload: EmptyPayload) -> None:
+    if shards[server_id].get_match_queue(server_id).remove(user_id, "CANCELLED") is not None:
+        log("BATTLE_QUEUE_LEAVE", f"server={server_id}, user={user_id}")
+    await send_queue_left(server_id, user_id, "CANCELLED", "已取消配對。")
+
+
+async def run_matchmaking(server_id: str) -> None:
+    """一次配對 tick：先把不能打的人移出佇列（斷線、體力掉到門檻以下、已經在對戰），再依積分配對開房。"""
+    manager = shards[server_id]
+    match_queue = manager.get_match_queue(server_id)
+    if not match_queue:
+        return
+    started = time.perf_counter()
+
+    for user_id in list(match_queue.entries):
+        if (server_id, user_id) not in manager.active_connections:
+            # 斷線（grace 期也算）：不通知，回來要重新排
+            match_queue.remove(user_id, "DISCONNECTED")
+            continue
+        energy = manager.get_player_energy(server_id, user_id)
+        if energy is None:
+            match_queue.remove(user_id, "ENERGY_UNKNOWN")
+            await send_queue_left(server_id, user_id, "ENERGY_UNKNOWN", ENERGY_UNKNOWN_MESSAGE)
+        elif energy < BATTLE_MIN_ENERGY:
+            match_queue.remove(user_id, "LOW_ENERGY")
+            await send_queue_left(
+                server_id, user_id, "LOW_ENERGY", f"小寵物體力低於 {BATTLE_MIN_ENERGY}，已離開配對。"
+            )
+        elif manager.find_battle_by_user(server_id, user_id) or manager.remote_battle_owner(server_id, user_id):
+            match_queue.remove(user_id, "IN_BATTLE")
+
+    pairs = match_queue.pair(time.time())
+    match_queue.last_tick_ms = (time.perf_counter() - started) * 1000
+    for player1_id, player2_id in pairs:
+        room = await start_battle(server_id, player1_id, player2_id)
+        log("BATTLE_MATCHED", f"server={server_id}, battle_id={room.battle_id}, queued={len(match_queue)}")
+
+
+async def matchmaking_loop() -> None:
+    while True:
+        await asyncio.sleep(MATCH_TICK)
+        for server_id in list(shards):
+            try:
+                await run_matchmaking(server_id)
+            except Exception as exc:
+                log("MATCHMAKING_ERROR", f"server={server_id} 配對失敗：{exc!r}")
+
+
+async def handle_battle_ready(server_id: str, user_id: int, payload: BattleReadyPayload) -> None:
+    """雙方在 game.html 點『開始』 → 送 battle_ready，兩邊都 ready 後送 battle_go。"""
+    manager = shards[server_id]
+    battle_id = payload.battle_id
+
+    room = manager.get_battle(battle_id)
+    if not room:
+        log("BATTLE_READY_ERROR", "battle_id 不存在")
+        return
+    if not room.has_player(user_id):
+        log("BATTLE_READY_ERROR", f"user_id={user_id} 不是 battle_id={battle_id} 的玩家，忽略")
+        return
+
+    room.ready[user_id] = True
+    room.last_activity = time.time()
+    log("BATTLE_READY", f"user {user_id} 已準備好 battle {battle_id}")
+
+    if all(room.ready.values()):
+        log("BATTLE_GO", f"battle {battle_id} 雙方都準備好了，發送 battle_go")
+
+        msg = {
+            "type": "battle_go",
+            "server_id": server_id,
+            "payload": {
+                "battle_id": battle_id,
+                "player1_id": room.player1_id,
+                "player2_id": room.player2_id,
+            }
+        }
+
+        await manager.send_json(server_id, room.player1_id, msg)
+        await manager.send_json(server_id, room.player2_id, msg)
+
+
+async def handle_battle_update(server_id: str, user_id: int, payload: BattleScorePayload) -> None:
+    manager = shards[server_id]
+    battle_id = payload.battle_id
+    score = payload.score
+    state = payload.state
+
+    room = manager.get_battle(battle_id)
+    if room is None:
+        log("BATTLE_UPDATE", f"battle_id={battle_id} 不存在，略過")
+        return
+    # 知道 battle_id 的其他人不能改分數
+    if not room.has_player(user_id):
+        log("BATTLE_UPDATE_ERROR", f"user_id={user_id} 不是 battle_id={battle_id} 的玩家，忽略")
+        return
+
+    # 分數立刻記在房間（結算 / 斷線判定都看這裡），轉送給雙方交給 battle_relay_loop 合併
+    room.scores[user_id] = score
+    manager.set_battle_state(room, state)
+
+    if BATTLE_RELAY_INTERVAL <= 0:
+        await send_battle_update(server_id, room, {user_id})
+        return
+    manager.dirty_battles.setdefault(battle_id, set()).add(user_id)
+
+
+async def relay_battle_scores(manager: ConnectionManager) -> None:
+    """
+    一次 tick：每個分數有變的房間送一則合併後的最新分數。
+    不管前端一秒送幾次 battle_update，每場對戰每人每秒最多收 1 / BATTLE_RELAY_INTERVAL 則。
+    """
+    if not manager.dirty_battles:
+        return
+    dirty, manager.dirty_battles = manager.dirty_battles, {}
+    for battle_id, changed in dirty.items():
+        room = manager.get_battle(battle_id)
+        # 已經結算的房間不用再送，最後分數以 battle_result 為準
+        if room is None:
+            continue
+        if log_enabled("BATTLE_RELAY"):
+            log("BATTLE_RELAY", f"battle_id={battle_id}, scores={room.scores}, changed={sorted(changed)}")
+        await send_battle_update(room.server_id, room, changed)
+
+
+async def battle_relay_loop() -> None:
+    while True:
+        await asyncio.sleep(BATTLE_RELAY_INTERVAL)
+        for manager in list(shards.values()):
+            try:
+                await relay_battle_scores(manager)
+            except Exception as exc:
+                log("BATTLE_RELAY_ERROR", f"轉送對戰分數失敗：{exc!r}")
+
+
+async def handle_battle_result(server_id: str, user_id: int, payload: BattleScorePayload) -> None:
+    """
+    新版：每個玩家結束遊戲時，送上自己的最終分數。
+    等到 room.results 裡有 2 個人，就一起決定勝負、加積分、廣播結果。
+    """
+    manager = shards[server_id]
+    battle_id = payload.battle_id
+    score = payload.score
+
+    room = manager.get_battle(battle_id)
+    if room is None:
+        log("BATTLE_RESULT", f"battle_id={battle_id} 不存在，略過")
+        return
+    # 知道 battle_id 的其他人不能送結果決定勝負
+    if not room.has_player(user_id):
+        log("BATTLE_RESULT_ERROR", f"user_id={user_id} 不是 battle_id={battle_id} 的玩家，忽略")
+        return
+
+    # 1. 記錄這個玩家的最終成績
+    room.results[user_id] = score
+    room.last_activity = time.time()
+    room.scores[user_id] = score
+
+    log(
+        "BATTLE_RESULT_PARTIAL",
+        f"battle_id={battle_id}, user_id={user_id}, score={score}, "
+        f"current_results={room.results}",
+    )
+
+    # 2. 如果另一邊還沒送上來，就直接把「目前的分數」當成他的最終分數
+    if len(room.results) < 2:
+        # 判斷對手是誰
+        other_id = room.player2_id if user_id == room.player1_id else room.player1_id
+        if other_id not in room.results:
+            # 用目前 room.scores 中的分數，當作對手的最終分數
+            other_score = room.scores.get(other_id, 0)
+            room.results[other_id] = other_score
+            log(
+                "BATTLE_RESULT_AUTO_FILL",
+                f"battle_id={battle_id}, auto fill other_id={other_id} score={other_score}",
+            )
+
+    # 3. 兩邊的最終成績都在 room.results 裡了 → 決定勝負
+    player1_id = room.player1_id
+    player2_id = room.player2_id
+
+
+    player1_score = room.results.get(player1_id, 0)
+    player2_score = room.results.get(player2_id, 0)
+
+    if player1_score > player2_score:
+        winner_user_id = player1_id
+    elif player2_score > player1_score:
+        winner_user_id = player2_id
+    else:
+        winner_user_id = 0  # 平手
+
+    log(
+        "BATTLE_RESULT_FINAL",
+        f"battle_id={battle_id}, p1={player1_id} score={player1_score}, "
+        f"p2={player2_id} score={player2_score}, winner={winner_user_id}",
+    )
+    report_battle(room, player1_score, player2_score, winner_user_id)
+
+    # 4. 幫贏家加分（平手不加），和 backend 加的一樣多
+    if winner_user_id > 0:
+        winner_state = manager.get_player_state(server_id, winner_user_id)
+        if winner_state is not None:
+            winner_state.score += BATTLE_WIN_SCORE
+            pet_cache.add_score(winner_user_id, BATTLE_WIN_SCORE)
+
+            # 送一次 pet_state_update 給贏家與視野內的人，排行榜就會更新
+            version = manager.touch_lobby_player(server_id, winner_user_id)
+            update_text = encode_player_message(
+                "pet_state_update", server_id, winner_user_id, winner_state, version
+            )
+            viewers = manager.get_viewers(server_id, winner_user_id)
+            await manager.send_text_to_users(
+                server_id, viewers | {winner_user_id}, update_text, "pet_state_update"
+            )
+
+    # 5. 告訴兩邊最終結果（前端也有自己的 endGame 動畫）
+    result_msg = {
+        "type": "battle_result",
+        "server_id": server_id,
+        "user_id": user_id,
+        "payload": {
+            "battle_id": battle_id,
+            "winner_user_id": winner_user_id,
+            "player1_id": player1_id,
+            "player2_id": player2_id,
+            "player1_score": player1_score,
+            "player2_score": player2_score,
+        },
+    }
+
+    await manager.send_json(server_id, player1_id, result_msg)
+    await manager.send_json(server_id, player2_id, result_msg)
+
+    # ⭐ 新增：順便送一個 battle_force_end，讓前端兩邊一起強制跳結算畫面
+    for pid in (player1_id, player2_id):
+        if pid == player1_id:
+            my_score = player1_score
+            opp_score = player2_score
+        else:
+            my_score = player2_score
+            opp_score = player1_score
+
+        force_msg = {
+            "type": "battle_force_end",
+            "server_id": server_id,
+            "user_id": pid,
+            "payload": {
+                "battle_id": battle_id,
+                "my_final_score": my_score,
+                "opponent_final_score": opp_score,
+                "winner_user_id": winner_user_id,
+                "player1_id": player1_id,
+                "player2_id": player2_id,
+            },
+        }
+        await manager.send_json(server_id, pid, force_msg)
+
+    # 6. 房間收掉
+    manager.finish_battle(battle_id)
+
+
+async def handle_battle_disconnect(server_id: str, user_id: int) -> None:
+    """
+    某一邊在對戰中突然斷線時的處理：
+    - waiting：多半是從 lobby 切到 game.html，不判輸贏也不收房間，真的沒人回來由 battle_reaper_loop 收掉。
+    - running：才會把斷線方判定為落敗，加積分給另外一方。
+    """
+    manager = shards[server_id]
+    room = manager.find_battle_by_user(server_id, user_id)
+    if room is None:
+        owner = manager.remote_battle_owner(server_id, user_id)
+        if owner is not None:
+            # 房間開在別的 worker：交給它判
+            manager.publish(server_id, {"op": "battle_disconnect", "user_id": user_id}, owner)
+            return
+        log(
+            "BATTLE_DISCONNECT",
+            f"server={server_id}, disconnect_user={user_id}, 但找不到 battle 房間，略過",
+        )
+        return
+
+    if room.state == "waiting":
+        log(
+            "BATTLE_DISCONNECT_WAITING",
+            f"server={server_id}, disconnect_user={user_id}, "
+            f"battle_id={room.battle_id} (waiting，多半是從 lobby 切到 game.html，不判輸贏)",
+        )
+        return
+
+    if room.state != "running":
+        log(
+            "BATTLE_DISCONNECT",
+            f"server={server_id}, disconnect_user={user_id}, "
+            f"battle_id={room.battle_id} (state={room.state}，不判輸贏，只結束房間)",
+        )
+        manager.finish_battle(room.battle_id)
+        return
+
+    if user_id == room.player1_id:
+        winner_user_id = room.player2_id
+    else:
+        winner_user_id = room.player1_id
+
+    player1_score = room.scores.get(room.player1_id, 0)
+    player2_score = room.scores.get(room.player2_id, 0)
+
+    log(
+        "BATTLE_DISCONNECT",
+        f"server={server_id}, disconnect_user={user_id}, "
+        f"winner={winner_user_id}, battle_id={room.battle_id}",
+    )
+    report_battle(room, player1_score, player2_score, winner_user_id)
+
+    result_msg = {
+        "type": "battle_result",
+        "server_id": server_id,
+        "user_id": winner_user_id,
+        "payload": {
+            "battle_id": room.battle_id,
+            "winner_user_id": winner_user_id,
+            "player1_id": room.player1_id,
+            "player2_id": room.player2_id,
+            "player1_score": player1_score,
+            "player2_score": player2_score,
+        },
+    }
+
+    await manager.send_json(server_id, room.player1_id, result_msg)
+    await manager.send_json(server_id, room.player2_id, result_msg)
+
+    manager.finish_battle(room.battle_id)
+
+
+# =========================================================
+# 訊息路由表：type -> (payload schema, handler)
+# join_lobby 要綁定連線，另外在 websocket_endpoint 裡處理
+# =========================================================
+
+MessageHandler = Callable[[str, int, Any], Awaitable[None]]
+
+MESSAGE_ROUTES: Dict[str, Tuple[MessageSchema, MessageHandler]] = {
+    "pet_state_update": (PET_STATE_SCHEMA, handle_pet_state_update),
+    "update_position": (POSITION_SCHEMA, handle_update_position),
+    "chat_request": (TO_USER_SCHEMA, handle_chat_request),
+    "chat_request_accept": (FROM_USER_SCHEMA, handle_chat_request_accept),
+    "chat_message": (CHAT_MESSAGE_SCHEMA, handle_chat_message),
+    "battle_invite": (TO_USER_SCHEMA, handle_battle_invite),
+    "battle_accept": (FROM_USER_SCHEMA, handle_battle_accept),
+    "battle_queue_join": (EMPTY_SCHEMA, handle_battle_queue_join),
+    "battle_queue_leave": (EMPTY_SCHEMA, handle_battle_queue_leave),
+    "battle_update": (BATTLE_SCORE_SCHEMA, handle_battle_update),
+    "battle_ready": (BATTLE_READY_SCHEMA, handle_battle_ready),
+    "battle_result": (BATTLE_SCORE_SCHEMA, handle_battle_result),
+}
+
+
+async def run_handler(
+    handler: Callable[..., Awaitable[None]],
+    msg_type: str,
+    server_id: str,
+    user_id: int,
+    payload: Any,
+    *args: Any,
+) -> None:
+    """dispatch 的地方都走這裡；剖析模式打開時記 handler 的時間，並讓裡面的廣播知道是哪個 type 觸發的。"""
+    if not profiler.enabled:
+        await handler(server_id, user_id, payload, *args)
+        return
+    token = current_msg_type.set(msg_type)
+    started = time.perf_counter()
+    try:
+        await handler(server_id, user_id, payload, *args)
+    finally:
+        profiler.record(handler.__name__, time.perf_counter() - started, user_id)
+        current_msg_type.reset(token)
+
+
+# =========================================================
+# 背景工作：回收卡住的對戰房間
+# =========================================================
+
+async def reap_expired_battles(manager: ConnectionManager) -> None:
+    now = time.time()
+    for room in manager.get_expired_battles(now):
+        reason = "WAITING_TIMEOUT" if room.state == "waiting" else "RUNNING_TIMEOUT"
+        log(
+            "BATTLE_EXPIRED",
+            f"server={room.server_id}, battle_id={room.battle_id}, state={room.state}, "
+            f"已停留 {now - room.state_since:.0f} 秒、閒置 {now - room.last_activity:.0f} 秒，回收房間",
+        )
+        for pid in (room.player1_id, room.player2_id):
+            msg = {
+                "type": "battle_expired",
+                "server_id": room.server_id,
+                "user_id": pid,
+                "payload": {
+                    "battle_id": room.battle_id,
+                    "reason": reason,
+                    "message": "對戰逾時，房間已關閉。",
+                },
+            }
+            await manager.send_json(room.server_id, pid, msg)
+        manager.finish_battle(room.battle_id)
+
+
+async def battle_reaper_loop() -> None:
+    while True:
+        await asyncio.sleep(BATTLE_REAP_INTERVAL)
+        try:
+            for manager in list(shards.values()):
+                await reap_expired_battles(manager)
+        except Exception as exc:
+            log("BATTLE_REAPER_ERROR", f"回收對戰房間失敗：{exc!r}")
+
+
+async def finish_lobby_leave(server_id: str, user_id: int) -> None:
+    """grace 期過了還沒回來 → 這時才處理對戰斷線、從大廳移除，通知整個大廳。"""
+    manager = shards[server_id]
+    await handle_battle_disconnect(server_id, user_id)
+    viewers = manager.get_viewers(server_id, user_id)
+    manager.disconnect(server_id, user_id)
+    version = manager.touch_lobby_player(server_id, user_id)
+
+    player_left_msg = {
+        "type": "player_left",
+        "server_id": server_id,
+        "user_id": user_id,
+        "payload": {"version": version},
+    }
+    await manager.send_to_users(server_id, viewers, player_left_msg)
+
+    # 視野外的人排行榜上可能還留著他（走出視野時 lobby_app 不會刪 allPlayers），
+    # 另外送一筆不帶版本的 player_left 給整個大廳，只是讓他們把人移掉
+    others = [uid for uid in manager.lobby_order.get(server_id, []) if uid not in viewers]
+    await manager.send_to_users(
+        server_id,
+        others,
+        {"type": "player_left", "server_id": server_id, "user_id": user_id, "payload": {}},
+    )
+
+
+async def handle_connection_lost(server_id: str, user_id: int, websocket: WebSocket, reason: str) -> None:
+    """WebSocketDisconnect 走這裡；grace 設成 0 時不等 lobby_leave_loop，直接離開大廳。"""
+    manager = shards[server_id]
+    if not manager.drop_connection(server_id, user_id, websocket, reason):
+        return
+    log("WS_DISCONNECT", f"server={server_id}, user_id={user_id} 斷線")
+    if LOBBY_LEAVE_GRACE <= 0 and manager.cancel_leave(server_id, user_id):
+        await finish_lobby_leave(server_id, user_id)
+
+
+# =========================================================
+# Backplane：處理其他 worker 送來的訊息
+# =========================================================
+
+# 這幾種訊息要在房間所在的 worker 上處理，房間不在這裡就轉過去
+BATTLE_ROOM_TYPES = {"battle_ready", "battle_update", "battle_result"}
+
+
+def forward_to_battle_owner(server_id: str, user_id: int, msg_type: str, payload: Any) -> bool:
+    manager = shards[server_id]
+    if msg_type not in BATTLE_ROOM_TYPES or not manager.backplane.distributed:
+        return False
+    owner = manager.remote_battles.get(payload.battle_id)
+    if owner is None:
+        return False
+    manager.publish(
+        server_id,
+        {"op": "handle", "type": msg_type, "user_id": user_id, "payload": asdict(payload)},
+        owner,
+    )
+    return True
+
+
+async def bp_deliver(server_id: str, worker: str, message: dict) -> None:
+    manager = shards[server_id]
+    await manager.send_text_to_users(
+        server_id, message["user_ids"], message["text"], message["msg_type"], relay=False
+    )
+
+
+async def bp_claim(server_id: str, worker: str, message: dict) -> None:
+    manager = shards[server_id]
+    replaced = manager.apply_remote_claim(server_id, message["user_id"], worker)
+    if replaced is not None:
+        close_in_background(replaced, WS_CLOSE_REPLACED, "logged in elsewhere")
+
+
+async def bp_player(server_id: str, worker: str, message: dict) -> None:
+    manager = shards[server_id]
+    manager.apply_remote_player(server_id, message["user_id"], worker, message["player"])
+
+
+async def bp_chat_approve(server_id: str, worker: str, message: dict) -> None:
+    manager = shards[server_id]
+    user1_id, user2_id = message["user_ids"]
+    manager.chat_approvals.approve(server_id, user1_id, user2_id, message["at"])
+
+
+async def bp_battle_open(server_id: str, worker: str, message: dict) -> None:
+    manager = shards[server_id]
+    manager.apply_remote_battle(server_id, worker, message["battle_id"], message["user_ids"], True)
+
+
+async def bp_battle_close(server_id: str, worker: str, message: dict) -> None:
+    manager = shards[server_id]
+    manager.apply_remote_battle(server_id, worker, message["battle_id"], message["user_ids"], False)
+
+
+async def bp_handle(server_id: str, worker: str, message: dict) -> None:
+    # 房間開在這裡，另一個 worker 上的玩家送來的對戰訊息
+    msg_type = message["type"]
+    schema, handler = MESSAGE_ROUTES[msg_type]
+    payload = schema.decode(message["payload"])
+    await run_handler(handler, msg_type, server_id, message["user_id"], payload)
+
+
+async def bp_battle_disconnect(server_id: str, worker: str, message: dict) -> None:
+    await handle_battle_disconnect(server_id, message["user_id"])
+
+
+async def bp_sync_request(server_id: str, worker: str, message: dict) -> None:
+    manager = shards[server_id]
+    # 新 worker 加入（或剛重連上 broker），把自己身上的狀態再公告一次
+    manager.replicate_local_state(server_id)
+
+
+BACKPLANE_OPS: Dict[str, Callable[[str, str, dict], Awaitable[None]]] = {
+    "deliver": bp_deliver,
+    "claim": bp_claim,
+    "player": bp_player,
+    "chat_approve": bp_chat_approve,
+    "battle_open": bp_battle_open,
+    "battle_close": bp_battle_close,
+    "handle": bp_handle,
+    "battle_disconnect": bp_battle_disconnect,
+    "sync_request": bp_sync_request,
+}
+
+
+async def handle_backplane_message(message: dict) -> None:
+    worker = message.get("origin")
+    if worker == WORKER_ID:
+        return
+    op = BACKPLANE_OPS.get(message.get("op"))
+    if op is None:
+        log("BACKPLANE_ERROR", f"未知的 backplane op={message.get('op')!r}，略過")
+        return
+    await op(message["server_id"], worker, message)
+
+
+def announce_worker(server_id: str) -> None:
+    manager = shards[server_id]
+    manager.replicate_local_state(server_id)
+    manager.publish(server_id, {"op": "sync_request"})
+
+
+# =========================================================
+# 全域頻道：跨 shard 的公告 / 排行榜推播
+# 每個行程訂閱一次；收到後每個 shard 只 encode 一次，送給這個行程身上所有連線
+# =========================================================
+
+global_backplane = make_backplane(GLOBAL_BACKPLANE_URL)
+
+
+async def deliver_global_event(message: dict) -> Dict[str, int]:
+    """送給這個行程裡每個（指定的）shard 的所有連線，回傳每個 shard 送給幾個人。"""
+    targets = message.get("shards") or None
+    delivered: Dict[str, int] = {}
+    for shard_id, manager in list(shards.items()):
+        if targets is not None and shard_id not in targets:
+            continue
+        text = json.dumps(
+            {"type": message["event"], "server_id": shard_id, "payload": message["payload"]},
+            ensure_ascii=False,
+        )
+        user_ids = [uid for _, uid in list(manager.active_connections)]
+        # 其他 worker 也訂閱了全域頻道，各自送自己身上的連線，不用再轉
+        await manager.send_text_to_users(shard_id, user_ids, text, message["event"], relay=False)
+        manager.metrics.record_global(len(user_ids), max(time.time() - message["sent_at"], 0.0))
+        delivered[shard_id] = len(user_ids)
+    return delivered
+
+
+async def handle_global_message(message: dict) -> None:
+    if message.get("origin") == WORKER_ID:
+        return
+    await deliver_global_event(message)
+
+
+async def publish_global_event(event: str, payload: dict, target_shards: List[str] | None = None) -> dict:
+    message = {
+        "id": secrets.token_hex(8),
+        "event": event,
+        "payload": payload,
+        "shards": target_shards,
+        "sent_at": time.time(),
+        "origin": WORKER_ID,
+    }
+    # broker 不會回送給自己，這個行程的 shard 直接送
+    if global_backplane.distributed:
+        global_backplane.publish(GLOBAL_CHANNEL, message)
+    delivered = await deliver_global_event(message)
+    log("GLOBAL_EVENT", f"id={message['id']}, event={event}, shards={target_shards or 'all'}, local={delivered}")
+    return {"id": message["id"], "published": global_backplane.distributed, "delivered_local": delivered}
+
+
+# =========================================================
+# backend 推來的寵物變動（"pet:<server_id>"，走全域頻道）
+# =========================================================
+
+async def handle_pet_event(message: dict) -> None:
+    """
+    Pi 回報運動、對戰結算、體力衰減寫進 DB 後，backend 推過來的最新值。
+    每個 worker 都會收到，只有玩家所在的 worker 會改到大廳玩家、發出 pet_state_update，
+    看得到他的人在別的 worker 時由 send_text_to_users 轉過去。
+    """
+    pet_cache.pushes += 1
+    if "sent_at" in message:
+        pet_cache.push_latency.observe(max(time.time() - message["sent_at"], 0.0))
+    changed = pet_cache.apply(message["user_id"], message["energy"], message["score"], message["status"])
+    await broadcast_pet_changes(changed)
+
+
+async def broadcast_pet_changes(changed: List[Tuple[str, LobbyPlayer, int]]) -> None:
+    """本人 + 視野內的人各收一筆 pet_state_update（每個人只 encode 一次）。"""
+    for shard_id, player, version in changed:
+        manager = shards[shard_id]
+        text = encode_player_message("pet_state_update", shard_id, player.user_id, player, version)
+        viewers = manager.get_viewers(shard_id, player.user_id)
+        await manager.send_text_to_users(shard_id, viewers | {player.user_id}, text, "pet_state_update")
+        if log_enabled("PET_PUSH"):
+            log(
+                "PET_PUSH",
+                f"server={shard_id}, user_id={player.user_id}, energy={player.energy}, "
+                f"score={player.score}, viewers={len(viewers)}",
+            )
+
+
+async def pet_cache_refresh_loop() -> None:
+    while True:
+        await asyncio.sleep(PET_CACHE_REFRESH)
+        await pet_cache.refresh()
+
+
+async def lobby_leave_loop() -> None:
+    # 送訊失敗被踢掉的連線也會排進來，所以 grace 設成 0 也要跑
+    while True:
+        await asyncio.sleep(max(LOBBY_LEAVE_GRACE / 4, 0.5))
+        now = time.time()
+        for manager in list(shards.values()):
+            for server_id, user_id in manager.pop_expired_leaves(now):
+                try:
+                    await finish_lobby_leave(server_id, user_id)
+                except Exception as exc:
+                    log("LOBBY_LEAVE_ERROR", f"server={server_id}, user_id={user_id} 移出大廳失敗：{exc!r}")
+
+
+async def close_quietly(websocket: WebSocket, code: int, reason: str | None = None) -> None:
+    try:
+        await websocket.close(code=code, reason=reason)
+    except (RuntimeError, WebSocketDisconnect, OSError):
+        pass
+
+
+def close_in_background(websocket: WebSocket, code: int, reason: str | None = None) -> None:
+    # 半開的 TCP 連線 close 可能要等很久，另外開 task，不要卡住呼叫端
+    closing = asyncio.create_task(close_quietly(websocket, code, reason))
+    closing_tasks.add(closing)
+    closing.add_done_callback(closing_tasks.discard)
+
+
+async def heartbeat_loop() -> None:
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        now = time.time()
+        for manager in list(shards.values()):
+            for (server_id, user_id), ws in list(manager.active_connections.items()):
+                idle = now - manager.last_seen.get((server_id, user_id), now)
+                if idle > HEARTBEAT_TIMEOUT:
+                    if manager.drop_connection(server_id, user_id, ws, "heartbeat_timeout"):
+                        close_in_background(ws, 1001, "heartbeat timeout")
+                elif idle >= HEARTBEAT_INTERVAL:
+                    ping_text = (
+                        f'{{"type":"ping","server_id":{json.dumps(server_id)},'
+                        f'"user_id":{user_id},"payload":{{"ts":{now!r}}}}}'
+                    )
+                    await manager.send_text(server_id, user_id, ping_text, "ping")
+
+
+async def metrics_loop() -> None:
+    # 每個視窗把累積計數換算成每秒訊息數
+    while True:
+        await asyncio.sleep(METRICS_WINDOW)
+        now = time.time()
+        for manager in list(shards.values()):
+            manager.metrics.roll(now)
+
+
+async def event_loop_lag_probe() -> None:
+    # sleep 固定時間，實際醒來晚了多少就是 event loop 被卡住的時間
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.record(max(loop.time() - start - LOOP_LAG_INTERVAL, 0.0))
+
+
+async def chat_approval_prune_loop() -> None:
+    # 沒人再聊的配對不會被 is_chat_approved 碰到，定期掃一次過期的
+    while True:
+        await asyncio.sleep(CHAT_APPROVAL_TTL / 4)
+        now = time.time()
+        for shard_id, manager in list(shards.items()):
+            removed = manager.chat_approvals.prune(now)
+            if removed:
+                log(
+                    "CHAT_APPROVAL_PRUNE",
+                    f"server={shard_id} 清掉 {removed} 組過期聊天配對，剩餘 {manager.chat_approvals.pair_count()} 組",
+                )
+
+
+async def open_backend_client() -> None:
+    global backend_client
+    if not BACKEND_URL:
+        log("BACKEND", "WS_BACKEND_URL 沒設定，對戰結果 / 聊天紀錄不寫回 backend")
+        return
+    backend_client = httpx.AsyncClient(
+        base_url=BACKEND_URL,
+        timeout=BACKEND_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=BACKEND_MAX_CONNECTIONS,
+            max_keepalive_connections=BACKEND_MAX_CONNECTIONS,
+        ),
+    )
+    await battle_reporter.start(
+        backend_client,
+        BATTLE_REPORT_QUEUE
+        or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", f"battle_reports-{LogFormatter.name}.jsonl"),
+    )
+    chat_writer.start(backend_client)
+    pet_cache.start(backend_client)
+    background_tasks.append(asyncio.create_task(pet_cache_refresh_loop()))
+    log("BACKEND", f"backend={BACKEND_URL}")
+
+
+@app.on_event("startup")
+async def start_background_tasks() -> None:
+    if not shards:
+        configure_shards(SHARD_IDS_DEFAULT)
+    for shard_id, manager in shards.items():
+        backplane = manager.backplane
+        backplane.subscribe(shard_id, handle_backplane_message)
+        backplane.subscribe(f"{shard_id}:{WORKER_ID}", handle_backplane_message)
+        backplane.on_connect = functools.partial(announce_worker, shard_id)
+        await backplane.start()
+    global_backplane.subscribe(GLOBAL_CHANNEL, handle_global_message)
+    for shard_id in shards:
+        global_backplane.subscribe(f"pet:{shard_id}", handle_pet_event)
+    await global_backplane.start()
+    await open_backend_client()
+    log("START", f"shards={','.join(shards)}, worker={WORKER_ID}")
+    background_tasks.append(asyncio.create_task(battle_reaper_loop()))
+    background_tasks.append(asyncio.create_task(matchmaking_loop()))
+    if BATTLE_RELAY_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(battle_relay_loop()))
+    background_tasks.append(asyncio.create_task(chat_approval_prune_loop()))
+    background_tasks.append(asyncio.create_task(lobby_leave_loop()))
+    if HEARTBEAT_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(heartbeat_loop()))
+    background_tasks.append(asyncio.create_task(metrics_loop()))
+    background_tasks.append(asyncio.create_task(event_loop_lag_probe()))
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks() -> None:
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    for manager in shards.values():
+        await manager.backplane.close()
+    await global_backplane.close()
+    await chat_writer.close()
+    await battle_reporter.close()
+    if backend_client is not None:
+        await backend_client.aclose()
+    # 把 queue 裡剩下的 log 盡量寫完；不用 log_listener.stop()，stdout 卡住時它會一直 join 不回來
+    deadline = time.time() + 2.0
+    while not log_queue_handler.queue.empty() and time.time() < deadline:
+        await asyncio.sleep(0.05)
+
+
+# =========================================================
+# FastAPI 路由：health_check + metrics + WebSocket 主入口
+# =========================================================
+
+def default_shard_id() -> str:
+    return next(iter(shards))
+
+
+def shard_health(server_id: str) -> dict:
+    manager = shards[server_id]
+    return {
+        "message": f"ws{server_id} server running",
+        "server_id": server_id,
+        "live_battles": manager.live_battle_count(),
+        "chat_approved_pairs": manager.chat_approvals.pair_count(),
+        "chat_approved_users": manager.chat_approvals.user_count(),
+        "compression": manager.compression_stats.snapshot(),
+        "lobby_version": manager.lobby_version(server_id),
+        "pending_lobby_leaves": len(manager.pending_leaves),
+        "sessions": len(manager.sessions),
+        "connections": len(manager.active_connections),
+        "evictions": dict(manager.eviction_counts),
+        "throttled": dict(manager.inbound_limiter.throttled),
+        "read_pauses": manager.read_pauses,
+    }
+
+
+def shard_metrics(server_id: str) -> dict:
+    manager = shards[server_id]
+    pending = manager.outbound_pending
+    slowest = sorted(pending.items(), key=lambda item: item[1], reverse=True)[:5]
+    return {
+        "connections": len(manager.active_connections),
+        "lobby_size": len(manager.lobby_order.get(server_id, ())),
+        "live_battles": manager.live_battle_count(),
+        "chat_approved_pairs": manager.chat_approvals.pair_count(server_id),
+        **manager.metrics.snapshot(),
+        "matchmaking": manager.get_match_queue(server_id).snapshot(time.time()),
+        "outbound_queue": {
+            "connections_waiting": len(pending),
+            "total_pending": sum(pending.values()),
+            "max_pending": slowest[0][1] if slowest else 0,
+            "paused_readers": len(manager.outbound_waiters),
+            "slowest": [{"user_id": uid, "pending": n} for (_, uid), n in slowest],
+        },
+        "throttled": dict(manager.inbound_limiter.throttled),
+        "evictions": dict(manager.eviction_counts),
+        "backplane": {
+            **manager.backplane.snapshot(),
+            "remote_users": len(manager.remote_users),
+            "remote_battles": len(manager.remote_battles),
+        },
+    }
+
+
+@app.get("/")
+async def health_check():
+    log("HEALTH_CHECK", "收到 / 請求")
+    # 最上層維持原本（第一個 shard）的格式，多 shard 時每個 shard 的在 shards 底下
+    return {
+        **shard_health(default_shard_id()),
+        "shards": {shard_id: shard_health(shard_id) for shard_id in shards},
+        "log_dropped": dict(log_sampler.dropped),
+        "log_queue_full": log_queue_handler.dropped,
+        "profiling": profiler.enabled,
+    }
+
+
+@app.get("/metrics")
+async def runtime_metrics():
+    # 給監控定期抓，不寫 log
+    return {
+        "server_id": default_shard_id(),
+        "window_seconds": METRICS_WINDOW,
+        "servers": {shard_id: shard_metrics(shard_id) for shard_id in shards},
+        "event_loop_lag_ms": loop_lag.snapshot(),
+        "global_backplane": global_backplane.snapshot(),
+        "battle_reports": battle_reporter.snapshot(),
+        "chat_persist": chat_writer.snapshot(),
+        "pet_cache": pet_cache.snapshot(),
+    }
+
+
+def require_admin(request: Request) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="admin API disabled (WS_ADMIN_TOKEN not set)")
+    if not secrets.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="invalid admin token")
+
+
+@app.get("/admin/profile")
+async def get_profile(request: Request):
+    require_admin(request)
+    return profiler.snapshot()
+
+
+@app.post("/admin/profile")
+async def set_profile(
+    request: Request,
+    enabled: bool | None = None,
+    slow_ms: float | None = None,
+    reset: bool = False,
+):
+    """例：POST /admin/profile?enabled=true&slow_ms=20&reset=true"""
+    require_admin(request)
+    if reset:
+        profiler.reset()
+    if slow_ms is not None:
+        profiler.slow_ms = max(slow_ms, 0.0)
+    if enabled is not None:
+        profiler.set_enabled(enabled)
+    log("PROFILE", f"剖析模式 enabled={profiler.enabled}, slow_ms={profiler.slow_ms}, reset={reset}")
+    return profiler.snapshot()
+
+
+@app.get("/admin/profile/sample", response_class=PlainTextResponse)
+async def sample_profile(request: Request, seconds: float = 10.0, interval_ms: float = 5.0):
+    """
+    取樣 event loop 的 call stack N 秒，回傳 folded stacks：
+    curl -H "X-Admin-Token: ..." ".../admin/profile/sample?seconds=10" | flamegraph.pl > loop.svg
+    """
+    require_admin(request)
+    if profiler.sampling:
+        raise HTTPException(status_code=409, detail="another sample is running")
+    seconds = min(max(seconds, 0.1), PROFILE_SAMPLE_MAX_SECONDS)
+    interval = max(interval_ms, 1.0) / 1000
+    profiler.sampling = True
+    log("PROFILE", f"開始取樣 event loop stack {seconds:.1f} 秒，間隔 {interval * 1000:.0f}ms")
+    try:
+        # 取樣 thread 在跑的時候 event loop 照常處理訊息，這個 request 等它結束
+        return await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds, interval)
+    finally:
+        profiler.sampling = False
+
+
+class GlobalEventRequest(BaseModel):
+    type: str
+    payload: Dict[str, Any] = {}
+    # 只送給某些伺服器；不給就是全部
+    shards: List[str] | None = None
+
+
+@app.post("/admin/global")
+async def publish_global(request: Request, body: GlobalEventRequest):
+    """
+    例：維護公告
+    POST /admin/global {"type": "announcement", "payload": {"title": "維護通知", "message": "..."}}
+    """
+    require_admin(request)
+    if body.type not in GLOBAL_EVENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"type must be one of {sorted(GLOBAL_EVENT_TYPES)}")
+    return await publish_global_event(body.type, body.payload, body.shards)
+
+
+@app.websocket("/ws/")
+async def websocket_endpoint(websocket: WebSocket):
+    await serve_connection(websocket, default_shard_id())
+
+
+@app.websocket("/ws/{shard_id}/")
+async def shard_websocket_endpoint(websocket: WebSocket, shard_id: str):
+    if shard_id not in shards:
+        # 這個行程沒有跑這個 shard
+        await websocket.close(code=1008)
+        return
+    await serve_connection(websocket, shard_id)
+
+
+async def serve_connection(websocket: WebSocket, server_id: str) -> None:
+    await websocket.accept()
+    user_id: int | None = None
+    log("WS_ACCEPT", f"server={server_id} 有新的 WebSocket 連線進來")
+
+    manager = shards[server_id]
+    limiter = manager.inbound_limiter
+    metrics = manager.metrics
+
+    try:
+        while True:
+            if user_id is not None:
+                # 這個玩家自己的下行塞住了 → 先不讀他的訊息
+                await manager.wait_outbound_drained(server_id, user_id)
+            if user_id is None and HEARTBEAT_TIMEOUT > 0:
+                try:
+                    frame = await asyncio.wait_for(websocket.receive(), HEARTBEAT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    log("WS_IDLE", f"連線 {HEARTBEAT_TIMEOUT:.0f} 秒內沒有 join_lobby，關閉")
+                    await close_quietly(websocket, 1008)
+                    return
+            else:
+                frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            if user_id is not None:
+                if manager.get_ws(server_id, user_id) is not websocket:
+                    # 已經被新登入取代（或被踢掉）的舊連線：不再代表這個玩家處理任何訊息
+                    log("WS_STALE", f"server={server_id}, user_id={user_id} 舊連線已被取代，停止處理")
+                    await close_quietly(websocket, 1001)
+                    return
+                manager.last_seen[(server_id, user_id)] = time.time()
+
+            data = frame.get("bytes")
+            if data is not None:
+                if user_id is None:
+                    log("WS_NO_USER", "尚未 join_lobby 的連線收到二進位訊息，忽略")
+                    continue
+                try:
+                    msg_type, payload = decode_binary_frame(server_id, user_id, data)
+                except MessageDecodeError as exc:
+                    log("WS_BAD_BINARY", f"user_id={user_id} 二進位訊息格式錯誤（{exc}），忽略")
+                    continue
+                metrics.count_inbound(msg_type)
+                if not limiter.allow((server_id, user_id), msg_type, time.time()):
+                    continue
+                if forward_to_battle_owner(server_id, user_id, msg_type, payload):
+                    continue
+                _, handler = MESSAGE_ROUTES[msg_type]
+                await run_handler(handler, msg_type, server_id, user_id, payload)
+                continue
+
+            raw = frame.get("text") or ""
+            try:
+                msg_type, msg_user_id, raw_payload = decode_envelope(raw)
+            except MessageDecodeError as exc:
+                log("WS_ERROR", f"收到格式錯誤的訊息（{exc}）：{raw[:200]!r}")
+                continue
+
+            if msg_type == "pong":
+                # 只是心跳回應，上面已經更新過 last_seen
+                metrics.count_inbound(msg_type)
+                continue
+
+            # 限流在解 payload、dispatch 之前；還沒綁定的連線只會送第一個 join_lobby
+            if user_id is not None and not limiter.allow((server_id, user_id), msg_type, time.time()):
+                continue
+
+            if msg_type == "join_lobby":
+                metrics.count_inbound(msg_type)
+                if msg_user_id is None:
+                    log("JOIN_LOBBY_ERROR", "join_lobby 缺少有效 user_id，忽略")
+                    continue
+
+                try:
+                    join_payload = JOIN_LOBBY_SCHEMA.decode(raw_payload)
+                except MessageDecodeError as exc:
+                    log("JOIN_LOBBY_ERROR", f"join_lobby payload 格式錯誤（{exc}），忽略")
+                    continue
+
+                if user_id is None:
+                    user_id = msg_user_id
+                    log("WS_BIND_USER", f"這條連線綁定為 user_id={user_id}")
+                else:
+                    if msg_user_id != user_id:
+                        log(
+                            "JOIN_LOBBY_IMPERSONATE",
+                            f"連線實際 user_id={user_id}，但 join_lobby 帶 user_id={msg_user_id}，忽略",
+                        )
+                        continue
+
+                await run_handler(handle_join_lobby, msg_type, server_id, user_id, join_payload, websocket)
+                continue
+
+            if user_id is None:
+                # type 是前端給的任意字串，沒處理的一律算在 unknown，/metrics 的 key 不會被灌爆
+                metrics.count_inbound("unknown")
+                log("WS_NO_USER", f"尚未 join_lobby 的連線收到 {msg_type}，忽略")
+                continue
+
+            if msg_user_id is not None and msg_user_id != user_id:
+                continue
+
+            route = MESSAGE_ROUTES.get(msg_type)
+            if route is None:
+                metrics.count_inbound("unknown")
+                log("WS_UNKNOWN_TYPE", f"未知事件 type={msg_type!r}，略過")
+                continue
+            metrics.count_inbound(msg_type)
+
+            schema, handler = route
+            try:
+                payload = schema.decode(raw_payload)
+            except MessageDecodeError as exc:
+                log("WS_BAD_PAYLOAD", f"user_id={user_id}, type={msg_type} 格式錯誤（{exc}），忽略")
+                continue
+
+            if forward_to_battle_owner(server_id, user_id, msg_type, payload):
+                continue
+            await run_handler(handler, msg_type, server_id, user_id, payload)
+
+    except WebSocketDisconnect:
+        if user_id is not None:
+            # 先不廣播 player_left、不收對戰房間，grace 期內拿 token 重連就當作沒離開過
+            # 已經因為送訊失敗 / 心跳逾時被踢掉的連線，這裡不會再處理一次
+            await handle_connection_lost(server_id, user_id, websocket, "disconnect")
+